@@ -1,3 +1,4 @@
+from typing import Any
 from I40Client import configuration as config
 from I40Client import server_connection as server
 from I40ClientUtils import chatbot_tools
@@ -9,6 +10,8 @@ import copy
 import traceback
 import asyncio
 
+QUEUE_UPDATES_INTERVAL = 2  # Seconds between the queue position updates sent by the server
+
 def main() -> None:
     system = sys.platform
     configFile = None
@@ -87,16 +90,35 @@ def main() -> None:
     print(f"Got {len(conversation['conv'])} messages from the conversation.", flush = True)
     
     async def __socket__() -> None:
+        modelsInfo = {}
+
+        async def __get_model_info__() -> dict[str, Any]:
+            # Only requested once for each model
+            modelName = getattr(conf, "CLIENT_ModelName")
+
+            if (modelName not in modelsInfo):
+                modelsInfo[modelName] = await socket.GetModelInfo(modelName)
+            
+            return modelsInfo[modelName]
+
         async def __send__(AllowTools: bool = True, Service: str = "inference") -> None:
             await socket.Connect(Host = getattr(conf, "CLIENT_Host"), Port = getattr(conf, "CLIENT_Port"), Secure = getattr(conf, "CLIENT_Secure"))
             
-            modelInfo = await socket.GetModelInfo(getattr(conf, "CLIENT_ModelName"))
-            modelMaxSimulUsers = modelInfo["max_simul_users"] if ("max_simul_users" in modelInfo) else 1
-            queueData = await socket.GetQueueData(getattr(conf, "CLIENT_ModelName"))
+            userParams = conversation["params_user"].copy()
 
-            if (queueData["processing_users"] >= modelMaxSimulUsers):
-                usersBefore = queueData["processing_users"] + queueData["waiting_users"]
-                print(f"{usersBefore} users are using this model. You must wait until the queue of users is less than {modelMaxSimulUsers}.", flush = True)
+            if ("queue_updates_interval" not in userParams):
+                # Servers without queue updates ignore this parameter
+                userParams["queue_updates_interval"] = QUEUE_UPDATES_INTERVAL
+
+            if (not socket.HasCapability("queue_updates")):
+                # Older servers don't send the queue position, checked before sending the prompt
+                modelInfo = await __get_model_info__()
+                modelMaxSimulUsers = modelInfo["max_simul_users"] if ("max_simul_users" in modelInfo) else 1
+                queueData = await socket.GetQueueData(getattr(conf, "CLIENT_ModelName"))
+
+                if (queueData["processing_users"] >= modelMaxSimulUsers):
+                    usersBefore = queueData["processing_users"] + queueData["waiting_users"]
+                    print(f"{usersBefore} users are using this model. You must wait until the queue of users is less than {modelMaxSimulUsers}.", flush = True)
 
             conv = copy.deepcopy(conversation["conv"])
 
@@ -119,7 +141,7 @@ def main() -> None:
                 Key = None,
                 PromptConversation = conv,
                 PromptParameters = conversation["params_prompt"],
-                UserParameters = conversation["params_user"],
+                UserParameters = userParams,
                 Service = Service
             )
             errors = 0
@@ -127,6 +149,9 @@ def main() -> None:
             currentChannel = None
 
             async for token in gen:
+                if ("queue_position" in token):
+                    print(f"{token['queue_position']} users before you in the queue" + (f" (~{token['eta_seconds']} seconds)." if (token.get("eta_seconds") is not None) else "."), flush = True)
+
                 if ("conversation_result" in token):
                     conversation["conv"] = token["conversation_result"]
 
@@ -187,6 +212,9 @@ def main() -> None:
                     
                     errors += len(token["errors"])
             
+            if (len(tools) > 0 and AllowTools):
+                modelInfo = await __get_model_info__()
+            
             if (len(tools) > 0 and AllowTools and modelInfo["service"] == "chatbot"):
                 toolsResponse = []
 
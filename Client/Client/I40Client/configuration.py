@@ -9,6 +9,10 @@ class ClientConfiguration():
         self.Encryption_Threads: int = 1
         self.Encryption_RSASize: int = 4096
         self.Encryption_Hash: str = "sha512"
+        self.Encryption_UseSession: bool = True
+
+        # Protocol configuration
+        self.Protocol_Binary: bool = True  # Binary messages (protocol v3) if the server supports them; media is sent without base64
 
         # Service configuration
         self.Service_DefaultAPIKey: str = "nokey"
@@ -27,7 +31,7 @@ class ClientConfiguration():
     
     @classmethod
     def FromDict(cls, Dict = dict[str, Any]) -> Self:
-        instance = cls.__new__(cls)
+        instance = cls()  # Start from the defaults so older configurations get the new parameters
 
         for k, v in Dict.items():
             setattr(instance, k, v)
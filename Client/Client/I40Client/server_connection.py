@@ -4,12 +4,24 @@ from typing import Any, Literal
 from collections.abc import AsyncGenerator
 from websockets import connect as WS_Connect
 from websockets.protocol import State as WS_State
-from . import configuration, encryption
+from . import configuration, encryption, binary_protocol
 import json
 import base64
+import hashlib
 import asyncio
+import struct
 
 TRANSFER_RATE = 8192 * 1024
+BINARY_CHUNK_SIZE = TRANSFER_RATE - 262144  # Compression makes incompressible data (ciphertext, media) a bit larger, keep the frames under the limit
+FRAMES_SUBPROTOCOL = "i40-frames"  # Each message is a header frame (type of message, length in bytes) followed by its data
+FRAME_HEADER = struct.Struct(">BQ")
+FRAME_TYPE_TEXT = 0
+FRAME_TYPE_BINARY = 1
+
+def GetConversationHash(Conversation: list[dict[str, Any]]) -> str:
+    # Same hash as the server's `conversation_hash`, returned with the `delta_result` user parameter.
+    # The server converts text contents to `[{"type": "text", "text": ...}]`; hash the conversation in that format.
+    return hashlib.sha256(json.dumps(Conversation, sort_keys = True, separators = (",", ":")).encode("utf-8")).hexdigest()
 
 class ClientSocket():
     def __init__(
@@ -22,6 +34,8 @@ class ClientSocket():
         self.__configuration__ = Configuration
         self.__server_public_key_str__ = None
         self.__server_public_key__ = None
+        self.__server_capabilities__ = []
+        self.__session__ = None
         self.__current_connection__ = [None, None, None, None]
 
         if (Configuration.Encryption_PublicKey is None or Configuration.Encryption_PrivateKey is None):
@@ -47,6 +61,7 @@ class ClientSocket():
             self.__socket__ = await WS_Connect(
                 uri = uri,
                 max_size = TRANSFER_RATE,
+                subprotocols = [FRAMES_SUBPROTOCOL],  # Older servers ignore it and use `--END--` after each message
                 ping_interval = self.__configuration__.PingInterval,
                 ping_timeout = None
             )
@@ -55,6 +70,8 @@ class ClientSocket():
                 await asyncio.sleep(0.1)
         
         self.__current_connection__ = [self.__socket_type__, Host, Port, Secure]
+        self.__session__ = None
+
         await self.__set_server_public_key__()
 
     async def Close(self) -> None:
@@ -74,32 +91,110 @@ class ClientSocket():
         self.__server_public_key_str__ = await self.SendAndReceive("get_public_key")
         _, self.__server_public_key__ = encryption.LoadKeysFromContent(None, "", base64.b64decode(self.__server_public_key_str__))
 
-    async def __send__(self, Data: str) -> None:
+        await self.__set_server_capabilities__()
+    
+    async def __set_server_capabilities__(self) -> None:
+        try:
+            capabilities = json.loads(await self.SendAndReceive("get_capabilities"))
+            self.__server_capabilities__ = capabilities["capabilities"] if ("capabilities" in capabilities) else []
+        except Exception:
+            # Older servers do not know this command
+            self.__server_capabilities__ = []
+    
+    def HasCapability(self, Name: str) -> bool:
+        return Name in self.__server_capabilities__
+    
+    def __prepare_conversation__(self, Conversation: list[dict[str, Any]], Binary: bool) -> list[dict[str, Any]]:
+        # Binary messages send the media as raw bytes; text messages need it as base64
+        conversation = []
+
+        for msg in Conversation:
+            if (isinstance(msg["content"], str)):
+                conversation.append(msg)
+                continue
+
+            if (Binary):
+                content = binary_protocol.MediaToBytes(msg["content"])
+            else:
+                content = [
+                    (cont | {cont["type"]: base64.b64encode(cont[cont["type"]]).decode("utf-8")}) if (cont["type"] in cont and isinstance(cont[cont["type"]], bytes)) else cont
+                    for cont in msg["content"]
+                ]
+            
+            conversation.append(msg | {"content": content})
+        
+        return conversation
+
+    async def __send__(self, Data: str | bytes) -> None:
         if (not self.IsConnected()):
             raise ConnectionError("Socket not connected.")
 
         if (self.__socket_type__ == "websocket"):
             await self.__socket__.send(Data)
     
-    async def __recv__(self) -> str:
+    async def __recv__(self) -> str | bytes:
         if (not self.IsConnected()):
             raise ConnectionError("Socket not connected.")
         
         if (self.__socket_type__ == "websocket"):
-            recv = await self.__socket__.recv(decode = True)
+            # Text frames are returned as strings, binary frames (protocol v3) as bytes
+            recv = await self.__socket__.recv()
         
         return recv
     
-    async def Send(self, Data: str) -> None:
-        chunks = [Data[i:i + TRANSFER_RATE] for i in range(0, len(Data), TRANSFER_RATE)]
+    def __use_frames__(self) -> bool:
+        return self.__socket__ is not None and self.__socket__.subprotocol == FRAMES_SUBPROTOCOL
+
+    async def Send(self, Data: str | bytes) -> None:
+        useFrames = self.__use_frames__()
+
+        if (useFrames):
+            if (isinstance(Data, str)):
+                Data = Data.encode("utf-8")
+                dataType = FRAME_TYPE_TEXT
+            else:
+                dataType = FRAME_TYPE_BINARY
+            
+            await self.__send__(FRAME_HEADER.pack(dataType, len(Data)))
 
-        for chunk in chunks:
-            await self.__send__(chunk)
+        if (isinstance(Data, str)):
+            for i in range(0, len(Data), TRANSFER_RATE):
+                await self.__send__(Data[i:i + TRANSFER_RATE])
+        else:
+            view = memoryview(Data)
+
+            for i in range(0, len(view), BINARY_CHUNK_SIZE):
+                await self.__send__(view[i:i + BINARY_CHUNK_SIZE])
         
-        await self.__send__("--END--")
+        if (not useFrames):
+            await self.__send__("--END--")
     
-    async def Receive(self) -> str:
-        data = ""
+    async def __receive_frames__(self) -> str | bytearray:
+        header = await self.__recv__()
+
+        if (isinstance(header, str) or len(header) != FRAME_HEADER.size):
+            raise ConnectionError("Invalid message header.")
+        
+        dataType, length = FRAME_HEADER.unpack(header)
+        data = bytearray()  # Nothing is allocated from the declared length, the buffer grows with the received data
+        received = 0
+
+        while (received < length):
+            chunk = await self.__recv__()
+
+            if (isinstance(chunk, str) or received + len(chunk) > length):
+                raise ConnectionError("Invalid message data.")
+            
+            data += chunk
+            received += len(chunk)
+        
+        return data.decode("utf-8") if (dataType == FRAME_TYPE_TEXT) else data
+
+    async def Receive(self) -> str | bytes | bytearray:
+        if (self.__use_frames__()):
+            return await self.__receive_frames__()
+
+        chunks = []
 
         while (True):
             chunk = await self.__recv__()
@@ -107,10 +202,15 @@ class ClientSocket():
             if (chunk == "--END--"):
                 break
             
-            chunk = chunk[:TRANSFER_RATE]
-            data += chunk
+            if (len(chunks) > 0 and isinstance(chunks[0], str) != isinstance(chunk, str)):
+                raise ConnectionError("Text and binary frames mixed in the same message.")
+            
+            chunks.append(chunk)
         
-        return data
+        if (len(chunks) == 0):
+            return ""
+        
+        return "".join(chunks) if (isinstance(chunks[0], str)) else b"".join(chunks)
 
     async def SendAndReceive(self, Data: str) -> str:
         await self.Send(Data)
@@ -129,6 +229,8 @@ class ClientSocket():
             await self.__set_server_public_key__()
 
         h = encryption.ParseHash(self.__configuration__.Encryption_Hash)
+        useSession = h is not None and self.__configuration__.Encryption_UseSession and self.HasCapability("session")
+        useBinary = self.__configuration__.Protocol_Binary and self.HasCapability("protocol_v3")
         data = {
             "hash": self.__configuration__.Encryption_Hash,
             "public_key": self.__public_key_str__,
@@ -138,27 +240,82 @@ class ClientSocket():
                 "service": Service,
                 "key": self.__configuration__.Service_DefaultAPIKey if (Key is None) else Key,
                 "prompt": {
-                    "conversation": PromptConversation,
+                    "conversation": self.__prepare_conversation__(PromptConversation, useBinary),
                     "parameters": PromptParameters
                 },
                 "user_parameters": UserParameters
             }
         }
-        data["content"] = encryption.Encrypt(h, self.__server_public_key__, json.dumps(data["content"]), self.__configuration__.Encryption_Threads)
-        await self.Send(json.dumps(data))
+
+        if (useSession):
+            if (self.__session__ is None):
+                # Exchange the session key only once per connection
+                self.__session__, sessionKey = encryption.Session.Generate(encryption.SESSION_DIRECTION_CLIENT)
+                data["session_key"] = encryption.WrapSessionKey(h, self.__server_public_key__, sessionKey)
+            else:
+                data["session"] = True
+        
+        if (useBinary):
+            # Protocol v3, the content is encoded and encrypted without base64
+            content = binary_protocol.Encode(data.pop("content"))
+
+            if (useSession):
+                content = self.__session__.EncryptRaw(content)
+            else:
+                content = encryption.EncryptRaw(h, self.__server_public_key__, content, self.__configuration__.Encryption_Threads)
+            
+            await self.Send(binary_protocol.PackMessage(data, content))
+        else:
+            if (useSession):
+                data["content"] = self.__session__.Encrypt(json.dumps(data["content"]))
+            else:
+                data["content"] = encryption.Encrypt(h, self.__server_public_key__, json.dumps(data["content"]), self.__configuration__.Encryption_Threads)
+            
+            await self.Send(json.dumps(data))
 
         redirectTo = None
 
         while (True):
             recvData = await self.Receive()
-            recvData = json.loads(recvData)
-            recvData = encryption.Decrypt(
-                encryption.ParseHash(recvData["hash"]),
-                self.__private_key__,
-                recvData["data"],
-                self.__configuration__.Encryption_Threads
-            )
-            token = json.loads(recvData)
+            isBinaryFrame = binary_protocol.IsBinaryMessage(recvData)
+
+            if (isBinaryFrame):
+                recvData, recvContent = binary_protocol.UnpackMessage(recvData)
+            else:
+                recvData = json.loads(recvData)
+                recvContent = recvData["data"]
+
+            isSessionFrame = "session" in recvData and recvData["session"]
+
+            if (isSessionFrame):
+                if (self.__session__ is None):
+                    raise ConnectionError("Received a session frame without an established session.")
+                
+                recvContent = self.__session__.DecryptRaw(recvContent) if (isBinaryFrame) else self.__session__.Decrypt(recvContent)
+            elif (isBinaryFrame):
+                recvContent = encryption.DecryptRaw(
+                    encryption.ParseHash(recvData["hash"]),
+                    self.__private_key__,
+                    recvContent,
+                    self.__configuration__.Encryption_Threads
+                )
+            else:
+                recvContent = encryption.Decrypt(
+                    encryption.ParseHash(recvData["hash"]),
+                    self.__private_key__,
+                    recvContent,
+                    self.__configuration__.Encryption_Threads
+                )
+            
+            # Raw media is returned as base64, like in the text protocol
+            token = binary_protocol.Decode(recvContent, True) if (isBinaryFrame) else json.loads(recvContent)
+
+            if (
+                "session_key" in data and not isSessionFrame and
+                "errors" in token and len(token["errors"]) > 0
+            ):
+                # The server could not establish the session, create a new one in the next request
+                self.__session__ = None
 
             if ("redirect_to" in token):
                 redirectTo = token["redirect_to"]
@@ -344,4 +501,93 @@ class ClientSocket():
         if (support is None):
             raise RuntimeError("Could not fetch support data.")
         
-        return support
\ No newline at end of file
+        return support
+    
+    async def GetServerStats(self, **kwargs) -> dict[str, Any]:
+        stats = None
+        gen = self.AdvancedSendAndReceive("", Service = "get_server_stats", **kwargs)
+
+        async for token in gen:
+            if ("stats" in token):
+                stats = token["stats"]
+            
+            if ("errors" in token and len(token["errors"]) > 0):
+                raise RuntimeError(f"Unexpected server error(s): {token['errors']}")
+
+        if (stats is None):
+            raise RuntimeError("Could not fetch server stats.")
+        
+        return stats
+    
+    async def CreateConversation(self, Messages: list[dict[str, str | dict[str, str | bytes]]] = [], **kwargs) -> str:
+        # Use the ID with `UserParameters = {"conversation_id": ID}` to send only the new messages
+        conversationID = None
+        gen = self.AdvancedSendAndReceive("", PromptConversation = Messages, Service = "create_conversation", **kwargs)
+
+        async for token in gen:
+            if ("conversation_id" in token):
+                conversationID = token["conversation_id"]
+            
+            if ("errors" in token and len(token["errors"]) > 0):
+                raise RuntimeError(f"Unexpected server error(s): {token['errors']}")
+
+        if (conversationID is None):
+            raise RuntimeError("Could not create conversation.")
+        
+        return conversationID
+    
+    async def DeleteConversation(self, ID: str, **kwargs) -> None:
+        gen = self.AdvancedSendAndReceive("", PromptParameters = {
+            "conversation_id": ID
+        }, Service = "delete_conversation", **kwargs)
+
+        async for token in gen:
+            if ("errors" in token and len(token["errors"]) > 0):
+                raise RuntimeError(f"Unexpected server error(s): {token['errors']}")
+    
+    async def UploadBlob(self, Data: bytes | str, **kwargs) -> str:
+        # Returns the hash of the blob; use it in the conversation as `{"type": "image", "blob": hash}`
+        dataBytes = base64.b64decode(Data) if (isinstance(Data, str)) else Data
+        blobHash = hashlib.sha256(dataBytes).hexdigest()
+        
+        for sendData in (False, True):
+            # The data is only sent if the server doesn't have the blob
+            if (not sendData):
+                params = {"blob": blobHash}
+            elif (self.__configuration__.Protocol_Binary and self.HasCapability("protocol_v3")):
+                params = {"data": dataBytes}  # Raw bytes with the binary protocol
+            else:
+                params = {"data": Data if (isinstance(Data, str)) else base64.b64encode(Data).decode("utf-8")}
+            
+            uploadedHash = None
+            gen = self.AdvancedSendAndReceive("", PromptParameters = params, Service = "upload_blob", **kwargs)
+
+            async for token in gen:
+                if ("blob" in token):
+                    uploadedHash = token["blob"]
+                
+                if ("errors" in token and len(token["errors"]) > 0):
+                    raise RuntimeError(f"Unexpected server error(s): {token['errors']}")
+            
+            if (uploadedHash is not None):
+                return uploadedHash
+        
+        raise RuntimeError("Could not upload blob.")
+    
+    async def FetchBlob(self, Hash: str, **kwargs) -> bytes:
+        data = None
+        gen = self.AdvancedSendAndReceive("", PromptParameters = {
+            "blob": Hash
+        }, Service = "fetch_blob", **kwargs)
+
+        async for token in gen:
+            if ("data" in token):
+                data = base64.b64decode(token["data"])
+            
+            if ("errors" in token and len(token["errors"]) > 0):
+                raise RuntimeError(f"Unexpected server error(s): {token['errors']}")
+
+        if (data is None):
+            raise RuntimeError("Could not fetch blob.")
+        
+        return data
\ No newline at end of file
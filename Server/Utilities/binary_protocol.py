@@ -0,0 +1,167 @@
+from typing import Any
+import struct
+import base64
+import json
+
+# Protocol v3: binary WebSocket messages.
+# Message: MAGIC + header length (uint32) + JSON header + body (raw ciphertext of the encoded content).
+# The content is encoded with a compact binary codec where media travels as raw bytes instead of base64.
+# The server (Server/Utilities/binary_protocol.py) and the client (Client/Client/I40Client/binary_protocol.py) have identical copies of this file,
+# they are packaged separately; any change must be made in both, new types can be added (older decoders reject them), incompatible changes need a new version in MAGIC.
+MAGIC = b"I4\x03"
+MEDIA_TYPES = ("image", "audio", "video")
+
+TYPE_NONE = 0x00
+TYPE_FALSE = 0x01
+TYPE_TRUE = 0x02
+TYPE_INT = 0x03
+TYPE_FLOAT = 0x04
+TYPE_STR = 0x05
+TYPE_BYTES = 0x06
+TYPE_LIST = 0x07
+TYPE_DICT = 0x08
+TYPE_BIGINT = 0x09  # Integers outside of int64, as signed big-endian bytes (JSON keeps them exact too)
+
+__length__ = struct.Struct(">I")
+__int__ = struct.Struct(">q")
+__float__ = struct.Struct(">d")
+
+def IsBinaryMessage(Data: str | bytes | bytearray) -> bool:
+    return not isinstance(Data, str) and Data[:len(MAGIC)] == MAGIC
+
+def PackMessage(Header: dict[str, Any], Body: bytes) -> bytes:
+    header = json.dumps(Header).encode("utf-8")
+    return b"".join([MAGIC, __length__.pack(len(header)), header, Body])
+
+def UnpackMessage(Data: bytes | bytearray) -> tuple[dict[str, Any], memoryview]:
+    if (not IsBinaryMessage(Data)):
+        raise ValueError("Invalid binary message.")
+
+    data = memoryview(Data)
+    headerStart = len(MAGIC) + __length__.size
+    headerEnd = headerStart + __length__.unpack_from(data, len(MAGIC))[0]
+
+    if (headerEnd > len(data)):
+        raise ValueError("Invalid binary message header.")
+
+    return (json.loads(bytes(data[headerStart:headerEnd])), data[headerEnd:])
+
+def __encode__(Value: Any, Parts: list[bytes]) -> None:
+    if (Value is None):
+        Parts.append(bytes((TYPE_NONE,)))
+    elif (Value is True):
+        Parts.append(bytes((TYPE_TRUE,)))
+    elif (Value is False):
+        Parts.append(bytes((TYPE_FALSE,)))
+    elif (isinstance(Value, int) and -2 ** 63 <= Value < 2 ** 63):
+        Parts.append(bytes((TYPE_INT,)) + __int__.pack(Value))
+    elif (isinstance(Value, int)):
+        data = Value.to_bytes((Value.bit_length() + 8) // 8, "big", signed = True)
+        Parts.append(bytes((TYPE_BIGINT,)) + __length__.pack(len(data)))
+        Parts.append(data)
+    elif (isinstance(Value, float)):
+        Parts.append(bytes((TYPE_FLOAT,)) + __float__.pack(Value))
+    elif (isinstance(Value, str)):
+        data = Value.encode("utf-8")
+        Parts.append(bytes((TYPE_STR,)) + __length__.pack(len(data)))
+        Parts.append(data)
+    elif (isinstance(Value, (bytes, bytearray, memoryview))):
+        # Raw data is not copied until the parts are joined
+        Parts.append(bytes((TYPE_BYTES,)) + __length__.pack(len(Value)))
+        Parts.append(Value)
+    elif (isinstance(Value, (list, tuple))):
+        Parts.append(bytes((TYPE_LIST,)) + __length__.pack(len(Value)))
+
+        for item in Value:
+            __encode__(item, Parts)
+    elif (isinstance(Value, dict)):
+        Parts.append(bytes((TYPE_DICT,)) + __length__.pack(len(Value)))
+
+        for key, item in Value.items():
+            key = str(key).encode("utf-8")
+            Parts.append(__length__.pack(len(key)))
+            Parts.append(key)
+            __encode__(item, Parts)
+    else:
+        raise TypeError(f"Type `{type(Value).__name__}` can't be encoded.")
+
+def Encode(Value: Any) -> bytes:
+    parts = []
+    __encode__(Value, parts)
+
+    return b"".join(parts)
+
+def __decode__(Data: memoryview, Offset: int, BytesAsBase64: bool) -> tuple[Any, int]:
+    valueType = Data[Offset]
+    Offset += 1
+
+    if (valueType == TYPE_NONE):
+        return (None, Offset)
+    elif (valueType == TYPE_FALSE):
+        return (False, Offset)
+    elif (valueType == TYPE_TRUE):
+        return (True, Offset)
+    elif (valueType == TYPE_INT):
+        return (__int__.unpack_from(Data, Offset)[0], Offset + __int__.size)
+    elif (valueType == TYPE_FLOAT):
+        return (__float__.unpack_from(Data, Offset)[0], Offset + __float__.size)
+
+    length = __length__.unpack_from(Data, Offset)[0]
+    Offset += __length__.size
+
+    if (valueType == TYPE_STR or valueType == TYPE_BYTES or valueType == TYPE_BIGINT):
+        if (Offset + length > len(Data)):
+            raise ValueError("Truncated binary data.")
+
+        if (valueType == TYPE_BIGINT):
+            return (int.from_bytes(Data[Offset:Offset + length], "big", signed = True), Offset + length)
+
+        if (valueType == TYPE_STR):
+            return (str(Data[Offset:Offset + length], "utf-8"), Offset + length)
+
+        if (BytesAsBase64):
+            return (base64.b64encode(Data[Offset:Offset + length]).decode("utf-8"), Offset + length)
+
+        return (bytes(Data[Offset:Offset + length]), Offset + length)
+    elif (valueType == TYPE_LIST):
+        value = []
+
+        for _ in range(length):
+            item, Offset = __decode__(Data, Offset, BytesAsBase64)
+            value.append(item)
+
+        return (value, Offset)
+    elif (valueType == TYPE_DICT):
+        value = {}
+
+        for _ in range(length):
+            keyLength = __length__.unpack_from(Data, Offset)[0]
+            Offset += __length__.size
+
+            key = str(Data[Offset:Offset + keyLength], "utf-8")
+            value[key], Offset = __decode__(Data, Offset + keyLength, BytesAsBase64)
+
+        return (value, Offset)
+
+    raise ValueError(f"Invalid binary type `{valueType}`.")
+
+def Decode(Data: bytes | bytearray | memoryview, BytesAsBase64: bool = False) -> Any:
+    # With *BytesAsBase64*, raw data is returned as base64 strings (the format used everywhere else)
+    value, offset = __decode__(memoryview(Data), 0, BytesAsBase64)
+
+    if (offset != len(Data)):
+        raise ValueError("Unexpected data after the binary value.")
+
+    return value
+
+def MediaToBytes(Contents: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # Media contents (base64 strings) are sent as raw bytes
+    result = []
+
+    for content in Contents:
+        if (content["type"] in MEDIA_TYPES and content["type"] in content and isinstance(content[content["type"]], str)):
+            content = content | {content["type"]: base64.b64decode(content[content["type"]])}
+
+        result.append(content)
+
+    return result
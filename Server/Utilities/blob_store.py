@@ -0,0 +1,336 @@
+import logging
+from typing import Any
+from collections import OrderedDict
+import os
+import re
+import mmap
+import json
+import base64
+import hashlib
+import itertools
+import threading
+import exceptions
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class BlobStore():
+    # Content-addressed files, indexed by the SHA-256 of their data, so the same media is only saved once.
+    # Blobs referenced by running requests or pinned (by stored conversations) are never evicted; the rest are evicted (least recently used first) when the store exceeds its size.
+    # Only the owners of a blob (the API keys that uploaded or generated its data) can use it.
+    def __init__(self, Directory: str, MaxBytes: int | None = None, MaxBlobBytes: int | None = None) -> None:
+        self.DIRECTORY = Directory
+        self.MAX_BYTES = MaxBytes
+        self.MAX_BLOB_BYTES = MaxBlobBytes
+        self.__blobs__: OrderedDict[str, int] = OrderedDict()  # {"hash": size}
+        self.__references__: dict[str, int] = {}
+        self.__owners__: dict[str, set[str]] = {}  # {"hash": {"key hash", ...}}
+        self.__pins__: dict[str, set[str]] = {}  # {"hash": {"holder", ...}}
+        self.__pinned_by__: dict[str, set[str]] = {}  # {"holder": {"hash", ...}}
+        self.__metadata_lock__ = threading.Lock()
+        self.__bytes__ = 0
+        self.__lock__ = threading.Lock()
+        self.__tombstones__ = itertools.count()
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+
+        os.makedirs(Directory, exist_ok = True)
+        self.__load_index__()
+
+    @staticmethod
+    def IsValidHash(Hash: Any) -> bool:
+        return isinstance(Hash, str) and HASH_PATTERN.match(Hash) is not None
+
+    def __get_file_path__(self, Hash: str) -> str:
+        return os.path.join(self.DIRECTORY, f"{Hash}.bin")
+
+    def __get_metadata_path__(self, Hash: str) -> str:
+        return os.path.join(self.DIRECTORY, f"{Hash}.json")
+
+    @staticmethod
+    def __hash_owner__(Owner: str) -> str:
+        # API keys are never saved in the disk
+        return hashlib.sha256(Owner.encode("utf-8")).hexdigest()[:32]
+
+    def __tombstone__(self, Hash: str) -> list[str]:
+        # Must be called with the lock acquired; the files of an evicted blob are renamed, so deleting them later never removes a new blob with the same hash
+        tombstones = []
+
+        for filePath in (self.__get_file_path__(Hash), self.__get_metadata_path__(Hash)):
+            tombstonePath = f"{filePath}.{next(self.__tombstones__)}.evicted"
+
+            try:
+                os.replace(filePath, tombstonePath)
+            except FileNotFoundError:
+                continue
+
+            tombstones.append(tombstonePath)
+
+        return tombstones
+
+    @staticmethod
+    def __delete_files__(Paths: list[str]) -> None:
+        for filePath in Paths:
+            try:
+                os.remove(filePath)
+            except FileNotFoundError:
+                pass
+
+    def __save_metadata__(self, Hash: str) -> None:
+        # Owners and pins are kept next to the data, so they survive restarts
+        with self.__metadata_lock__:
+            with self.__lock__:
+                if (Hash not in self.__blobs__):
+                    return
+
+                metadata = {
+                    "owners": sorted(self.__owners__.get(Hash, set())),
+                    "pins": sorted(self.__pins__.get(Hash, set()))
+                }
+
+            filePath = self.__get_metadata_path__(Hash)
+
+            with open(filePath + ".tmp", "w") as f:
+                f.write(json.dumps(metadata))
+
+            with self.__lock__:
+                if (Hash not in self.__blobs__):
+                    # Evicted while writing
+                    os.remove(filePath + ".tmp")
+                    return
+
+                os.replace(filePath + ".tmp", filePath)
+
+    def __load_metadata__(self, Hash: str) -> None:
+        try:
+            with open(self.__get_metadata_path__(Hash), "r") as f:
+                metadata = json.loads(f.read())
+        except FileNotFoundError:
+            return
+        except Exception as ex:
+            logging.warning(f"[blob_store] Could not read the metadata of the blob `{Hash}`. Details: {ex}")
+            return
+
+        if (len(metadata["owners"]) > 0):
+            self.__owners__[Hash] = set(metadata["owners"])
+
+        for holder in metadata["pins"]:
+            self.__pins__.setdefault(Hash, set()).add(holder)
+            self.__pinned_by__.setdefault(holder, set()).add(Hash)
+
+    def __load_index__(self) -> None:
+        files = []
+
+        for fileName in os.listdir(self.DIRECTORY):
+            if (fileName.endswith(".evicted") or fileName.endswith(".tmp")):
+                # Left by a previous run
+                self.__delete_files__([os.path.join(self.DIRECTORY, fileName)])
+                continue
+
+            if (not fileName.endswith(".bin") or not self.IsValidHash(fileName[:-4])):
+                continue
+
+            stat = os.stat(os.path.join(self.DIRECTORY, fileName))
+            files.append((stat.st_mtime, fileName[:-4], stat.st_size))
+
+        for _, blobHash, size in sorted(files):
+            self.__blobs__[blobHash] = size
+            self.__bytes__ += size
+            self.__load_metadata__(blobHash)
+
+        with self.__lock__:
+            evicted = self.__evict__()
+
+        self.__delete_files__(evicted)
+
+    def __evict__(self, Keep: str | None = None) -> list[str]:
+        # Must be called with the lock acquired; returns the files to delete (after releasing the lock)
+        evicted = []
+
+        if (self.MAX_BYTES is None):
+            return evicted
+
+        for blobHash in list(self.__blobs__.keys()):
+            if (self.__bytes__ <= self.MAX_BYTES):
+                break
+
+            if (blobHash == Keep or blobHash in self.__references__ or blobHash in self.__pins__):
+                continue
+
+            self.__bytes__ -= self.__blobs__.pop(blobHash)
+            self.__owners__.pop(blobHash, None)
+            self.Evictions += 1
+            evicted += self.__tombstone__(blobHash)
+
+        return evicted
+
+    def __check_hash__(self, Hash: str) -> None:
+        if (not self.IsValidHash(Hash)):
+            raise ValueError("Invalid blob hash.")
+
+    def Put(self, Data: bytes | bytearray | memoryview, Owner: str | None = None) -> str:
+        if (len(Data) == 0):
+            raise ValueError("Empty blob.")
+
+        if (self.MAX_BLOB_BYTES is not None and len(Data) > self.MAX_BLOB_BYTES):
+            raise exceptions.MediaTooLargeException(self.MAX_BLOB_BYTES)
+
+        blobHash = hashlib.sha256(Data).hexdigest()
+        ownerHash = self.__hash_owner__(Owner) if (Owner is not None) else None
+
+        with self.__lock__:
+            exists = blobHash in self.__blobs__
+
+            if (exists):
+                self.__blobs__.move_to_end(blobHash)
+                newOwner = self.__add_owner__(blobHash, ownerHash)
+
+        if (exists):
+            if (newOwner):
+                self.__save_metadata__(blobHash)
+
+            return blobHash
+
+        filePath = self.__get_file_path__(blobHash)
+        tempFilePath = f"{filePath}.{threading.get_ident()}.tmp"
+
+        with open(tempFilePath, "wb") as f:
+            f.write(Data)
+
+        with self.__lock__:
+            # Moved with the lock acquired, so an eviction of the same hash can't remove it
+            os.replace(tempFilePath, filePath)
+
+            if (blobHash not in self.__blobs__):
+                self.__blobs__[blobHash] = len(Data)
+                self.__bytes__ += len(Data)
+
+            newOwner = self.__add_owner__(blobHash, ownerHash)
+            evicted = self.__evict__(blobHash)
+
+        self.__delete_files__(evicted)
+
+        if (newOwner):
+            self.__save_metadata__(blobHash)
+
+        return blobHash
+
+    def PutBase64(self, Data: str, Owner: str | None = None) -> str:
+        return self.Put(base64.b64decode(Data), Owner)
+
+    def __add_owner__(self, Hash: str, OwnerHash: str | None) -> bool:
+        # Must be called with the lock acquired; returns True if the owner is new
+        if (OwnerHash is None or OwnerHash in self.__owners__.get(Hash, set())):
+            return False
+
+        self.__owners__.setdefault(Hash, set()).add(OwnerHash)
+        return True
+
+    def IsOwner(self, Hash: str, Owner: str) -> bool:
+        # Blobs of other owners are treated as if they don't exist
+        with self.__lock__:
+            return Hash in self.__blobs__ and self.__hash_owner__(Owner) in self.__owners__.get(Hash, set())
+
+    def Has(self, Hash: str) -> bool:
+        with self.__lock__:
+            return Hash in self.__blobs__
+
+    def GetSize(self, Hash: str) -> int:
+        with self.__lock__:
+            if (Hash not in self.__blobs__):
+                raise FileNotFoundError(f"Blob `{Hash}` not found.")
+
+            return self.__blobs__[Hash]
+
+    def Open(self, Hash: str) -> mmap.mmap:
+        # Read-only memory map of the blob; the caller must close it
+        self.__check_hash__(Hash)
+
+        with self.__lock__:
+            if (Hash not in self.__blobs__):
+                self.Misses += 1
+                raise FileNotFoundError(f"Blob `{Hash}` not found.")
+
+            self.__blobs__.move_to_end(Hash)
+            self.Hits += 1
+
+            # Opened with the lock acquired, so the file can't be evicted before (the map stays valid after)
+            with open(self.__get_file_path__(Hash), "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def Read(self, Hash: str) -> bytes:
+        with self.Open(Hash) as data:
+            return data[:]
+
+    def ReadBase64(self, Hash: str) -> str:
+        with self.Open(Hash) as data:
+            return base64.b64encode(data).decode("utf-8")
+
+    def AddReference(self, Hash: str) -> None:
+        # Referenced blobs can't be evicted
+        self.__check_hash__(Hash)
+
+        with self.__lock__:
+            if (Hash not in self.__blobs__):
+                raise FileNotFoundError(f"Blob `{Hash}` not found.")
+
+            self.__references__[Hash] = self.__references__.get(Hash, 0) + 1
+
+    def RemoveReference(self, Hash: str) -> None:
+        with self.__lock__:
+            if (Hash not in self.__references__):
+                logging.warning(f"[blob_store] Removing a reference of the unreferenced blob `{Hash}`.")
+                return
+
+            self.__references__[Hash] -= 1
+
+            if (self.__references__[Hash] <= 0):
+                del self.__references__[Hash]
+
+            evicted = self.__evict__()
+
+        self.__delete_files__(evicted)
+
+    def SetPins(self, Holder: str, Hashes: set[str]) -> None:
+        # Pinned blobs can't be evicted; replaces the blobs pinned by *Holder* (missing blobs are ignored)
+        with self.__lock__:
+            oldHashes = self.__pinned_by__.pop(Holder, set())
+            newHashes = {blobHash for blobHash in Hashes if (blobHash in self.__blobs__)}
+
+            for blobHash in oldHashes - newHashes:
+                self.__pins__[blobHash].discard(Holder)
+
+                if (len(self.__pins__[blobHash]) == 0):
+                    del self.__pins__[blobHash]
+
+            for blobHash in newHashes - oldHashes:
+                self.__pins__.setdefault(blobHash, set()).add(Holder)
+
+            if (len(newHashes) > 0):
+                self.__pinned_by__[Holder] = newHashes
+
+            evicted = self.__evict__()
+
+        for blobHash in oldHashes ^ newHashes:
+            self.__save_metadata__(blobHash)  # Evicted blobs are skipped
+
+        self.__delete_files__(evicted)
+
+    def GetPinHolders(self) -> set[str]:
+        with self.__lock__:
+            return set(self.__pinned_by__.keys())
+
+    def GetStats(self) -> dict[str, Any]:
+        with self.__lock__:
+            requests = self.Hits + self.Misses
+
+            return {
+                "items": len(self.__blobs__),
+                "bytes": self.__bytes__,
+                "referenced": len(self.__references__),
+                "pinned": len(self.__pins__),
+                "hits": self.Hits,
+                "misses": self.Misses,
+                "evictions": self.Evictions,
+                "hit_rate": round(self.Hits / requests, 4) if (requests > 0) else None
+            }
@@ -0,0 +1,88 @@
+from typing import Any
+import math
+import threading
+import time
+
+class Histogram():
+    # Rolling window histogram with fixed, logarithmic buckets (HDR style).
+    # The window is split in slots; old slots are cleared when reused, so memory never grows.
+    def __init__(
+        self,
+        MinValue: float = 0.001,
+        MaxValue: float = 3600,
+        Precision: float = 0.05,
+        WindowSeconds: float = 300,
+        Slots: int = 10
+    ) -> None:
+        self.MIN_VALUE = MinValue
+        self.MAX_VALUE = MaxValue
+        self.SLOTS = max(Slots, 1)
+        self.SLOT_SECONDS = max(WindowSeconds, 1) / self.SLOTS
+        self.__log_base__ = math.log(1 + Precision)
+        self.__buckets_count__ = self.__bucket_index__(MaxValue) + 1
+        self.__counts__ = [[0] * self.__buckets_count__ for _ in range(self.SLOTS)]
+        self.__epochs__ = [-1] * self.SLOTS
+        self.__lock__ = threading.Lock()
+
+    def __bucket_index__(self, Value: float) -> int:
+        if (Value <= self.MIN_VALUE):
+            return 0
+
+        return int(math.log(Value / self.MIN_VALUE) / self.__log_base__) + 1
+
+    def __bucket_value__(self, Index: int) -> float:
+        if (Index == 0):
+            return self.MIN_VALUE
+
+        return self.MIN_VALUE * math.exp(Index * self.__log_base__)
+
+    def __current_slot__(self) -> int:
+        # Must be called with the lock acquired
+        epoch = int(time.monotonic() / self.SLOT_SECONDS)
+        slot = epoch % self.SLOTS
+
+        if (self.__epochs__[slot] != epoch):
+            self.__epochs__[slot] = epoch
+            self.__counts__[slot] = [0] * self.__buckets_count__
+
+        return slot
+
+    def Record(self, Value: float) -> None:
+        index = min(self.__bucket_index__(max(Value, 0)), self.__buckets_count__ - 1)
+
+        with self.__lock__:
+            self.__counts__[self.__current_slot__()][index] += 1
+
+    def __merged_counts__(self) -> list[int]:
+        with self.__lock__:
+            minEpoch = int(time.monotonic() / self.SLOT_SECONDS) - self.SLOTS + 1
+            slots = [self.__counts__[slot] for slot in range(self.SLOTS) if (self.__epochs__[slot] >= minEpoch)]
+
+        return [sum(counts) for counts in zip(*slots)] if (len(slots) > 0) else []
+
+    def GetPercentiles(self, Percentiles: list[float] = [50, 95, 99]) -> dict[str, Any]:
+        counts = self.__merged_counts__()
+        total = sum(counts)
+        result = {"count": total}
+
+        for percentile in Percentiles:
+            result[f"p{percentile}"] = None
+
+        if (total == 0):
+            return result
+
+        for percentile in Percentiles:
+            target = math.ceil(total * percentile / 100)
+            cumulative = 0
+
+            for idx, count in enumerate(counts):
+                cumulative += count
+
+                if (cumulative >= target):
+                    result[f"p{percentile}"] = round(self.__bucket_value__(idx), 4)
+                    break
+
+        return result
+
+    def GetPercentile(self, Percentile: float) -> float | None:
+        return self.GetPercentiles([Percentile])[f"p{Percentile}"]
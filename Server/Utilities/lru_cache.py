@@ -0,0 +1,109 @@
+from typing import Any
+from collections.abc import Callable
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache():
+    # Thread-safe least recently used cache.
+    # Memory is bounded by the number of items and, optionally, by the total size given when setting each item.
+    def __init__(
+        self,
+        MaxItems: int,
+        MaxBytes: int | None = None,
+        TTL: float | None = None,
+        OnEvict: Callable[[Any, Any], None] | None = None
+    ) -> None:
+        self.MAX_ITEMS = max(MaxItems, 1)
+        self.MAX_BYTES = MaxBytes
+        self.TTL = TTL if (TTL is not None and TTL > 0) else None
+        self.OnEvict = OnEvict  # Called (without the lock) when an item is removed because of the limits or the TTL
+        self.__items__: OrderedDict[Any, tuple[Any, int, float]] = OrderedDict()
+        self.__bytes__ = 0
+        self.__lock__ = threading.Lock()
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+
+    def __remove__(self, Key: Any) -> Any:
+        # Must be called with the lock acquired
+        value, size, _ = self.__items__.pop(Key)
+        self.__bytes__ -= size
+
+        return value
+
+    def __evicted__(self, Items: list[tuple[Any, Any]]) -> None:
+        if (self.OnEvict is None):
+            return
+        
+        for key, value in Items:
+            self.OnEvict(key, value)
+
+    def Get(self, Key: Any, Default: Any = None) -> Any:
+        evicted = []
+
+        with self.__lock__:
+            item = self.__items__.get(Key)
+
+            if (item is not None and self.TTL is not None and time.monotonic() - item[2] > self.TTL):
+                evicted.append((Key, self.__remove__(Key)))
+                item = None
+
+            if (item is None):
+                self.Misses += 1
+            else:
+                self.__items__.move_to_end(Key)
+                self.Hits += 1
+        
+        self.__evicted__(evicted)
+        return item[0] if (item is not None) else Default
+
+    def Peek(self, Key: Any, Default: Any = None) -> Any:
+        # Same as Get, but without changing the order, the stats or removing expired items
+        with self.__lock__:
+            item = self.__items__.get(Key)
+        
+        return item[0] if (item is not None) else Default
+
+    def Set(self, Key: Any, Value: Any, Size: int = 0) -> None:
+        if (self.MAX_BYTES is not None and Size > self.MAX_BYTES):
+            return
+
+        evicted = []
+
+        with self.__lock__:
+            if (Key in self.__items__):
+                self.__remove__(Key)
+
+            self.__items__[Key] = (Value, Size, time.monotonic())
+            self.__bytes__ += Size
+
+            while (len(self.__items__) > self.MAX_ITEMS or (self.MAX_BYTES is not None and self.__bytes__ > self.MAX_BYTES)):
+                oldestKey = next(iter(self.__items__))
+                evicted.append((oldestKey, self.__remove__(oldestKey)))
+                self.Evictions += 1
+        
+        self.__evicted__(evicted)
+
+    def Delete(self, Key: Any) -> None:
+        with self.__lock__:
+            if (Key in self.__items__):
+                self.__remove__(Key)
+
+    def Clear(self) -> None:
+        with self.__lock__:
+            self.__items__.clear()
+            self.__bytes__ = 0
+
+    def GetStats(self) -> dict[str, Any]:
+        with self.__lock__:
+            requests = self.Hits + self.Misses
+
+            return {
+                "items": len(self.__items__),
+                "bytes": self.__bytes__,
+                "hits": self.Hits,
+                "misses": self.Misses,
+                "evictions": self.Evictions,
+                "hit_rate": round(self.Hits / requests, 4) if (requests > 0) else None
+            }
@@ -0,0 +1,238 @@
+from collections.abc import Callable
+from pydub import AudioSegment
+from PIL import Image as PILImage
+import io
+import mmap
+import base64
+import contextlib
+import av
+import exceptions
+
+READ_BUFFER_SIZE = 65536
+MediaData = str | mmap.mmap  # Base64 string or memory-mapped file (blobs)
+
+class Base64Reader(io.RawIOBase):
+    # Seekable file-like object over a base64 string.
+    # Only the requested ranges are decoded, so reading the headers of a file never decodes the whole payload.
+    def __init__(self, Data: str, MaxReadBytes: int | None = None) -> None:
+        super().__init__()
+        padding = 2 if (Data.endswith("==")) else (1 if (Data.endswith("=")) else 0)
+
+        self.MAX_READ_BYTES = MaxReadBytes
+        self.__data__ = Data
+        self.__size__ = len(Data) // 4 * 3 - padding
+        self.__position__ = 0
+        self.__read_bytes__ = 0
+
+    @staticmethod
+    def IsSupported(Data: str) -> bool:
+        # Random access requires a contiguous base64 string (no line breaks or spaces)
+        return len(Data) % 4 == 0 and "\n" not in Data and "\r" not in Data and " " not in Data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position__
+
+    def seek(self, Offset: int, Whence: int = io.SEEK_SET) -> int:
+        if (Whence == io.SEEK_SET):
+            position = Offset
+        elif (Whence == io.SEEK_CUR):
+            position = self.__position__ + Offset
+        elif (Whence == io.SEEK_END):
+            position = self.__size__ + Offset
+        else:
+            raise ValueError("Invalid whence.")
+
+        if (position < 0):
+            raise ValueError("Negative seek position.")
+
+        self.__position__ = position
+        return position
+
+    def readinto(self, Buffer: bytearray | memoryview) -> int:
+        start = self.__position__
+        end = min(start + len(Buffer), self.__size__)
+
+        if (start >= end):
+            return 0
+
+        if (self.MAX_READ_BYTES is not None and self.__read_bytes__ + end - start > self.MAX_READ_BYTES):
+            raise exceptions.MediaTooLargeException(self.MAX_READ_BYTES)
+
+        # Every 4 base64 characters are 3 bytes
+        chunk = base64.b64decode(self.__data__[start // 3 * 4:-(-end // 3) * 4])
+        data = chunk[start % 3:start % 3 + end - start]
+
+        Buffer[:len(data)] = data
+        self.__position__ = end
+        self.__read_bytes__ += len(data)
+
+        return len(data)
+
+def GetDecodedSize(Data: str) -> int:
+    return len(Data) * 3 // 4
+
+def __probe__(
+    Data: MediaData,
+    Probe: Callable[[io.BufferedIOBase], tuple],
+    MaxProbeBytes: int | None,
+    MaxDecodedBytes: int | None,
+    Fallback: Callable[[io.BufferedIOBase], tuple] | None = None
+) -> tuple:
+    if (isinstance(Data, mmap.mmap)):
+        # Already random access, nothing to decode
+        try:
+            Data.seek(0)
+            return Probe(Data)
+        except Exception:
+            if (Fallback is None):
+                raise
+
+            Data.seek(0)
+            return Fallback(Data)
+
+    if (Base64Reader.IsSupported(Data)):
+        try:
+            with io.BufferedReader(Base64Reader(Data, MaxProbeBytes), READ_BUFFER_SIZE) as reader:
+                return Probe(reader)
+        except Exception:
+            # Some files keep their metadata far away from the start or in a format that can't be probed; decode them fully
+            pass
+
+    if (MaxDecodedBytes is not None and GetDecodedSize(Data) > MaxDecodedBytes):
+        raise exceptions.MediaTooLargeException(MaxDecodedBytes)
+
+    with io.BytesIO(base64.b64decode(Data)) as buffer:
+        try:
+            return Probe(buffer)
+        except Exception:
+            if (Fallback is None):
+                raise
+
+            buffer.seek(0)
+            return Fallback(buffer)
+
+def __probe_image__(Buffer: io.BufferedIOBase) -> tuple[int, int]:
+    # PIL only reads the headers when opening; pixels are decoded on demand
+    with PILImage.open(Buffer) as img:
+        return img.size
+
+def __probe_audio__(Buffer: io.BufferedIOBase) -> tuple[float]:
+    with av.open(Buffer) as reader:
+        if (reader.duration):
+            return (float(reader.duration / av.time_base),)
+
+        stream = next(s for s in reader.streams if (s.type == "audio"))
+
+        if (stream.duration is None):
+            raise ValueError("Unknown audio duration.")
+
+        return (float(stream.duration * stream.time_base),)
+
+def __decode_audio__(Buffer: io.BufferedIOBase) -> tuple[float]:
+    return (len(AudioSegment.from_file(Buffer)) / 1000,)
+
+def __probe_video__(Buffer: io.BufferedIOBase) -> tuple[float, int, int]:
+    with av.open(Buffer) as reader:
+        stream = next(s for s in reader.streams if (s.type == "video"))
+
+        fps = float(stream.average_rate) if (stream.average_rate) else 0
+        numberOfFrames = stream.frames
+        durationInSeconds = float(reader.duration / av.time_base) if (reader.duration) else (numberOfFrames / fps if (fps) else 0)
+
+        return (durationInSeconds, stream.width, stream.height)
+
+def __open_media__(Data: MediaData, MaxReadBytes: int | None) -> contextlib.AbstractContextManager:
+    if (isinstance(Data, mmap.mmap)):
+        # Owned by the caller, not closed here
+        Data.seek(0)
+        return contextlib.nullcontext(Data)
+
+    if (Base64Reader.IsSupported(Data)):
+        return io.BufferedReader(Base64Reader(Data, MaxReadBytes), READ_BUFFER_SIZE)
+    
+    if (MaxReadBytes is not None and GetDecodedSize(Data) > MaxReadBytes):
+        raise exceptions.MediaTooLargeException(MaxReadBytes)
+    
+    return io.BytesIO(base64.b64decode(Data))
+
+def __encode_frame__(Frame: av.VideoFrame, MaxSize: int) -> str:
+    scale = min(MaxSize / max(Frame.width, Frame.height), 1)
+    img = Frame.to_image(width = max(int(Frame.width * scale), 1), height = max(int(Frame.height * scale), 1))
+
+    with io.BytesIO() as buffer:
+        img.convert("RGB").save(buffer, format = "JPEG", quality = 90)
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+def ExtractVideoFrames(
+    Data: MediaData,
+    Count: int,
+    KeyframesOnly: bool = True,
+    MaxSize: int = 224,
+    MaxReadBytes: int | None = None
+) -> list[str]:
+    # Returns up to *Count* evenly spaced frames of the video as base64 JPEG images, downscaled to *MaxSize* pixels.
+    # Seeks to each position instead of decoding the whole video; with *KeyframesOnly* only keyframes are decoded.
+    frames = []
+
+    with __open_media__(Data, MaxReadBytes) as buffer:
+        with av.open(buffer) as reader:
+            stream = next(s for s in reader.streams if (s.type == "video"))
+            stream.thread_type = "AUTO"
+
+            if (KeyframesOnly):
+                stream.codec_context.skip_frame = "NONKEY"
+
+            if (reader.duration):
+                durationInSeconds = float(reader.duration / av.time_base)
+            elif (stream.duration is not None):
+                durationInSeconds = float(stream.duration * stream.time_base)
+            else:
+                durationInSeconds = 0
+            
+            if (durationInSeconds > 0 and stream.time_base is not None):
+                startTime = float(stream.start_time * stream.time_base) if (stream.start_time is not None) else 0
+
+                for idx in range(Count):
+                    targetTime = startTime + durationInSeconds * (idx + 0.5) / Count
+                    reader.seek(int(targetTime / stream.time_base), stream = stream, backward = True, any_frame = False)
+
+                    for frame in reader.decode(stream):
+                        if (not KeyframesOnly and frame.time is not None and frame.time < targetTime):
+                            continue
+
+                        encodedFrame = __encode_frame__(frame, MaxSize)
+
+                        if (len(frames) == 0 or frames[-1] != encodedFrame):
+                            # Close positions may seek to the same keyframe
+                            frames.append(encodedFrame)
+                        
+                        break
+            else:
+                # Unknown duration, can't seek; use the first frames
+                for frame in reader.decode(stream):
+                    frames.append(__encode_frame__(frame, MaxSize))
+
+                    if (len(frames) >= Count):
+                        break
+    
+    return frames
+
+def ProbeImage(Data: MediaData, MaxProbeBytes: int | None = None, MaxDecodedBytes: int | None = None, MaxPixels: int | None = None) -> tuple[int, int]:
+    width, height = __probe__(Data, __probe_image__, MaxProbeBytes, MaxDecodedBytes)
+
+    if (MaxPixels is not None and width * height > MaxPixels):
+        raise exceptions.MediaTooLargeException(MaxPixels, "pixels")
+
+    return (width, height)
+
+def ProbeAudioDuration(Data: MediaData, MaxProbeBytes: int | None = None, MaxDecodedBytes: int | None = None) -> float:
+    return __probe__(Data, __probe_audio__, MaxProbeBytes, MaxDecodedBytes, __decode_audio__)[0]
+
+def ProbeVideo(Data: MediaData, MaxProbeBytes: int | None = None, MaxDecodedBytes: int | None = None) -> tuple[float, int, int]:
+    return __probe__(Data, __probe_video__, MaxProbeBytes, MaxDecodedBytes)
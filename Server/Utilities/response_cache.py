@@ -0,0 +1,96 @@
+import logging
+from typing import Any
+import os
+import json
+import time
+import Utilities.lru_cache as lru_cache
+
+class ResponseCache():
+    # Complete responses of the models (the tokens yielded by the service), indexed by a hash of the request.
+    # Memory is the first tier; optionally, responses are also saved in a directory and read from there after being evicted from memory.
+    def __init__(
+        self,
+        MaxItems: int,
+        MaxBytes: int | None = None,
+        TTL: float | None = None,
+        Directory: str | None = None,
+        MaxDiskBytes: int | None = None
+    ) -> None:
+        self.DIRECTORY = Directory
+        self.__memory__ = lru_cache.LRUCache(MaxItems, MaxBytes, TTL)
+        self.__disk__ = None
+
+        if (Directory is not None):
+            os.makedirs(Directory, exist_ok = True)
+            self.__disk__ = lru_cache.LRUCache(2 ** 31, MaxDiskBytes, TTL, lambda Key, _: self.__delete_file__(Key))
+            self.__load_disk_index__(TTL)
+
+    def __get_file_path__(self, Key: str) -> str:
+        return os.path.join(self.DIRECTORY, f"{Key}.json")
+
+    def __delete_file__(self, Key: str) -> None:
+        try:
+            os.remove(self.__get_file_path__(Key))
+        except FileNotFoundError:
+            pass
+
+    def __load_disk_index__(self, TTL: float | None) -> None:
+        files = []
+
+        for fileName in os.listdir(self.DIRECTORY):
+            if (not fileName.endswith(".json")):
+                continue
+
+            stat = os.stat(os.path.join(self.DIRECTORY, fileName))
+            files.append((stat.st_mtime, fileName[:-5], stat.st_size))
+
+        for mtime, key, size in sorted(files):
+            if (TTL is not None and TTL > 0 and time.time() - mtime > TTL):
+                self.__delete_file__(key)
+                continue
+
+            self.__disk__.Set(key, True, size)
+
+    def Get(self, Key: str) -> list[dict[str, Any]] | None:
+        tokens = self.__memory__.Get(Key)
+
+        if (tokens is not None or self.__disk__ is None or self.__disk__.Get(Key) is None):
+            return tokens
+
+        try:
+            with open(self.__get_file_path__(Key), "r") as f:
+                data = f.read()
+
+            tokens = json.loads(data)
+        except Exception as ex:
+            logging.warning(f"[response_cache] Could not read cached response `{Key}`. Details: {ex}")
+            self.__disk__.Delete(Key)
+
+            return None
+
+        self.__memory__.Set(Key, tokens, len(data))
+        return tokens
+
+    def Set(self, Key: str, Tokens: list[dict[str, Any]]) -> None:
+        data = json.dumps(Tokens)
+        self.__memory__.Set(Key, Tokens, len(data))
+
+        if (self.__disk__ is None):
+            return
+
+        try:
+            tempFilePath = self.__get_file_path__(Key) + ".tmp"
+
+            with open(tempFilePath, "w") as f:
+                f.write(data)
+
+            os.replace(tempFilePath, self.__get_file_path__(Key))
+            self.__disk__.Set(Key, True, len(data))
+        except Exception as ex:
+            logging.warning(f"[response_cache] Could not save cached response `{Key}`. Details: {ex}")
+
+    def GetStats(self) -> dict[str, Any]:
+        return {
+            "memory": self.__memory__.GetStats(),
+            "disk": self.__disk__.GetStats() if (self.__disk__ is not None) else None
+        }
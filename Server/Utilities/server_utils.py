@@ -1,23 +1,38 @@
 import logging
+from typing import Any
 from collections.abc import Awaitable, Callable
 from websockets.asyncio.server import ServerConnection as WS_ServerConnection
 from websockets.protocol import State as WS_State
 import websockets
 import ssl
+import struct
 import threading
 import asyncio
 import exceptions
 
 TRANSFER_RATE = 8192 * 1024
+BINARY_CHUNK_SIZE = TRANSFER_RATE - 262144  # Compression makes incompressible data (ciphertext, media) a bit larger, keep the frames under the limit
+LOOP_LAG_INTERVAL = 0.5
+FRAMES_SUBPROTOCOL = "i40-frames"  # Negotiated with the clients that support length-prefixed messages
+FRAME_HEADER = struct.Struct(">BQ")  # Type of message (text/binary), length in bytes
+FRAME_TYPE_TEXT = 0
+FRAME_TYPE_BINARY = 1
+DEFAULT_MAX_MESSAGE_SIZE = 536870912  # Used when the listener doesn't set `max_message_size`
 
 class Client():
     def __init__(
         self,
         Socket: WS_ServerConnection,
-        EndPoint: tuple[str, int]
+        EndPoint: tuple[str, int],
+        MaxMessageSize: int | None = None
     ) -> None:
         self.__socket__ = Socket
         self.__endpoint__ = EndPoint
+        self.MAX_MESSAGE_SIZE = MaxMessageSize if (MaxMessageSize is not None) else DEFAULT_MAX_MESSAGE_SIZE
+        self.Session: Any | None = None
+
+        # Each message is a header frame followed by its data; otherwise, the data is followed by `--END--` (older clients)
+        self.UseFrames = Socket.subprotocol == FRAMES_SUBPROTOCOL
 
         self.__validate_connection_type__()
         logging.info("[server_utils] Connection created.")
@@ -31,7 +46,7 @@ class Client():
         ):
             raise exceptions.ConnectionTypeInvalid()
     
-    async def __send__(self, Message: str) -> None:
+    async def __send__(self, Message: str | bytes | memoryview) -> None:
         if (not self.IsConnected()):
             await self.Close()
             raise exceptions.ConnectionClosedError()
@@ -39,39 +54,96 @@ class Client():
         if (isinstance(self.__socket__, WS_ServerConnection)):
             await self.__socket__.send(Message)
     
-    async def __receive__(self) -> str:
+    async def __receive__(self) -> str | bytes:
         if (not self.IsConnected()):
             raise exceptions.ConnectionClosedError()
         
         if (isinstance(self.__socket__, WS_ServerConnection)):
-            received = await self.__socket__.recv(True)
+            # Text frames are returned as strings, binary frames (protocol v3) as bytes
+            received = await self.__socket__.recv()
         
         return received
 
-    async def Receive(self) -> str:
+    def __check_size__(self, Size: int) -> None:
+        if (Size > self.MAX_MESSAGE_SIZE):
+            raise exceptions.MessageTooLargeException(self.MAX_MESSAGE_SIZE)
+
+    async def __receive_frames__(self) -> str | bytearray:
+        header = await self.__receive__()
+
+        if (isinstance(header, str) or len(header) != FRAME_HEADER.size):
+            raise ValueError("Invalid message header.")
+
+        messageType, length = FRAME_HEADER.unpack(header)
+        self.__check_size__(length)  # Rejected before receiving the data
+
+        buffer = bytearray()  # Nothing is allocated from the declared length, the buffer grows with the received data
+        received = 0
+
+        while (received < length):
+            chunk = await self.__receive__()
+
+            if (isinstance(chunk, str) or received + len(chunk) > length):
+                raise ValueError("Invalid message data.")
+
+            buffer += chunk
+            received += len(chunk)
+
+        return buffer.decode("utf-8") if (messageType == FRAME_TYPE_TEXT) else buffer
+
+    async def Receive(self) -> str | bytes | bytearray:
         self.__validate_connection_type__()
-        message = ""
+
+        if (self.UseFrames):
+            return await self.__receive_frames__()
+
+        chunks = []
+        size = 0
 
         while (True):
             result = await self.__receive__()
 
             if (result == "--END--"):
                 break
-            elif (len(result.strip()) == 0):
+            elif (len(result) == 0 or (isinstance(result, str) and len(result.strip()) == 0)):
                 await self.Close()
-
-            message += result
+            
+            if (len(chunks) > 0 and isinstance(chunks[0], str) != isinstance(result, str)):
+                raise ValueError("Text and binary frames mixed in the same message.")
+            
+            size += len(result)
+            self.__check_size__(size)  # Checked while the message is arriving
+            chunks.append(result)
+        
+        if (len(chunks) == 0):
+            return ""
         
-        return message
+        return "".join(chunks) if (isinstance(chunks[0], str)) else b"".join(chunks)
 
-    async def Send(self, Message: str) -> None:
+    async def Send(self, Message: str | bytes | bytearray) -> None:
         self.__validate_connection_type__()
-        chunks = [Message[i:i + TRANSFER_RATE] for i in range(0, len(Message), TRANSFER_RATE)]
 
-        for chunk in chunks:
-            await self.__send__(chunk)
+        if (self.UseFrames):
+            if (isinstance(Message, str)):
+                Message = Message.encode("utf-8")
+                messageType = FRAME_TYPE_TEXT
+            else:
+                messageType = FRAME_TYPE_BINARY
+            
+            await self.__send__(FRAME_HEADER.pack(messageType, len(Message)))
         
-        await self.__send__("--END--")
+        if (isinstance(Message, str)):
+            for i in range(0, len(Message), TRANSFER_RATE):
+                await self.__send__(Message[i:i + TRANSFER_RATE])
+        else:
+            # Chunks are views of the message, nothing is copied
+            view = memoryview(Message)
+
+            for i in range(0, len(view), BINARY_CHUNK_SIZE):
+                await self.__send__(view[i:i + BINARY_CHUNK_SIZE])
+        
+        if (not self.UseFrames):
+            await self.__send__("--END--")
 
     async def Close(self) -> None:
         try:
@@ -101,22 +173,25 @@ class BaseServer():
         ListenPort: int,
         ConnectedCallback: Callable[[Client], Awaitable[None]] | None = None,
         DisconenctedCallback: Callable[[Client], Awaitable[None]] | None = None,
-        ReceiveCallback: Callable[[Client, str], Awaitable[bool | None]] | None = None,
+        ReceiveCallback: Callable[[Client, str | bytes], Awaitable[bool | None]] | None = None,
         StartServerCallback: Callable[[], Awaitable[None]] | None = None,
         StopServerCallback: Callable[[], Awaitable[None]] | None = None,
         NewThread: bool = True,
-        BannedIPs: list[str] = []
+        BannedIPs: list[str] = [],
+        MaxMessageSize: int | None = None
     ) -> None:
         self.ConnectedCallback = ConnectedCallback
         self.DisconnectedCallback = DisconenctedCallback
         self.ReceiveCallback = ReceiveCallback
         self.BannedIPs = BannedIPs
+        self.MaxMessageSize = MaxMessageSize
         self.__new_thread__ = NewThread
         self.__endpoint__ = (ListenIP, ListenPort)
         self.__started__ = False
         self.__connected_clients__: list[Client] = []
         self.__start_server_callback__ = StartServerCallback
         self.__stop_server_callback__ = StopServerCallback
+        self.EventLoopLag: dict[str, float] = {"last": 0, "average": 0, "max": 0}
 
         if (self.__start_server_callback__ == None or self.__stop_server_callback__ == None):
             raise ValueError("Start server callback and stop server callback MUST NOT be null.")
@@ -125,9 +200,32 @@ class BaseServer():
     
     def IsStarted(self) -> bool:
         return self.__started__
+    
+    def GetStats(self) -> dict[str, Any]:
+        return {
+            "endpoint": f"{self.__endpoint__[0]}:{self.__endpoint__[1]}",
+            "connected_clients": len(self.__connected_clients__),
+            "event_loop_lag": self.EventLoopLag.copy()
+        }
+    
+    async def __monitor_event_loop_lag__(self) -> None:
+        # Measures how late the event loop wakes up; anything blocking the loop shows up here
+        loop = asyncio.get_running_loop()
+
+        while (self.__started__):
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+
+            lag = max(loop.time() - start - LOOP_LAG_INTERVAL, 0)
+            self.EventLoopLag["last"] = round(lag, 4)
+            self.EventLoopLag["average"] = round(self.EventLoopLag["average"] * 0.9 + lag * 0.1, 4)
+            self.EventLoopLag["max"] = round(max(self.EventLoopLag["max"], lag), 4)
+
+            if (lag > 0.1):
+                logging.warning(f"[server_utils] Event loop lag of {round(lag * 1000)}ms at `{self.__endpoint__[0]}:{self.__endpoint__[1]}`.")
 
     async def __on_client_connected__(self, Socket: WS_ServerConnection) -> None:
-        c = Client(Socket, Socket.remote_address)
+        c = Client(Socket, Socket.remote_address, self.MaxMessageSize)
 
         try:
             if (self.ConnectedCallback is not None):
@@ -166,7 +264,10 @@ class BaseServer():
         
         try:
             self.__started__ = True
+            lagMonitor = asyncio.create_task(self.__monitor_event_loop_lag__())
+
             await self.__start_server_callback__()
+            lagMonitor.cancel()
         except Exception as ex:
             logging.error(f"[server_utils] Could not start base server: {ex}")
     
@@ -211,13 +312,14 @@ class WebSocketsServer(BaseServer):
         ListenPort: int,
         ConnectedCallback: Callable[[Client], Awaitable[None]] | None = None,
         DisconenctedCallback: Callable[[Client], Awaitable[None]] | None = None,
-        ReceiveCallback: Callable[[Client, str], Awaitable[bool | None]] | None = None,
+        ReceiveCallback: Callable[[Client, str | bytes], Awaitable[bool | None]] | None = None,
         NewThread: bool = True,
         BannedIPs: list[str] = [],
         IgnoreBasicCommands: bool = False,
         SSLCertFile: str | None = None,
         SSLKeyFile: str | None = None,
-        SSLPassword: str | None = None
+        SSLPassword: str | None = None,
+        MaxMessageSize: int | None = None
     ) -> None:
         super().__init__(
             ListenIP = ListenIP,
@@ -228,7 +330,8 @@ class WebSocketsServer(BaseServer):
             StartServerCallback = self.__start_server_call__,
             StopServerCallback = self.__stop_server_call__,
             NewThread = NewThread,
-            BannedIPs = BannedIPs
+            BannedIPs = BannedIPs,
+            MaxMessageSize = MaxMessageSize
         )
 
         self.IgnoreBasicCommands = IgnoreBasicCommands
@@ -236,7 +339,7 @@ class WebSocketsServer(BaseServer):
         self.__socket__ = None
         self.__ssl__ = None if (SSLCertFile is None or SSLKeyFile is None) else (SSLCertFile, SSLKeyFile, SSLPassword)
     
-    async def __receive_client__(self, Client: Client, Message: str) -> bool:
+    async def __receive_client__(self, Client: Client, Message: str | bytes) -> bool:
         if (not self.IgnoreBasicCommands):
             if (Message == "ping"):
                 await Client.Send("pong")
@@ -260,7 +363,8 @@ class WebSocketsServer(BaseServer):
             host = self.__endpoint__[0],
             port = self.__endpoint__[1],
             max_size = TRANSFER_RATE,
-            ssl = sslCtx
+            ssl = sslCtx,
+            select_subprotocol = lambda Connection, Subprotocols: FRAMES_SUBPROTOCOL if (FRAMES_SUBPROTOCOL in Subprotocols) else None
         )
         
         logging.info(f"[server_utils] (websockets) Server listening at `{self.__endpoint__[0]}:{self.__endpoint__[1]}`.")
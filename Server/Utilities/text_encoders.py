@@ -0,0 +1,94 @@
+import logging
+from typing import Any
+import math
+import threading
+
+HEURISTIC_PREFIX = "heuristic:"
+HEURISTICS = {
+    "bytes": lambda Text: len(Text.encode("utf-8")),  # Upper bound for byte-level BPE tokenizers
+    "chars": lambda Text: math.ceil(len(Text) / 4)  # Approximation of most BPE tokenizers for english text
+}
+Configuration: dict[str, Any] = {}
+
+class HeuristicEncoder():
+    # Fast local encoder used when no tokenizer is available. Only counts tokens.
+    def __init__(self, Name: str) -> None:
+        if (Name not in HEURISTICS):
+            raise ValueError(f"Invalid heuristic encoder `{Name}`. Available: {list(HEURISTICS.keys())}.")
+
+        self.Name = Name
+        self.__count__ = HEURISTICS[Name]
+
+    def Count(self, Text: str) -> int:
+        return self.__count__(Text)
+
+class PretrainedEncoder():
+    def __init__(self, Name: str) -> None:
+        from transformers import AutoTokenizer  # Imported here so the server starts without loading transformers
+
+        self.Name = Name
+        self.__tokenizer__ = AutoTokenizer.from_pretrained(Name)
+
+    def Count(self, Text: str) -> int:
+        return len(self.__tokenizer__.encode(Text))
+
+Encoders: dict[str, HeuristicEncoder | PretrainedEncoder] = {}
+EncodersLock: threading.Lock = threading.Lock()
+LoadingLocks: dict[str, threading.Lock] = {}
+
+def GetDefaultEncoderName() -> str:
+    return Configuration["server_encoder"] if ("server_encoder" in Configuration and Configuration["server_encoder"]) else GetFallbackEncoderName()
+
+def GetFallbackEncoderName() -> str:
+    if ("server_encoder_fallback" in Configuration and Configuration["server_encoder_fallback"]):
+        return HEURISTIC_PREFIX + Configuration["server_encoder_fallback"]
+
+    return HEURISTIC_PREFIX + "bytes"
+
+def __load_encoder__(Name: str) -> HeuristicEncoder | PretrainedEncoder:
+    if (Name.startswith(HEURISTIC_PREFIX)):
+        return HeuristicEncoder(Name[len(HEURISTIC_PREFIX):])
+
+    try:
+        logging.info(f"[text_encoders] Loading encoder `{Name}`.")
+        return PretrainedEncoder(Name)
+    except Exception as ex:
+        fallbackName = GetFallbackEncoderName()
+        logging.warning(f"[text_encoders] Could not load encoder `{Name}`, using `{fallbackName}` instead. Details: {ex}")
+
+        return GetEncoder(fallbackName)
+
+def __get_loading_lock__(Name: str) -> threading.Lock:
+    with EncodersLock:
+        if (Name not in LoadingLocks):
+            LoadingLocks[Name] = threading.Lock()
+
+        return LoadingLocks[Name]
+
+def GetEncoder(Name: str | None = None) -> HeuristicEncoder | PretrainedEncoder:
+    # Encoders are loaded on first use and shared between all the models that use them
+    if (Name is None):
+        Name = GetDefaultEncoderName()
+
+    encoder = Encoders.get(Name)
+
+    if (encoder is not None):
+        return encoder
+
+    with EncodersLock:
+        if (Name not in Encoders):
+            Encoders[Name] = __load_encoder__(Name) if (Name.startswith(HEURISTIC_PREFIX)) else None
+
+    if (Encoders[Name] is None):
+        # Pretrained encoders are loaded outside of the global lock so the other encoders keep working
+        with __get_loading_lock__(Name):
+            if (Encoders[Name] is None):
+                Encoders[Name] = __load_encoder__(Name)
+
+    return Encoders[Name]
+
+def CountTokens(Text: str, Name: str | None = None) -> int:
+    return GetEncoder(Name).Count(Text)
+
+def GetLoadedEncoders() -> list[str]:
+    return [name for name, encoder in Encoders.copy().items() if (encoder is not None)]
@@ -0,0 +1,309 @@
+import logging
+from typing import Any
+from collections.abc import Callable
+import os
+import json
+import time
+import hashlib
+import secrets
+import threading
+import exceptions
+import Utilities.lru_cache as lru_cache
+
+CLEANUP_INTERVAL = 60
+Configuration: dict[str, Any] = {}
+__memory__: lru_cache.LRUCache | None = None  # {"conversation id": conversation}, recently used conversations
+__disk__: dict[str, str] = {}  # {"conversation id": "key hash"}, conversations saved in the disk
+__keys__: dict[str, set[str]] = {}  # {"key hash": {"conversation id", ...}}
+__busy__: set[str] = set()
+__lock__: threading.RLock = threading.RLock()
+__last_cleanup__: float = 0
+OnStore: Callable[[str, list[dict[str, Any]]], None] | None = None  # Called with the messages of a conversation when they change
+OnForget: Callable[[str], None] | None = None  # Called when a conversation is deleted or expires
+
+def __get_config__() -> dict[str, Any]:
+    return Configuration["server_conversations"] if ("server_conversations" in Configuration) else {}
+
+def __get_directory__() -> str:
+    return os.path.join(Configuration["server_data"]["temp_dir"], "conversations")
+
+def __get_file_path__(ID: str, KeyHash: str) -> str:
+    return os.path.join(__get_directory__(), f"{KeyHash}_{ID}.json")
+
+def __hash_key__(Key: str) -> str:
+    # API keys are never saved in the disk
+    return hashlib.sha256(Key.encode("utf-8")).hexdigest()[:32]
+
+def __save_to_disk__(ID: str, Conversation: dict[str, Any]) -> None:
+    # Also called by the memory cache (without its lock) when the conversation is evicted, so it can run at the same time as a delete
+    try:
+        filePath = __get_file_path__(ID, Conversation["key"])
+
+        with open(filePath + ".tmp", "w") as f:
+            f.write(json.dumps(Conversation))
+
+        os.utime(filePath + ".tmp", (Conversation["updated"], Conversation["updated"]))
+
+        with __lock__:
+            currentConversation = __memory__.Peek(ID)
+
+            if (
+                ID not in __keys__.get(Conversation["key"], set()) or  # Deleted
+                (currentConversation is not None and currentConversation is not Conversation)  # A newer version is in memory
+            ):
+                os.remove(filePath + ".tmp")
+                return
+
+            os.replace(filePath + ".tmp", filePath)
+            __disk__[ID] = Conversation["key"]
+    except Exception as ex:
+        logging.error(f"[conversations_manager] Could not save conversation `{ID}`. Details: {ex}")
+
+def __delete_from_disk__(ID: str) -> None:
+    with __lock__:
+        keyHash = __disk__.pop(ID, None)
+
+    if (keyHash is None):
+        return
+
+    try:
+        os.remove(__get_file_path__(ID, keyHash))
+    except FileNotFoundError:
+        pass
+
+def __is_expired__(Updated: float) -> bool:
+    ttl = __get_config__()["ttl"] if ("ttl" in __get_config__()) else None
+    return ttl is not None and ttl > 0 and time.time() - Updated > ttl
+
+def __forget__(ID: str, KeyHash: str) -> None:
+    # Removed from the keys first, so a conversation being evicted is not saved again
+    with __lock__:
+        if (KeyHash in __keys__):
+            __keys__[KeyHash].discard(ID)
+
+            if (len(__keys__[KeyHash]) == 0):
+                del __keys__[KeyHash]
+
+    __memory__.Delete(ID)
+    __delete_from_disk__(ID)
+
+    if (OnForget is not None):
+        OnForget(ID)
+
+def __load__(ID: str) -> dict[str, Any] | None:
+    conversation = __memory__.Get(ID)
+
+    if (conversation is None):
+        with __lock__:
+            keyHash = __disk__.get(ID)
+
+        if (keyHash is None):
+            return None
+
+        try:
+            with open(__get_file_path__(ID, keyHash), "r") as f:
+                conversation = json.loads(f.read())
+        except Exception as ex:
+            logging.error(f"[conversations_manager] Could not read conversation `{ID}`. Details: {ex}")
+            __forget__(ID, keyHash)
+
+            return None
+
+        __memory__.Set(ID, conversation)
+
+    if (__is_expired__(conversation["updated"])):
+        __forget__(ID, conversation["key"])
+        return None
+
+    return conversation
+
+def __forget_if_expired__(ID: str, KeyHash: str) -> None:
+    conversation = __memory__.Peek(ID)
+
+    if (conversation is None):
+        try:
+            updated = os.path.getmtime(__get_file_path__(ID, KeyHash))
+        except OSError:
+            updated = 0
+    else:
+        updated = conversation["updated"]
+
+    if (__is_expired__(updated)):
+        __forget__(ID, KeyHash)
+
+def Cleanup() -> None:
+    # Removes the expired conversations
+    global __last_cleanup__
+    __last_cleanup__ = time.time()
+
+    with __lock__:
+        ids = [(ID, keyHash) for keyHash, keyIDs in __keys__.items() for ID in keyIDs]
+
+    for ID, keyHash in ids:
+        with __lock__:
+            if (ID in __busy__ or ID not in __keys__.get(keyHash, set())):
+                continue
+
+            __busy__.add(ID)
+
+        try:
+            __forget_if_expired__(ID, keyHash)
+        finally:
+            with __lock__:
+                __busy__.discard(ID)
+
+def Init() -> None:
+    global __memory__
+    conversationsConfig = __get_config__()
+    __memory__ = lru_cache.LRUCache(
+        conversationsConfig["max_memory_items"] if ("max_memory_items" in conversationsConfig) else 1024,
+        OnEvict = __save_to_disk__  # Conversations removed from memory are moved to the disk
+    )
+
+    if (not IsEnabled()):
+        return
+
+    os.makedirs(__get_directory__(), exist_ok = True)
+
+    for fileName in os.listdir(__get_directory__()):
+        if (not fileName.endswith(".json") or "_" not in fileName):
+            continue
+
+        keyHash, ID = fileName[:-5].split("_", 1)
+        __disk__[ID] = keyHash
+
+        if (keyHash not in __keys__):
+            __keys__[keyHash] = set()
+
+        __keys__[keyHash].add(ID)
+
+    Cleanup()
+
+def Close() -> None:
+    if (__memory__ is None or not IsEnabled()):
+        return
+
+    # Save the conversations that are only in memory
+    with __lock__:
+        ids = [ID for keyIDs in __keys__.values() for ID in keyIDs]
+
+    for ID in ids:
+        conversation = __memory__.Peek(ID)
+
+        if (conversation is not None):
+            __save_to_disk__(ID, conversation)
+
+def IsEnabled() -> bool:
+    conversationsConfig = __get_config__()
+    return "enabled" in conversationsConfig and conversationsConfig["enabled"]
+
+def Create(Key: str, Messages: list[dict[str, Any]] = []) -> str:
+    if (not IsEnabled()):
+        raise RuntimeError("Conversations are disabled in this server.")
+
+    if (time.time() - __last_cleanup__ > CLEANUP_INTERVAL):
+        Cleanup()
+
+    conversationsConfig = __get_config__()
+    maxPerKey = conversationsConfig["max_per_key"] if ("max_per_key" in conversationsConfig) else None
+    keyHash = __hash_key__(Key)
+    ID = secrets.token_urlsafe(24)
+
+    with __lock__:
+        if (maxPerKey is not None and maxPerKey > 0 and len(__keys__.get(keyHash, [])) >= maxPerKey):
+            raise exceptions.QuotaExceededException(f"Maximum {maxPerKey} conversations per API key. Delete a conversation to create a new one.")
+
+        if (keyHash not in __keys__):
+            __keys__[keyHash] = set()
+
+        __keys__[keyHash].add(ID)
+
+    __memory__.Set(ID, {"key": keyHash, "messages": list(Messages), "updated": time.time()})
+
+    if (OnStore is not None):
+        OnStore(ID, Messages)
+
+    return ID
+
+def Acquire(ID: str, Key: str) -> list[dict[str, Any]]:
+    # Returns the messages of the conversation; it can't be used by other requests until released
+    if (not IsEnabled()):
+        raise RuntimeError("Conversations are disabled in this server.")
+
+    keyHash = __hash_key__(Key)
+
+    with __lock__:
+        if (ID not in __keys__.get(keyHash, set())):
+            raise ValueError("Conversation not found.")
+
+        if (ID in __busy__):
+            raise RuntimeError("The conversation is being used by another request.")
+
+        __busy__.add(ID)
+
+    try:
+        conversation = __load__(ID)
+    except:
+        Release(ID, None)
+        raise
+
+    if (conversation is None):
+        Release(ID, None)
+        raise ValueError("Conversation not found.")
+
+    return list(conversation["messages"])
+
+def GetMaxMessages() -> int | None:
+    conversationsConfig = __get_config__()
+    maxMessages = conversationsConfig["max_messages"] if ("max_messages" in conversationsConfig) else None
+
+    return maxMessages if (maxMessages is not None and maxMessages > 0) else None
+
+def Release(ID: str, Messages: list[dict[str, Any]] | None) -> None:
+    # Saves the new messages of the conversation (if any) and releases it
+    try:
+        if (Messages is not None):
+            conversation = __load__(ID)
+
+            if (conversation is not None):
+                __delete_from_disk__(ID)  # Outdated; deleted before, so the new messages can be saved if they are evicted
+                __memory__.Set(ID, conversation | {"messages": Messages, "updated": time.time()})
+
+                if (OnStore is not None):
+                    OnStore(ID, Messages)
+    finally:
+        with __lock__:
+            __busy__.discard(ID)
+
+def Delete(ID: str, Key: str) -> None:
+    keyHash = __hash_key__(Key)
+
+    with __lock__:
+        if (ID not in __keys__.get(keyHash, set())):
+            raise ValueError("Conversation not found.")
+
+        if (ID in __busy__):
+            raise RuntimeError("The conversation is being used by another request.")
+
+        # Busy while deleting, so it can't be acquired
+        __busy__.add(ID)
+
+    try:
+        __forget__(ID, keyHash)
+    finally:
+        with __lock__:
+            __busy__.discard(ID)
+
+def GetIDs() -> set[str]:
+    with __lock__:
+        return {ID for keyIDs in __keys__.values() for ID in keyIDs}
+
+def GetStats() -> dict[str, Any]:
+    with __lock__:
+        return {
+            "conversations": sum(len(keyIDs) for keyIDs in __keys__.values()),
+            "keys": len(__keys__),
+            "on_disk": len(__disk__),
+            "busy": len(__busy__),
+            "memory": __memory__.GetStats() if (__memory__ is not None) else None
+        }
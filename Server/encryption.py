@@ -1,12 +1,19 @@
 import logging
+from typing import Self
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.backends import default_backend
 from concurrent.futures import ThreadPoolExecutor
 import base64
 import os
 import hashlib
+import threading
+
+SESSION_DIRECTION_CLIENT: bytes = b"\x00\x00\x00\x00"
+SESSION_DIRECTION_SERVER: bytes = b"\x00\x00\x00\x01"
+SESSION_REPLAY_WINDOW: int = 64  # Frames that can arrive (or be decrypted) out of order
 
 def ParseHash(HashName: str) -> hashes.HashAlgorithm | None:
     if (HashName == "sha224"):
@@ -109,7 +116,8 @@ def LoadKeysFromContent(
 
     return (privateKey, publicKey)
 
-def Encrypt(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data: str | bytes, MaxThreads: int) -> str | bytes:
+def EncryptRaw(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data: bytes, MaxThreads: int) -> bytes:
+    # Same as Encrypt, without base64 (used by the binary protocol)
     def _encrypt(Key: bytes, Nonce: bytes, Idx: int, Chunk: bytes, ChunkSize: int) -> tuple[int, bytes]:
         nonceInt = int.from_bytes(Nonce, "big")
         blocksPerChunk = ChunkSize // 16
@@ -124,13 +132,6 @@ def Encrypt(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data
     if (Hash is None):
         return Data
     
-    if (isinstance(Data, bytes)):
-        returnAsBytes = True
-        data = Data
-    else:
-        returnAsBytes = False
-        data = Data.encode("utf-8")
-    
     key = os.urandom(32)
     encriptedKey = PublicKey.encrypt(
         key,
@@ -143,7 +144,7 @@ def Encrypt(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data
 
     nonce = os.urandom(16)
     chunkSize = 1024 * 1024
-    chunks = [data[i:i + chunkSize] for i in range(0, len(data), chunkSize)]
+    chunks = [Data[i:i + chunkSize] for i in range(0, len(Data), chunkSize)]
 
     results = [None] * len(chunks)
 
@@ -157,20 +158,33 @@ def Encrypt(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data
             idx, ciphertext = future.result()
             results[idx] = ciphertext
 
-    result = (
+    return (
         len(encriptedKey).to_bytes(4, "big") +
         encriptedKey +
         nonce +
         b"".join(results)
     )
-    result = base64.b64encode(result)
+
+def Encrypt(Hash: hashes.HashAlgorithm | None, PublicKey: rsa.RSAPublicKey, Data: str | bytes, MaxThreads: int) -> str | bytes:
+    if (Hash is None):
+        return Data
+    
+    if (isinstance(Data, bytes)):
+        returnAsBytes = True
+        data = Data
+    else:
+        returnAsBytes = False
+        data = Data.encode("utf-8")
+    
+    result = base64.b64encode(EncryptRaw(Hash, PublicKey, data, MaxThreads))
 
     if (returnAsBytes):
         return result
     
     return result.decode("utf-8")
 
-def Decrypt(Hash: hashes.HashAlgorithm | None, PrivateKey: rsa.RSAPrivateKey, Data: str | bytes, MaxThreads: int) -> str | bytes:
+def DecryptRaw(Hash: hashes.HashAlgorithm | None, PrivateKey: rsa.RSAPrivateKey, Data: bytes | memoryview, MaxThreads: int) -> bytes:
+    # Same as Decrypt, without base64 (used by the binary protocol)
     def _decrypt(Key: bytes, Nonce: bytes, Idx: int, Chunk: bytes, ChunkSize: int) -> tuple[int, bytes]:
         nonceInt = int.from_bytes(Nonce, "big")
         blocksPerChunks = ChunkSize // 16
@@ -185,19 +199,10 @@ def Decrypt(Hash: hashes.HashAlgorithm | None, PrivateKey: rsa.RSAPrivateKey, Da
     if (Hash is None):
         return Data
 
-    if (isinstance(Data, bytes)):
-        returnAsBytes = True
-        data = Data
-    else:
-        returnAsBytes = False
-        data = Data.encode("utf-8")
-    
-    data = base64.b64decode(data)
-    
-    lenKey = int.from_bytes(data[:4], "big")
-    encryptedKey = data[4:4 + lenKey]
-    nonce = data[4 + lenKey:4 + lenKey + 16]
-    ciphertext = data[4 + lenKey + 16:]
+    lenKey = int.from_bytes(Data[:4], "big")
+    encryptedKey = bytes(Data[4:4 + lenKey])
+    nonce = bytes(Data[4 + lenKey:4 + lenKey + 16])
+    ciphertext = Data[4 + lenKey + 16:]
 
     key = PrivateKey.decrypt(
         encryptedKey,
@@ -225,10 +230,25 @@ def Decrypt(Hash: hashes.HashAlgorithm | None, PrivateKey: rsa.RSAPrivateKey, Da
             idx, plaintext = future.result()
             results[idx] = plaintext
 
+    return b"".join(results)
+
+def Decrypt(Hash: hashes.HashAlgorithm | None, PrivateKey: rsa.RSAPrivateKey, Data: str | bytes, MaxThreads: int) -> str | bytes:
+    if (Hash is None):
+        return Data
+
+    if (isinstance(Data, bytes)):
+        returnAsBytes = True
+        data = Data
+    else:
+        returnAsBytes = False
+        data = Data.encode("utf-8")
+    
+    result = DecryptRaw(Hash, PrivateKey, base64.b64decode(data), MaxThreads)
+
     if (returnAsBytes):
-        return b"".join(results)
+        return result
     
-    return "".join([p.decode("utf-8") for p in results])
+    return result.decode("utf-8")
 
 def HashContent(Content: str | bytes, Hash: hashes.HashAlgorithm) -> str:
     if (Hash is None):
@@ -249,4 +269,123 @@ def HashContent(Content: str | bytes, Hash: hashes.HashAlgorithm) -> str:
     
     hashHex = hashObj.hexdigest()
     
-    return hashHex
\ No newline at end of file
+    return hashHex
+
+def WrapSessionKey(Hash: hashes.HashAlgorithm, PublicKey: rsa.RSAPublicKey, Key: bytes) -> str:
+    encryptedKey = PublicKey.encrypt(
+        Key,
+        padding.OAEP(
+            mgf = padding.MGF1(Hash),
+            algorithm = Hash,
+            label = None
+        )
+    )
+    return base64.b64encode(encryptedKey).decode("utf-8")
+
+def UnwrapSessionKey(Hash: hashes.HashAlgorithm, PrivateKey: rsa.RSAPrivateKey, Data: str | bytes) -> bytes:
+    key = PrivateKey.decrypt(
+        base64.b64decode(Data),
+        padding.OAEP(
+            mgf = padding.MGF1(Hash),
+            algorithm = Hash,
+            label = None
+        )
+    )
+
+    if (len(key) != 32):
+        raise ValueError("Invalid session key length.")
+    
+    return key
+
+class Session():
+    # The AES key is exchanged using RSA-OAEP only once per connection, after that every frame only uses AES-GCM.
+    # Nonces are built from the direction of the frame and a counter, so they are never repeated for the same key.
+    # Replays are rejected with the highest received counter and a bitmap of the previous ones (frames can be decrypted out of order by different threads).
+    def __init__(self, Key: bytes, Direction: bytes) -> None:
+        if (len(Key) != 32):
+            raise ValueError("Invalid session key length.")
+        
+        if (Direction != SESSION_DIRECTION_CLIENT and Direction != SESSION_DIRECTION_SERVER):
+            raise ValueError("Invalid session direction.")
+
+        self.__aes__ = AESGCM(Key)
+        self.__direction__ = Direction
+        self.__counter__ = 0
+        self.__highest_counter__ = 0
+        self.__counters_window__ = 1  # Bit N set = counter (highest - N) received; counter 0 is never valid
+        self.__lock__ = threading.Lock()
+    
+    @classmethod
+    def Generate(cls, Direction: bytes) -> tuple[Self, bytes]:
+        key = AESGCM.generate_key(bit_length = 256)
+        return (cls(key, Direction), key)
+
+    def __next_nonce__(self) -> bytes:
+        with self.__lock__:
+            self.__counter__ += 1
+
+            if (self.__counter__ >= 2 ** 64):
+                raise OverflowError("Session counter exhausted. A new session must be created.")
+
+            return self.__direction__ + self.__counter__.to_bytes(8, "big")
+
+    def EncryptRaw(self, Data: bytes) -> bytes:
+        # Nonce + ciphertext, without base64 (binary protocol)
+        nonce = self.__next_nonce__()
+        return nonce + self.__aes__.encrypt(nonce, Data, None)
+    
+    def DecryptRaw(self, Data: bytes | memoryview) -> bytes:
+        nonce = bytes(Data[:12])
+
+        if (len(nonce) != 12 or nonce[:4] == self.__direction__):
+            raise ValueError("Invalid session nonce.")
+        
+        counter = int.from_bytes(nonce[4:], "big")
+
+        # Authenticated before updating the counters, forged frames can't burn valid counters
+        data = self.__aes__.decrypt(nonce, Data[12:], None)
+
+        with self.__lock__:
+            if (counter > self.__highest_counter__):
+                shift = counter - self.__highest_counter__
+                self.__counters_window__ = ((self.__counters_window__ << min(shift, SESSION_REPLAY_WINDOW)) | 1) & ((1 << SESSION_REPLAY_WINDOW) - 1)
+                self.__highest_counter__ = counter
+            else:
+                offset = self.__highest_counter__ - counter
+
+                if (offset >= SESSION_REPLAY_WINDOW or (self.__counters_window__ >> offset) & 1):
+                    raise ValueError("Session frame replayed.")
+                
+                self.__counters_window__ |= 1 << offset
+
+        return data
+
+    def Encrypt(self, Data: str | bytes) -> str | bytes:
+        if (isinstance(Data, bytes)):
+            returnAsBytes = True
+            data = Data
+        else:
+            returnAsBytes = False
+            data = Data.encode("utf-8")
+        
+        result = base64.b64encode(self.EncryptRaw(data))
+
+        if (returnAsBytes):
+            return result
+        
+        return result.decode("utf-8")
+    
+    def Decrypt(self, Data: str | bytes) -> str | bytes:
+        if (isinstance(Data, bytes)):
+            returnAsBytes = True
+            data = Data
+        else:
+            returnAsBytes = False
+            data = Data.encode("utf-8")
+        
+        plaintext = self.DecryptRaw(base64.b64decode(data))
+
+        if (returnAsBytes):
+            return plaintext
+        
+        return plaintext.decode("utf-8")
@@ -23,4 +23,30 @@ class ConnectionClosedError(Exception):
 
 class FilterException(Exception):
     def __init__(self):
-        super().__init__("Your message does not comply with the server's Terms of Service.")
\ No newline at end of file
+        super().__init__("Your message does not comply with the server's Terms of Service.")
+
+class ServerBusyException(Exception):
+    def __init__(self, RetryAfter: float | None = None) -> None:
+        self.RetryAfter = RetryAfter
+        message = "The server is busy."
+
+        if (RetryAfter is not None):
+            message += f" Retry after {RetryAfter} seconds."
+
+        super().__init__(message)
+
+class PromptTooLongException(Exception):
+    def __init__(self, InputTokens: int, MaxTokens: int) -> None:
+        super().__init__(f"The prompt is too long. {InputTokens} input tokens; {MaxTokens} maximum tokens.")
+
+class MediaTooLargeException(Exception):
+    def __init__(self, Limit: int, Unit: str = "bytes") -> None:
+        super().__init__(f"The media file is too large. Maximum {Limit} {Unit}.")
+
+class QuotaExceededException(Exception):
+    def __init__(self, Message: str | None = None) -> None:
+        super().__init__("Quota exceeded" + (f": {Message}" if (Message is not None) else "."))
+
+class MessageTooLargeException(Exception):
+    def __init__(self, Limit: int) -> None:
+        super().__init__(f"The message is too large. Maximum {Limit} bytes.")
\ No newline at end of file
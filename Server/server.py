@@ -1,4 +1,5 @@
 SERVER_VERSION: int = 220000
+SERVER_CAPABILITIES: list[str] = ["session", "protocol_v3", "queue_updates"]
 
 import traceback
 
@@ -16,14 +17,17 @@ try:
     import os
     import sys
     import json
+    import base64
     import time
     import random
     import asyncio
     import threading
+    from concurrent.futures import ThreadPoolExecutor
 
     import encryption
     import services_manager
     import Utilities.server_utils as server_utils
+    import Utilities.binary_protocol as binary_protocol
     import Configuration.config as config
 except Exception as ex:
     print(f"Could not load server modules. Error: {ex}\nPlease make sure all of the requirements are installed.", flush = True)
@@ -68,6 +72,39 @@ def __pardon_user__(Type: Literal["key", "ip"], Value: str) -> None:
     elif (Type != "key" and Type != "ip"):
         raise ValueError("Could not pardon.")
 
+def __update_workers_stats__(Name: str, Value: int) -> None:
+    with WorkersStatsLock:
+        WorkersStats[Name] += Value
+
+def __get_server_stats__() -> dict[str, Any]:
+    with WorkersStatsLock:
+        workersStats = WorkersStats.copy()
+
+    return {
+        "servers": [server.GetStats() for server in Servers],
+        "models": {
+            modelName: {
+                "waiting_users": modelQueue.GetWaitingCount(),
+                "processing_users": modelQueue.GetProcessingCount(),
+                "max_simul_users": modelQueue.MAX_SIMULTANEOUS_USERS,
+                "latency": modelQueue.GetLatencyStats()
+            } for modelName, modelQueue in services_manager.queue.Queues.copy().items()
+        },
+        "caches": {
+            "pricing": services_manager.PricingCache.GetStats() if (services_manager.PricingCache is not None) else None,
+            "responses": services_manager.ResponsesCache.GetStats() if (services_manager.ResponsesCache is not None) else None,
+            "filters": services_manager.FiltersCache.GetStats() if (services_manager.FiltersCache is not None) else None,
+            "blobs": services_manager.Blobs.GetStats() if (services_manager.Blobs is not None) else None
+        },
+        "coalescing": services_manager.queue.FlightsStats.copy(),
+        "conversations": services_manager.conversations_manager.GetStats() if (services_manager.conversations_manager.IsEnabled()) else None,
+        "workers": workersStats | {
+            "max_workers": RequestsPool._max_workers if (RequestsPool is not None) else 0,
+            "waiting_in_queue": len(WaitTasks),
+            "max_pending_frames": config.Configuration["server_workers"]["max_pending_frames"]
+        }
+    }
+
 def __offload_models_t__() -> None:
     global CloseServerReason
     models = {}
@@ -87,7 +124,7 @@ def __offload_models_t__() -> None:
 
             if (modelOT[0] is None or (
                 queue is not None and
-                len(queue.__waiting_uids__) + len(queue.__processing_uids__) > 0
+                queue.GetWaitingCount() + queue.GetProcessingCount() > 0
             )):
                 modelOT[1] = 0
                 continue
@@ -125,7 +162,7 @@ async def __unhandled_connection__(Client: server_utils.Client) -> None:
         await Client.Send("Access denied.")
         await Client.Close()
 
-async def __unhandled_received_message__(Client: server_utils.Client, Message: str) -> None:
+async def __unhandled_received_message__(Client: server_utils.Client, Message: str | bytes) -> None:
     global TOSContent
 
     clientPublicKey = None
@@ -138,10 +175,13 @@ async def __unhandled_received_message__(Client: server_utils.Client, Message: s
             await Client.Send(publicBytes.decode("utf-8"))
         elif (Message == "get_tos"):
             await Client.Send(TOSContent)
+        elif (Message == "get_capabilities"):
+            capabilities = SERVER_CAPABILITIES + (["conversations"] if (services_manager.conversations_manager.IsEnabled()) else []) + (["blobs"] if (services_manager.Blobs is not None) else [])
+            await Client.Send(json.dumps({"capabilities": capabilities}))
         else:
             # Process other commands
-            async def __send_to_client_2__(Token: dict[str, Any]) -> None:
-                global BannedUsers, Servers
+            def __prepare_token__(Token: dict[str, Any]) -> str | bytes:
+                # Runs in the worker thread, so the event loop only has to write the finished frame
                 nonlocal clientPublicKey, clientPublicKeyStr, modelName, queueUID, keyInstance, filterAction
 
                 tokenPublicParams = {k: v for k, v in Token.items() if (not k.startswith("_"))}
@@ -164,16 +204,18 @@ async def __unhandled_received_message__(Client: server_utils.Client, Message: s
                 else:
                     responseHash = config.Configuration["server_encryption"]["force_response_hash"]
                 
-                if (tokenPrivateParams["_public_key"] != clientPublicKeyStr):
+                session = tokenPrivateParams["_session"] if ("_session" in tokenPrivateParams) else None
+
+                if (session is None and tokenPrivateParams["_public_key"] != clientPublicKeyStr):
                     clientPublicKeyStr = tokenPrivateParams["_public_key"]
-                    clientPublicKey = encryption.LoadKeysFromContent(None, "", services_manager.base64.b64decode(clientPublicKeyStr))[1]
+                    clientPublicKey = encryption.LoadKeysFromContent(None, "", base64.b64decode(clientPublicKeyStr))[1]
                 
                 responseHashParsed = encryption.ParseHash(responseHash)
 
                 if (
                     config.Configuration["server_encryption"]["obfuscate"] and
                     responseHashParsed is not None and
-                    clientPublicKey is not None
+                    (clientPublicKey is not None or session is not None)
                 ):
                     chars = "abcdefghijplnmopqrstuvwxyz"
                     chars += chars.upper()
@@ -185,7 +227,35 @@ async def __unhandled_received_message__(Client: server_utils.Client, Message: s
 
                     tokenPublicParams["obfuscate"] = "".join([chars[random.randint(0, len(chars) - 1)] for _ in range(random.randint(5, 25))])
                 
-                if (clientPublicKey is None):
+                if (isBinaryMessage):
+                    # Protocol v3, replies use the same format as the request
+                    if ("response" in tokenPublicParams and "files" in tokenPublicParams["response"]):
+                        tokenPublicParams["response"] = tokenPublicParams["response"] | {"files": binary_protocol.MediaToBytes(tokenPublicParams["response"]["files"])}
+                    
+                    if ("conversation_result" in tokenPublicParams):
+                        tokenPublicParams["conversation_result"] = [
+                            msg if (isinstance(msg["content"], str)) else (msg | {"content": binary_protocol.MediaToBytes(msg["content"])})
+                            for msg in tokenPublicParams["conversation_result"]
+                        ]
+                    
+                    encrItem = binary_protocol.Encode(tokenPublicParams)
+
+                    if (session is not None and responseHashParsed is not None):
+                        encrItem = session.EncryptRaw(encrItem)
+                    elif (clientPublicKey is not None):
+                        encrItem = encryption.EncryptRaw(
+                            responseHashParsed,
+                            clientPublicKey,
+                            encrItem,
+                            config.Configuration["server_encryption"]["encryption_threads"]
+                        )
+                    
+                    return binary_protocol.PackMessage({"hash": responseHash} | ({"session": True} if (session is not None and responseHashParsed is not None) else {}), encrItem)
+                
+                if (session is not None and responseHashParsed is not None):
+                    # Session established, only AES is used
+                    encrItem = session.Encrypt(json.dumps(tokenPublicParams))
+                elif (clientPublicKey is None):
                     encrItem = json.dumps(tokenPublicParams)
                 else:
                     encrItem = encryption.Encrypt(
@@ -199,63 +269,151 @@ async def __unhandled_received_message__(Client: server_utils.Client, Message: s
                     "data": encrItem,
                     "hash": responseHash
                 }
-                resItem = json.dumps(resItem)
 
-                try:
-                    await Client.Send(resItem)
-                except services_manager.exceptions.ConnectionClosedError as ex:
-                    raise ex
-                except Exception as ex:
-                    logging.error(f"[server] Error sending to client: {ex}")
-                    raise ex
+                if (session is not None and responseHashParsed is not None):
+                    resItem["session"] = True
+
+                return json.dumps(resItem)
             
-            async def __send_to_client__(Token: dict[str, Any]) -> None:
+            async def __frames_writer__() -> None:
                 nonlocal exc
 
+                while (True):
+                    frame = await framesQueue.get()
+
+                    if (frame is None):
+                        break
+
+                    try:
+                        if (exc is None):
+                            await Client.Send(frame)
+                    except services_manager.exceptions.ConnectionClosedError as ex:
+                        exc = ex
+                    except Exception as ex:
+                        logging.error(f"[server] Error sending to client: {ex}")
+                        exc = ex
+                    finally:
+                        __update_workers_stats__("pending_frames", -1)
+                        framesSemaphore.release()
+
+            async def __wait_in_loop__(Wait: services_manager.queue.Wait) -> None:
+                # The request waits here, without using a worker, until it can continue
+                wakeUp = asyncio.Event()
+                callback = lambda: asyncLoop.call_soon_threadsafe(wakeUp.set)
+
                 try:
-                    await __send_to_client_2__(Token)
-                except Exception as ex:
-                    exc = ex
+                    if (Wait.AddCallback(callback)):
+                        try:
+                            await asyncio.wait_for(wakeUp.wait(), Wait.TIMEOUT)
+                        except asyncio.TimeoutError:
+                            pass
+                        finally:
+                            Wait.RemoveCallback(callback)
+                finally:
+                    Wait.Waited = True
+                    __update_workers_stats__("queued", 1)
+                    RequestsPool.submit(__run_in_thread__)
+
+            def __start_wait__(Wait: services_manager.queue.Wait) -> None:
+                waitTask = asyncio.create_task(__wait_in_loop__(Wait))
+                WaitTasks.add(waitTask)
+                waitTask.add_done_callback(WaitTasks.discard)
 
             def __run_in_thread__() -> None:
-                nonlocal keyInstance, asyncLoop, exc
-                gen = __process_client__(Message, Client.GetEndPoint())
+                nonlocal keyInstance, exc, gen
+                __update_workers_stats__("queued", -1)
+                __update_workers_stats__("active", 1)
+                waiting = False
 
-                for token in gen:
-                    if (exc is None):
-                        future = asyncio.run_coroutine_threadsafe(
-                            coro = __send_to_client__(token),
-                            loop = asyncLoop
-                        )
-                        future.result()
-                    else:
-                        if (keyInstance is not None):
-                            keyInstance.SaveToFile()
-                        
-                        gen.throw(StopIteration)
-                        break
+                try:
+                    if (gen is None):
+                        gen = __process_client__(Message, Client.GetEndPoint(), Client)
+
+                    for token in gen:
+                        if ("_wait" in token and exc is None):
+                            try:
+                                # Continues in another worker when the wait ends
+                                asyncLoop.call_soon_threadsafe(__start_wait__, token["_wait"])
+                                waiting = True
+                                return
+                            except RuntimeError as ex:
+                                # Event loop closed
+                                exc = ex
+                                continue
+
+                        if (exc is None):
+                            try:
+                                frame = __prepare_token__(token)
+                            except Exception as ex:
+                                logging.error(f"[server] Error preparing token for client: {ex}")
+                                exc = ex
+                                continue
+                            
+                            # Blocks only when the writer is behind (backpressure)
+                            framesSemaphore.acquire()
+                            __update_workers_stats__("pending_frames", 1)
+
+                            try:
+                                asyncLoop.call_soon_threadsafe(framesQueue.put_nowait, frame)
+                            except RuntimeError as ex:
+                                # Event loop closed
+                                __update_workers_stats__("pending_frames", -1)
+                                framesSemaphore.release()
+                                exc = ex
+                        else:
+                            if (keyInstance is not None):
+                                keyInstance.SaveToFile()
+                            
+                            gen.throw(StopIteration)
+                            break
+                finally:
+                    __update_workers_stats__("active", -1)
+
+                    if (not waiting):
+                        try:
+                            asyncLoop.call_soon_threadsafe(framesQueue.put_nowait, None)
+                        except RuntimeError:
+                            pass
             
+            gen = None
             modelName = None
             queueUID = None
             keyInstance = None
             filterAction = None
             exc = None
+            isBinaryMessage = binary_protocol.IsBinaryMessage(Message)
             asyncLoop = asyncio.get_running_loop()
+            maxPendingFrames = max(config.Configuration["server_workers"]["max_pending_frames"], 1)
+            framesQueue = asyncio.Queue(maxsize = maxPendingFrames + 1)
+            framesSemaphore = threading.BoundedSemaphore(maxPendingFrames)
 
-            th = threading.Thread(target = __run_in_thread__, daemon = True)
-            th.start()
+            writerTask = asyncio.create_task(__frames_writer__())
+            WriterTasks.add(writerTask)
+            writerTask.add_done_callback(WriterTasks.discard)
+
+            __update_workers_stats__("queued", 1)
+            RequestsPool.submit(__run_in_thread__)
     except Exception as ex:
         logging.error(f"[server] Error while receiving from client ({ex}). The connection will be closed.")
         await Client.Close()
 
-def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dict[str, Any]]:
+def __process_client__(Message: str | bytes, EndPoint: tuple[str, int], Connection: server_utils.Client | None = None) -> Generator[dict[str, Any]]:
     global SERVER_VERSION
 
     try:
-        message = json.loads(Message)
-        messageContent = message["content"]
+        isBinaryMessage = binary_protocol.IsBinaryMessage(Message)
+
+        if (isBinaryMessage):
+            # Protocol v3, the header has the same fields as the text messages and the body is the (encrypted) content
+            message, messageContent = binary_protocol.UnpackMessage(Message)
+        else:
+            message = json.loads(Message)
+            messageContent = message["content"]
+
         messageHash = message["hash"]
         messagePublicKey = message["public_key"]
+        messageSessionKey = message["session_key"] if ("session_key" in message) else None
+        messageUseSession = messageSessionKey is not None or ("session" in message and message["session"])
         clientVersion = message["version"] if ("version" in message) else -1
 
         if (config.Configuration["server_client_version"]["min"] is None):
@@ -294,16 +452,43 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
             }
 
         messageHashParsed = encryption.ParseHash(messageHash)
-        messageContent = encryption.Decrypt(
-            messageHashParsed,
-            PrivateKey,
-            messageContent,
-            config.Configuration["server_encryption"]["encryption_threads"]
-        )
+        session = None
+
+        if (messageUseSession and messageHashParsed is not None):
+            if (Connection is None):
+                raise ValueError("Sessions are not available for this connection.")
+            
+            if (messageSessionKey is not None):
+                # New session, this is the only RSA operation for this connection
+                Connection.Session = encryption.Session(
+                    encryption.UnwrapSessionKey(messageHashParsed, PrivateKey, messageSessionKey),
+                    encryption.SESSION_DIRECTION_SERVER
+                )
+            elif (Connection.Session is None):
+                raise ValueError("Session not established.")
+            
+            session = Connection.Session
+            messageContent = session.DecryptRaw(messageContent) if (isBinaryMessage) else session.Decrypt(messageContent)
+        elif (isBinaryMessage):
+            messageContent = encryption.DecryptRaw(
+                messageHashParsed,
+                PrivateKey,
+                messageContent,
+                config.Configuration["server_encryption"]["encryption_threads"]
+            )
+        else:
+            messageContent = encryption.Decrypt(
+                messageHashParsed,
+                PrivateKey,
+                messageContent,
+                config.Configuration["server_encryption"]["encryption_threads"]
+            )
+        
         gen = None
 
         try:
-            content = json.loads(messageContent)
+            # Raw media of binary messages is converted to base64, the format used by the services
+            content = binary_protocol.Decode(messageContent, True) if (isBinaryMessage) else json.loads(messageContent)
             modelName = content["model_name"]
             service = content["service"] if ("service" in content) else "inference"
             key = content["key"] if ("key" in content) else "nokey"
@@ -334,6 +519,7 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                     "_model": modelName,
                     "_hash": messageHash,
                     "_public_key": messagePublicKey,
+                    "_session": session,
                     "_key_instance": keyInstance
                 }
                 return
@@ -360,8 +546,69 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                         "_model": modelName,
                         "_hash": messageHash,
                         "_public_key": messagePublicKey,
+                        "_session": session,
                         "_key_instance": keyInstance
                     }
+            elif (service == "create_conversation"):
+                if (keyInstance.Key == "nokey"):
+                    raise PermissionError("An API key is required to create conversations.")
+
+                messages = prompt["conversation"] if ("conversation" in prompt) else []
+
+                for msg in messages:
+                    if (isinstance(msg["content"], str)):
+                        msg["content"] = [{"type": "text", "text": msg["content"]}]
+
+                services_manager.CheckBlobsAccess(messages, keyInstance.Key)
+
+                yield {
+                    "conversation_id": services_manager.conversations_manager.Create(keyInstance.Key, messages),
+                    "_hash": messageHash,
+                    "_public_key": messagePublicKey,
+                    "_session": session
+                }
+            elif (service == "delete_conversation"):
+                services_manager.conversations_manager.Delete(prompt["parameters"]["conversation_id"], keyInstance.Key)
+            elif (service == "upload_blob"):
+                if (services_manager.Blobs is None):
+                    raise ValueError("Blobs are disabled in this server.")
+
+                if (keyInstance.Key == "nokey"):
+                    raise PermissionError("An API key is required to upload blobs.")
+
+                blobParams = prompt["parameters"] if ("parameters" in prompt) else {}
+
+                if ("data" in blobParams):
+                    blobHash = services_manager.Blobs.PutBase64(blobParams["data"], keyInstance.Key)
+                elif ("blob" in blobParams and services_manager.Blobs.IsOwner(blobParams["blob"], keyInstance.Key)):
+                    # The client only sends the data if it already uploaded it; other keys must send the data to use the blob
+                    blobHash = blobParams["blob"]
+                else:
+                    blobHash = None
+
+                yield {
+                    "blob": blobHash,
+                    "_hash": messageHash,
+                    "_public_key": messagePublicKey,
+                    "_session": session
+                }
+            elif (service == "fetch_blob"):
+                if (services_manager.Blobs is None):
+                    raise ValueError("Blobs are disabled in this server.")
+
+                if (keyInstance.Key == "nokey"):
+                    raise PermissionError("An API key is required to fetch blobs.")
+
+                if (not services_manager.Blobs.IsOwner(prompt["parameters"]["blob"], keyInstance.Key)):
+                    raise FileNotFoundError("Blob not found.")
+
+                yield {
+                    "blob": prompt["parameters"]["blob"],
+                    "data": services_manager.Blobs.Read(prompt["parameters"]["blob"]) if (isBinaryMessage) else services_manager.Blobs.ReadBase64(prompt["parameters"]["blob"]),
+                    "_hash": messageHash,
+                    "_public_key": messagePublicKey,
+                    "_session": session
+                }
             elif (service == "get_queue_data"):
                 queueData = services_manager.queue.GetQueueForModel(modelName)
 
@@ -370,20 +617,23 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                         "waiting_users": 0,
                         "processing_users": 0,
                         "tps": None,
-                        "fts": None
+                        "fts": None,
+                        "latency": None
                     }
                 else:
                     queueData = {
-                        "waiting_users": len(queueData.__waiting_uids__),
-                        "processing_users": len(queueData.__processing_uids__),
+                        "waiting_users": queueData.GetWaitingCount(),
+                        "processing_users": queueData.GetProcessingCount(),
                         "tps": queueData.TokensPerSecond,
-                        "fts": queueData.FirstTokenSeconds
+                        "fts": queueData.FirstTokenSeconds,
+                        "latency": queueData.GetLatencyStats()
                     }
 
                 yield {
                     "queue": queueData,
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             elif (service == "get_model_info"):
                 modelInfo = services_manager.GetModelConfiguration(modelName)
@@ -391,18 +641,15 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                 yield {
                     "config": modelInfo,
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             elif (service == "get_available_models"):
-                names = []
-
-                for _, modelInfo in services_manager.ServicesModels.items():
-                    names += list(modelInfo.keys())
-                
                 yield {
-                    "models": names,
+                    "models": services_manager.GetAvailableModels(),
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             elif (service == "create_api_key" and keyInstance.IsAdmin()):
                 keyData = prompt["parameters"] if ("parameters" in prompt) else {}
@@ -427,7 +674,8 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                 yield {
                     "key": newKey.Key,
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             elif (service == "delete_api_key" and keyInstance.IsAdmin()):
                 keyToDelete = prompt["parameters"]["key"]
@@ -446,7 +694,8 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                 yield {
                     "key": keyData,
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             elif (service == "ban" and keyInstance.IsAdmin()):
                 banType = prompt["parameters"]["type"]
@@ -458,11 +707,19 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
                 pardonVal = prompt["parameters"]["value"]
 
                 __pardon_user__(pardonType, pardonVal)
+            elif (service == "get_server_stats" and keyInstance.IsAdmin()):
+                yield {
+                    "stats": __get_server_stats__(),
+                    "_hash": messageHash,
+                    "_public_key": messagePublicKey,
+                    "_session": session
+                }
             elif (service == "get_support"):
                 yield {
                     "support": Support,
                     "_hash": messageHash,
-                    "_public_key": messagePublicKey
+                    "_public_key": messagePublicKey,
+                    "_session": session
                 }
             else:
                 raise ValueError("Invalid service.")
@@ -470,18 +727,25 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
             yield {
                 "ended": True,
                 "_hash": messageHash,
-                "_public_key": messagePublicKey
+                "_public_key": messagePublicKey,
+                "_session": session
             }
         except Exception as ex:
             if (gen is not None):
                 gen.close()
 
-            yield {
+            errorToken = {
                 "ended": True,
                 "errors": [f"Error processing message ({ex})."],
                 "_hash": messageHash,
-                "_public_key": messagePublicKey
+                "_public_key": messagePublicKey,
+                "_session": session
             }
+
+            if (isinstance(ex, services_manager.exceptions.ServerBusyException)):
+                errorToken["busy"] = {"retry_after": ex.RetryAfter}
+
+            yield errorToken
     except Exception as ex:
         yield {
             "ended": True,
@@ -491,11 +755,20 @@ def __process_client__(Message: str, EndPoint: tuple[str, int]) -> Generator[dic
         }
 
 def StartServer() -> None:
-    global PrivateKey, PublicKey, Servers, BannedUsers
+    global PrivateKey, PublicKey, Servers, BannedUsers, RequestsPool
     
     if (PrivateKey is None or PublicKey is None):
         PrivateKey, PublicKey = encryption.GenerateRSAKeys()
     
+    if (RequestsPool is None):
+        maxWorkers = config.Configuration["server_workers"]["max_workers"]
+
+        if (maxWorkers is None or maxWorkers <= 0):
+            maxWorkers = min(32, (os.cpu_count() or 1) + 4) * 4
+
+        logging.info(f"[server] Processing requests using {maxWorkers} workers.")
+        RequestsPool = ThreadPoolExecutor(max_workers = maxWorkers, thread_name_prefix = "i4_worker")
+    
     for server in config.Configuration["server_listen"]:
         try:
             if (
@@ -517,7 +790,8 @@ def StartServer() -> None:
                     SSLCertFile = server["ssl_crt"] if ("ssl_crt" in server) else None,
                     SSLKeyFile = server["ssl_key"] if ("ssl_key" in server) else None,
                     SSLPassword = server["ssl_passwd"] if ("ssl_passwd" in server) else None,
-                    BannedIPs = BannedUsers["ips"]
+                    BannedIPs = BannedUsers["ips"],
+                    MaxMessageSize = server["max_message_size"] if ("max_message_size" in server) else None
                 )
                 asyncio.get_event_loop().run_until_complete(server.Start())
 
@@ -532,13 +806,16 @@ def StartServer() -> None:
     logging.info("[server] All servers started!")
 
 def CloseServer() -> None:
-    global CloseServerReason, Servers
+    global CloseServerReason, Servers, RequestsPool
 
     if (CloseServerReason is None):
         CloseServerReason = "Unknown"
     
     for server in Servers:
         asyncio.get_event_loop().run_until_complete(server.Stop())
+    
+    if (RequestsPool is not None):
+        RequestsPool.shutdown(wait = False, cancel_futures = True)
 
     print("Closing server.", flush = True)
     logging.info(f"[server] Closing server with reason '{CloseServerReason}'.")
@@ -582,6 +859,11 @@ if (not os.path.exists(config.Configuration["server_data"]["temp_dir"])):
     os.mkdir(config.Configuration["server_data"]["temp_dir"])
 
 Servers: list[Any] = []
+RequestsPool: ThreadPoolExecutor | None = None
+WriterTasks: set[asyncio.Task] = set()
+WaitTasks: set[asyncio.Task] = set()  # Requests waiting in a queue without using a worker
+WorkersStats: dict[str, int] = {"active": 0, "queued": 0, "pending_frames": 0}
+WorkersStatsLock: threading.Lock = threading.Lock()
 PrivateKey: Any | None = None
 PublicKey: Any | None = None
 CloseServerReason: str | None = None
@@ -650,7 +932,7 @@ if (__name__ == "__main__"):
                         msgFileType = input(">> Unable to get file type. Please specify file type (string) >$ ")
                         
                     with open(msgFilePath, "rb") as f:
-                        msgFiles.append({"type": msgFileType, msgFileType: services_manager.base64.b64encode(f.read()).decode("utf-8")})
+                        msgFiles.append({"type": msgFileType, msgFileType: base64.b64encode(f.read()).decode("utf-8")})
                 
                 infPromptParams = {}
 
@@ -738,6 +1020,9 @@ if (__name__ == "__main__"):
                     )
 
                     for infToken in infGen:
+                        if ("response" not in infToken):
+                            continue
+
                         print(infToken["response"]["text"], end = "", flush = True)
                         
                         infGenFiles += infToken["response"]["files"]
@@ -756,7 +1041,7 @@ if (__name__ == "__main__"):
                         file[file["type"]] = "UNABLE TO CREATE FILE"
                         
                         with open(filePath, "wb") as f:
-                            f.write(services_manager.base64.b64decode(fileData))
+                            f.write(base64.b64decode(fileData))
                         
                         file[file["type"]] = filePath
                 except Exception as ex:
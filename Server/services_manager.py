@@ -1,24 +1,29 @@
 import logging
 from typing import Any, Literal
 from collections.abc import Generator
-from io import BytesIO
-from pydub import AudioSegment
-from PIL import Image as PILImage
-from transformers import AutoTokenizer
 import os
 import gc
 import copy
 import shutil
 import time
+import threading
 import types
+from types import MappingProxyType
 import importlib.util
 import yaml
 import json
-import base64
-import av
+import hashlib
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, Future
 import exceptions
 import keys_manager
+import conversations_manager
 import services_queue as queue
+import Utilities.media_probe as media_probe
+import Utilities.text_encoders as text_encoders
+import Utilities.lru_cache as lru_cache
+import Utilities.response_cache as response_cache
+import Utilities.blob_store as blob_store
 import Utilities.install_requirements as requirements
 
 SERVICES_DIR = "./EnabledModules/"
@@ -37,7 +42,11 @@ SERVICES_CONFIG_FILES = [
     #"default_config.json"
 ]
 Configuration: dict[str, Any] = {}
-TextEncoder: AutoTokenizer | None = None
+PricingCache: lru_cache.LRUCache | None = None
+ResponsesCache: response_cache.ResponseCache | None = None
+FiltersCache: lru_cache.LRUCache | None = None
+Blobs: blob_store.BlobStore | None = None
+FiltersPool: ThreadPoolExecutor | None = None  # Not shared with the requests, which wait for the filters
 ServerVersion: int = 0
 
 class Service():
@@ -160,8 +169,92 @@ class Service():
 ServicesModules: dict[str, Service] = {}  # {"service name": service class}
 ServicesModels: dict[str, dict[str, dict[str, Any]]] = {}  # {"service name": {"model name": model config}}
 
+def __get_public_configuration__(D: dict[str, Any]) -> dict[str, Any]:
+    conf = {}
+
+    for configParamName, configParamValue in D.items():
+        if (
+            configParamName.startswith("_") or
+            configParamName.startswith(".") or
+            configParamName.startswith("_priv_") or
+            configParamName.startswith("_private_")
+        ):
+            continue
+
+        if (isinstance(configParamValue, dict)):
+            conf[configParamName] = __get_public_configuration__(configParamValue)
+            continue
+
+        conf[configParamName] = copy.deepcopy(configParamValue)
+    
+    return conf
+
+def __parse_redirect__(ModelName: str, Conf: dict[str, Any]) -> dict[str, Any] | None:
+    if ("redirect_to" not in Conf):
+        return None
+
+    try:
+        if (isinstance(Conf["redirect_to"], str)):
+            redirectTo = Conf["redirect_to"].split(":")
+
+            if (len(redirectTo) < 4):
+                raise ValueError("Redirection template not valid.")
+
+            redirectType = redirectTo[0] if (len(redirectTo[0].strip()) > 0) else None
+            redirectSecure = bool(int(redirectTo[1].strip()[0])) if (len(redirectTo[1].strip()) > 0) else None
+            redirectHost = redirectTo[2].strip() if (len(redirectTo[2].strip()) > 0) else None
+            redirectPort = int(redirectTo[3].strip()) if (len(redirectTo[3].strip()) > 0) else None
+            redirectModel = "".join(redirectTo[4:])
+        elif (isinstance(Conf["redirect_to"], dict)):
+            redirectTo = Conf["redirect_to"]
+            redirectType = redirectTo["type"] if ("type" in redirectTo and isinstance(redirectTo["type"], str)) else None
+            redirectSecure = redirectTo["secure"] if ("secure" in redirectTo and isinstance(redirectTo["secure"], bool)) else None
+            redirectHost = redirectTo["host"] if ("host" in redirectTo and isinstance(redirectTo["host"], str)) else None
+            redirectPort = redirectTo["port"] if ("port" in redirectTo and isinstance(redirectTo["port"], int)) else None
+            redirectModel = redirectTo["model"] if ("model" in redirectTo and isinstance(redirectTo["model"], str)) else None
+        else:
+            raise ValueError("Redirection type not valid.")
+
+        if (redirectType != "ws" and redirectType != "s" and redirectType != None):
+            raise ValueError("Invalid redirection host type.")
+
+        return {"redirect_to": {"type": redirectType, "secure": redirectSecure, "host": redirectHost, "port": redirectPort, "model": redirectModel}}
+    except Exception as ex:
+        logging.warning(f"[services_manager] Invalid redirection for the model `{ModelName}`. The model will not be redirected. Details: {ex}")
+    
+    return None
+
+class ModelsIndex():
+    # Snapshot of the loaded models, built once when the models are (re)loaded and replaced atomically.
+    # Everything in the snapshot is shared between requests and MUST NOT be modified.
+    def __init__(self, Models: dict[str, dict[str, dict[str, Any]]]) -> None:
+        services = {}
+        configurations = {}
+        publicConfigurations = {}
+        redirects = {}
+
+        for serviceName, models in Models.items():
+            for modelName, modelConfig in models.items():
+                services[modelName] = serviceName
+                configurations[modelName] = modelConfig
+                publicConfigurations[modelName] = __get_public_configuration__(modelConfig)
+                redirects[modelName] = __parse_redirect__(modelName, publicConfigurations[modelName])
+        
+        self.Services: MappingProxyType[str, str] = MappingProxyType(services)  # {"model name": "service name"}
+        self.Configurations: MappingProxyType[str, dict[str, Any]] = MappingProxyType(configurations)
+        self.PublicConfigurations: MappingProxyType[str, dict[str, Any]] = MappingProxyType(publicConfigurations)
+        self.Redirects: MappingProxyType[str, dict[str, Any] | None] = MappingProxyType(redirects)
+        self.Names: tuple[str, ...] = tuple(services.keys())
+
+Index: ModelsIndex = ModelsIndex({})
+
+def __build_index__() -> None:
+    global Index
+    Index = ModelsIndex(ServicesModels)
+
 def __delete_modules_and_info__() -> None:
-    global ServicesModules, ServicesModels
+    global ServicesModules, ServicesModels, Index
+    Index = ModelsIndex({})
 
     if (ServicesModules is not None):
         for _, service in ServicesModules.items():
@@ -282,18 +375,70 @@ def GetServices() -> list[Service]:
     return services
 
 def Init(Conf: dict[str, Any], SvVersion: int) -> None:
-    global Configuration, TextEncoder, ServerVersion
+    global Configuration, ServerVersion, PricingCache, ResponsesCache, FiltersCache, Blobs, FiltersPool
     ServerVersion = SvVersion
 
     Configuration = Conf
     keys_manager.Configuration = Configuration
     keys_manager.Init()
+    blobsConfig = Configuration["server_blobs"] if ("server_blobs" in Configuration) else {}
+
+    if ("enabled" in blobsConfig and blobsConfig["enabled"]):
+        Blobs = blob_store.BlobStore(
+            Directory = os.path.join(Configuration["server_data"]["temp_dir"], "blobs"),
+            MaxBytes = blobsConfig["max_bytes"] if ("max_bytes" in blobsConfig) else None,
+            MaxBlobBytes = blobsConfig["max_blob_bytes"] if ("max_blob_bytes" in blobsConfig) else None
+        )
+    else:
+        Blobs = None
+
+    # Blobs used by stored conversations are pinned while the conversation exists
+    conversations_manager.Configuration = Configuration
+    conversations_manager.OnStore = __pin_conversation_blobs__
+    conversations_manager.OnForget = __unpin_conversation_blobs__
+    conversations_manager.Init()
+
+    if (Blobs is not None):
+        for holder in Blobs.GetPinHolders() - conversations_manager.GetIDs():
+            __unpin_conversation_blobs__(holder)
+
+    queue.Configuration = Configuration
+    text_encoders.Configuration = Configuration  # Encoders are loaded on first use
+
+    pricingCacheConfig = Configuration["server_cache"]["pricing"] if ("server_cache" in Configuration and "pricing" in Configuration["server_cache"]) else {}
+    PricingCache = lru_cache.LRUCache(pricingCacheConfig["max_items"] if ("max_items" in pricingCacheConfig) else 65536) if ("enabled" in pricingCacheConfig and pricingCacheConfig["enabled"]) else None
+
+    if (FiltersPool is None):
+        maxFilterWorkers = Configuration["server_workers"]["max_filter_workers"] if ("server_workers" in Configuration and "max_filter_workers" in Configuration["server_workers"]) else None
+
+        if (maxFilterWorkers is None or maxFilterWorkers <= 0):
+            maxFilterWorkers = min(32, (os.cpu_count() or 1) + 4)
+
+        FiltersPool = ThreadPoolExecutor(max_workers = maxFilterWorkers, thread_name_prefix = "i4_filter")
+
+    filtersCacheConfig = Configuration["server_cache"]["filters"] if ("server_cache" in Configuration and "filters" in Configuration["server_cache"]) else {}
+    FiltersCache = lru_cache.LRUCache(filtersCacheConfig["max_items"] if ("max_items" in filtersCacheConfig) else 65536) if ("enabled" in filtersCacheConfig and filtersCacheConfig["enabled"]) else None
+
+    responsesCacheConfig = Configuration["server_cache"]["responses"] if ("server_cache" in Configuration and "responses" in Configuration["server_cache"]) else {}
+
+    if ("enabled" in responsesCacheConfig and responsesCacheConfig["enabled"]):
+        ResponsesCache = response_cache.ResponseCache(
+            MaxItems = responsesCacheConfig["max_items"] if ("max_items" in responsesCacheConfig) else 1024,
+            MaxBytes = responsesCacheConfig["max_bytes"] if ("max_bytes" in responsesCacheConfig) else None,
+            TTL = responsesCacheConfig["ttl"] if ("ttl" in responsesCacheConfig) else None,
+            Directory = os.path.join(Configuration["server_data"]["temp_dir"], "responses_cache") if ("disk" in responsesCacheConfig and responsesCacheConfig["disk"]) else None,
+            MaxDiskBytes = responsesCacheConfig["max_disk_bytes"] if ("max_disk_bytes" in responsesCacheConfig) else None
+        )
+    else:
+        ResponsesCache = None
 
-    if (TextEncoder is None):
-        TextEncoder = AutoTokenizer.from_pretrained(Configuration["server_encoder"])
 
 def Close() -> None:
     keys_manager.Close()
+    conversations_manager.Close()
+
+    if (FiltersPool is not None):
+        FiltersPool.shutdown(wait = False, cancel_futures = True)
 
 def IsServiceInstalled(Name: str) -> bool:
     for service in GetServices():
@@ -331,42 +476,26 @@ def InstallAllRequirements(Services: list[Service] | None = None, ExtraArgs: lis
 def LoadModels(Models: dict[str, dict[str, Any]]) -> None:
     global ServicesModules, ServicesModels
     __load_modules_and_info__(Models)
+    __build_index__()
     
     for serviceName, service in ServicesModules.items():
         Service.RunModuleFunction(service.ServiceModule, "SERVICE_LOAD_MODELS", [{model: conf for model, conf in ServicesModels[serviceName].items() if ("redirect_to" not in conf)}])
 
 def FindServiceForModel(ModelName: str, ReturnServiceName: bool = False) -> Service | str:
-    global ServicesModules
+    serviceName = Index.Services.get(ModelName)
 
-    for _, servModule in ServicesModules.items():
-        if (servModule.HasModel(ModelName)):
-            return servModule.Name if (ReturnServiceName) else servModule
+    if (serviceName is None):
+        raise RuntimeError("Could not find model in service.")
     
-    raise RuntimeError("Could not find model in service.")
+    return serviceName if (ReturnServiceName) else ServicesModules[serviceName]
 
 def GetModelConfiguration(ModelName: str) -> dict[str, Any]:
-    def get_private_conf(D: dict[str, Any]) -> dict[str, Any]:
-        conf = {}
-
-        for configParamName, configParamValue in D.items():
-            if (
-                configParamName.startswith("_") or
-                configParamName.startswith(".") or
-                configParamName.startswith("_priv_") or
-                configParamName.startswith("_private_")
-            ):
-                continue
-
-            if (isinstance(configParamValue, dict)):
-                conf[configParamName] = get_private_conf(configParamValue)
-                continue
-
-            conf[configParamName] = D[configParamName]
-        
-        return copy.deepcopy(conf)
+    # Public (sanitized) configuration of the model. Shared, must not be modified.
+    FindServiceForModel(ModelName, True)
+    return Index.PublicConfigurations[ModelName]
 
-    global ServicesModels
-    return get_private_conf(ServicesModels[FindServiceForModel(ModelName, True)][ModelName])
+def GetAvailableModels() -> list[str]:
+    return list(Index.Names)
 
 def OffloadModels(Names: list[str]) -> None:
     global ServicesModules, ServicesModels
@@ -384,12 +513,107 @@ def OffloadModels(Names: list[str]) -> None:
     
     gc.collect()
 
-def CalculateTokenPrice(ModelNameOrConfig: str | dict[str, Any], GetOutputPricing: bool, MessageContent: list[dict[str, str]]) -> tuple[float, int]:
-    global TextEncoder
+def CountTextTokens(ModelConfiguration: dict[str, Any], Text: str) -> int:
+    return text_encoders.CountTokens(Text, ModelConfiguration["encoder"] if ("encoder" in ModelConfiguration and ModelConfiguration["encoder"]) else None)
+
+def __is_blob__(Content: dict[str, Any]) -> bool:
+    # {"type": "image", "blob": "sha256"} instead of {"type": "image", "image": "base64"}
+    return Content["type"] not in Content and "blob" in Content
+
+def __get_blobs__() -> blob_store.BlobStore:
+    if (Blobs is None):
+        raise ValueError("Blobs are disabled in this server.")
+    
+    return Blobs
+
+def __open_content_data__(Content: dict[str, Any]) -> contextlib.AbstractContextManager:
+    # Blobs are memory-mapped, inline contents are used as they are
+    if (__is_blob__(Content)):
+        return __get_blobs__().Open(Content["blob"])
+    
+    return contextlib.nullcontext(Content[Content["type"]])
+
+def __get_blob_hashes__(Conversation: list[dict[str, Any]]) -> set[str]:
+    return {
+        content["blob"] for msg in Conversation if (not isinstance(msg["content"], str))
+        for content in msg["content"] if (__is_blob__(content))
+    }
+
+def __pin_conversation_blobs__(ID: str, Messages: list[dict[str, Any]]) -> None:
+    if (Blobs is not None):
+        Blobs.SetPins(ID, __get_blob_hashes__(Messages))
+
+def __unpin_conversation_blobs__(ID: str) -> None:
+    if (Blobs is not None):
+        Blobs.SetPins(ID, set())
+
+def CheckBlobsAccess(Conversation: list[dict[str, Any]], Key: str) -> set[str]:
+    # Returns the blobs of the conversation; blobs of other API keys are treated as if they don't exist
+    blobHashes = __get_blob_hashes__(Conversation)
+
+    if (len(blobHashes) == 0):
+        return blobHashes
 
+    if (Key == "nokey"):
+        raise PermissionError("An API key is required to use blobs.")
+
+    for blobHash in blobHashes:
+        if (not __get_blobs__().IsOwner(blobHash, Key)):
+            raise FileNotFoundError(f"Blob `{blobHash}` not found.")
+
+    return blobHashes
+
+def __resolve_blobs__(Conversation: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # Services receive the contents inline (base64); blobs are only read when a model needs them
+    resolved = []
+    blobsData = {}
+
+    for msg in Conversation:
+        if (isinstance(msg["content"], str) or not any(__is_blob__(content) for content in msg["content"])):
+            resolved.append(msg)
+            continue
+
+        msgContent = []
+
+        for content in msg["content"]:
+            if (__is_blob__(content)):
+                if (content["blob"] not in blobsData):
+                    blobsData[content["blob"]] = __get_blobs__().ReadBase64(content["blob"])
+
+                content = {k: v for k, v in content.items() if (k != "blob")} | {content["type"]: blobsData[content["blob"]]}
+            
+            msgContent.append(content)
+        
+        resolved.append(msg | {"content": msgContent})
+    
+    return resolved
+
+def __content_to_blob__(Content: dict[str, Any], Owner: str) -> dict[str, Any]:
+    if (Content["type"] == "text" or Content["type"] not in Content or not isinstance(Content[Content["type"]], str) or len(Content[Content["type"]]) == 0):
+        return Content
+    
+    return {k: v for k, v in Content.items() if (k != Content["type"])} | {"blob": __get_blobs__().PutBase64(Content[Content["type"]], Owner)}
+
+def __hash_content__(Content: dict[str, Any]) -> bytes:
+    contentHash = hashlib.blake2b(Content["type"].encode("utf-8"), digest_size = 16)
+
+    if (__is_blob__(Content)):
+        contentHash.update(b"blob:" + Content["blob"].encode("utf-8"))
+        return contentHash.digest()
+
+    contentData = Content[Content["type"]]
+
+    if (isinstance(contentData, str)):
+        contentHash.update(contentData.encode("utf-8"))
+    else:
+        contentHash.update(json.dumps(contentData, sort_keys = True).encode("utf-8"))
+    
+    return contentHash.digest()
+
+def CalculateTokenPrice(ModelNameOrConfig: str | dict[str, Any], GetOutputPricing: bool, MessageContent: list[dict[str, str]], UseCache: bool = False) -> tuple[float, int]:
     if (isinstance(ModelNameOrConfig, str)):
-        serviceName = FindServiceForModel(ModelNameOrConfig, True)
-        modelConfiguration = ServicesModels[serviceName][ModelNameOrConfig]
+        FindServiceForModel(ModelNameOrConfig, True)
+        modelConfiguration = Index.Configurations[ModelNameOrConfig]
     else:
         modelConfiguration = ModelNameOrConfig
     
@@ -421,72 +645,138 @@ def CalculateTokenPrice(ModelNameOrConfig: str | dict[str, Any], GetOutputPricin
         videoPriceR = modelPricing["video_input_r"] if ("video_input_r" in modelPricing) else 0
         otherPrice = modelPricing["other_input"] if ("other_input" in modelPricing) else 0
     
-    msgContent = copy.deepcopy(MessageContent)
+    mediaConfig = Configuration["server_media"] if ("server_media" in Configuration) else {}
+    mediaLimits = (
+        mediaConfig["max_probe_bytes"] if ("max_probe_bytes" in mediaConfig) else None,
+        mediaConfig["max_decoded_bytes"] if ("max_decoded_bytes" in mediaConfig) else None
+    )
+    maxImagePixels = mediaConfig["max_image_pixels"] if ("max_image_pixels" in mediaConfig) else None
+
+    if (UseCache and PricingCache is not None):
+        # The price of a content only depends on its data, the pricing table and the encoder
+        cacheKey = (GetOutputPricing, json.dumps(modelPricing, sort_keys = True), modelConfiguration["encoder"] if ("encoder" in modelConfiguration) else None)
+    else:
+        cacheKey = None
     
-    for content in msgContent:
-        if (len(content[content["type"]]) == 0):
-            continue
-
-        if (content["type"] == "text"):
-            txtTokens = len(TextEncoder.encode(content["text"]))
+    for content in MessageContent:
+        isBlob = __is_blob__(content)
 
-            price += txtTokens * textPrice / 1000000.0
-            totalTokens += txtTokens
-        elif (content["type"] == "image"):
-            imgBuffer = BytesIO(base64.b64decode(content["image"]))
-            img = PILImage.open(imgBuffer)
-            price += (img.size[0] / 1024) * (img.size[1] / 1024) * imagePrice
+        if (not isBlob and len(content[content["type"]]) == 0):
+            continue
 
-            img.close()
-            imgBuffer.close()
-        elif (content["type"] == "audio"):
-            audioBuffer = BytesIO(base64.b64decode(content["audio"]))
+        if (cacheKey is not None):
+            contentKey = (cacheKey, __hash_content__(content))
+            cachedPrice = PricingCache.Get(contentKey)
 
-            audio = AudioSegment.from_file(audioBuffer)
-            durationInSeconds = len(audio) / 1000
+            if (cachedPrice is not None):
+                price += cachedPrice[0]
+                totalTokens += cachedPrice[1]
+                continue
 
-            price += durationInSeconds * audioPrice
-            totalTokens += 1
+            priceBefore = price
+            tokensBefore = totalTokens
 
-            audioBuffer.close()
-        elif (content["type"] == "video"):
-            videoBuffer = BytesIO(base64.b64decode(content["video"]))
+        with __open_content_data__(content) as contentData:
+            # Other contents are priced by their base64 size, also when they are blobs
+            otherSize = (len(contentData) + 2) // 3 * 4 if (isBlob) else len(str(contentData))
 
-            try:
-                reader = av.open(videoBuffer)
-                stream = next(s for s in reader.streams if (s.type == "video"))
+            if (content["type"] == "text"):
+                txtTokens = CountTextTokens(modelConfiguration, contentData[:].decode("utf-8") if (isBlob) else contentData)
 
-                fps = float(stream.average_rate) if (stream.average_rate) else 0
-                numberOfFrames = stream.frames
-                durationInSeconds = float(reader.duration / av.time_base) if (reader.duration) else (numberOfFrames / fps if (fps) else 0)
+                price += txtTokens * textPrice / 1000000.0
+                totalTokens += txtTokens
+            elif (content["type"] == "image"):
+                width, height = media_probe.ProbeImage(contentData, *mediaLimits, MaxPixels = maxImagePixels)
+                price += (width / 1024) * (height / 1024) * imagePrice
+            elif (content["type"] == "audio"):
+                durationInSeconds = media_probe.ProbeAudioDuration(contentData, *mediaLimits)
 
-                width = stream.width
-                height = stream.height
+                price += durationInSeconds * audioPrice
+                totalTokens += 1
+            elif (content["type"] == "video"):
+                try:
+                    durationInSeconds, width, height = media_probe.ProbeVideo(contentData, *mediaLimits)
+                except exceptions.MediaTooLargeException:
+                    raise
+                except Exception as ex:
+                    raise RuntimeError(f"Could not calculate pricing for video. Reason: {ex}")
 
                 price += (durationInSeconds * videoPriceS) + ((width / 1024) * (height / 1024) * videoPriceR)
                 totalTokens += 1
-
-                reader.close()
-                videoBuffer.close()
-            except Exception as ex:
-                videoBuffer.close()
-                raise RuntimeError(f"Could not calculate pricing for video. Reason: {ex}")
-        elif (isinstance(otherPrice, float) or isinstance(otherPrice, int)):
-            price += len(str(content[content["type"]])) / 1048576 * otherPrice
-            totalTokens += 1
-        elif (isinstance(otherPrice, dict)):
-            if (content["type"] in otherPrice):
-                price += len(str(content[content["type"]])) / 1048576 * otherPrice[content["type"]]
+            elif (isinstance(otherPrice, float) or isinstance(otherPrice, int)):
+                price += otherSize / 1048576 * otherPrice
+                totalTokens += 1
+            elif (isinstance(otherPrice, dict)):
+                if (content["type"] in otherPrice):
+                    price += otherSize / 1048576 * otherPrice[content["type"]]
+                else:
+                    price += otherSize / 1048576 * otherPrice["global"]
+                
+                totalTokens += 1
             else:
-                price += len(str(content[content["type"]])) / 1048576 * otherPrice["global"]
-            
-            totalTokens += 1
-        else:
-            raise ValueError("Invalid content type or pricing.")
+                raise ValueError("Invalid content type or pricing.")
+        
+        if (cacheKey is not None):
+            PricingCache.Set(contentKey, (price - priceBefore, totalTokens - tokensBefore))
     
-    msgContent = None
     return (price, totalTokens)
 
+OUTPUT_TOKENIZATION_BATCH_BYTES = 512
+
+class OutputTokensCounter():
+    # Streaming accounting of the output of a model.
+    # Text is tokenized in batches instead of per token; between batches, the budget is checked using an upper bound of the tokens (1 token per byte at most).
+    def __init__(self, ModelConfiguration: dict[str, Any], TokensBudget: float) -> None:
+        if ("pricing" in ModelConfiguration):
+            modelPricing = ModelConfiguration["pricing"]
+        elif ("price" in ModelConfiguration):
+            modelPricing = ModelConfiguration["price"]
+        else:
+            modelPricing = {}
+
+        self.MODEL_CONFIGURATION = ModelConfiguration
+        self.TOKENS_BUDGET = TokensBudget
+        self.TEXT_PRICE = modelPricing["text_output"] if ("text_output" in modelPricing) else 0
+        self.Price = 0
+        self.Tokens = 0
+        self.__pending_text__ = []
+        self.__pending_bytes__ = 0
+    
+    def Add(self, Text: str, Files: list[dict[str, Any]], Usage: dict[str, Any] | None = None) -> None:
+        if (len(Files) > 0):
+            filesPriceData = CalculateTokenPrice(self.MODEL_CONFIGURATION, True, Files)
+
+            self.Price += filesPriceData[0]
+            self.Tokens += filesPriceData[1]
+
+        if (Usage is not None and "output_tokens" in Usage):
+            # Counted by the service, no need to tokenize
+            self.Price += Usage["output_tokens"] * self.TEXT_PRICE / 1000000.0
+            self.Tokens += Usage["output_tokens"]
+        elif (len(Text) > 0):
+            self.__pending_text__.append(Text)
+            self.__pending_bytes__ += len(Text.encode("utf-8"))
+
+            if (self.__pending_bytes__ >= OUTPUT_TOKENIZATION_BATCH_BYTES):
+                self.Flush()
+        
+        if (self.Price + self.__pending_bytes__ * self.TEXT_PRICE / 1000000.0 > self.TOKENS_BUDGET):
+            self.Flush()
+
+            if (self.Price > self.TOKENS_BUDGET):
+                raise exceptions.NotEnoughTokensException(self.Price, self.TOKENS_BUDGET)
+    
+    def Flush(self) -> None:
+        if (len(self.__pending_text__) == 0):
+            return
+        
+        txtTokens = CountTextTokens(self.MODEL_CONFIGURATION, "".join(self.__pending_text__))
+
+        self.Price += txtTokens * self.TEXT_PRICE / 1000000.0
+        self.Tokens += txtTokens
+        self.__pending_text__ = []
+        self.__pending_bytes__ = 0
+
 def ExecuteFilter(
     Type: Literal["text", "image", "audio", "video"],
     Conversation: list[dict[str, str | dict[str, str]]]
@@ -512,7 +802,66 @@ def ExecuteFilter(
     except Exception as ex:
         raise RuntimeError(f"Could not find filter service. Details: {ex}")
 
-    filterQueue = queue.GetQueueForModel(filterModel)
+    # Only the contents that were not filtered before are sent to the filter model
+    verdictKey = (Type, filterModel, filterKeyword, filterThreshold)
+    unseenConversation = []
+    unseenHashes = []
+
+    for msg in Conversation:
+        if (isinstance(msg["content"], str)):
+            msgContent = [{"type": "text", "text": msg["content"]}]
+        else:
+            msgContent = msg["content"]
+        
+        unseenContent = []
+
+        for content in msgContent:
+            if (content["type"] != Type or (not __is_blob__(content) and len(content[Type]) == 0)):
+                continue
+
+            contentHash = __hash_content__(content)
+
+            if (FiltersCache is not None and FiltersCache.Get((verdictKey, contentHash)) is not None):
+                continue
+
+            unseenContent.append(content)
+            unseenHashes.append(contentHash)
+        
+        if (len(unseenContent) > 0):
+            unseenConversation.append({"role": msg["role"], "content": unseenContent})
+    
+    if (len(unseenConversation) == 0):
+        yield {"_action": "none"}
+        return
+    
+    if (Type == "video"):
+        # Videos are filtered by sending some of their frames to the image classifier (all of them as a single batch)
+        mediaConfig = Configuration["server_media"] if ("server_media" in Configuration) else {}
+        framesConversation = []
+
+        for msg in unseenConversation:
+            framesContent = []
+
+            for content in msg["content"]:
+                try:
+                    with __open_content_data__(content) as videoData:
+                        frames = media_probe.ExtractVideoFrames(
+                            Data = videoData,
+                            Count = filterConfig["frames"] if ("frames" in filterConfig) else 8,
+                            KeyframesOnly = filterConfig["keyframes_only"] if ("keyframes_only" in filterConfig) else True,
+                            MaxSize = filterConfig["frame_size"] if ("frame_size" in filterConfig) else 224,
+                            MaxReadBytes = mediaConfig["max_decoded_bytes"] if ("max_decoded_bytes" in mediaConfig) else None
+                        )
+                except Exception as ex:
+                    raise RuntimeError(f"Could not read the frames of the video to filter it. Reason: {ex}")
+                
+                framesContent += [{"type": "image", "image": frame} for frame in frames]
+            
+            if (len(framesContent) > 0):
+                framesConversation.append({"role": msg["role"], "content": framesContent})
+        
+        unseenConversation = framesConversation
+
     filterModelConfig = GetModelConfiguration(filterModel)
 
     if ("max_simul_users" in filterModelConfig and filterModelConfig["max_simul_users"] > 0):
@@ -521,74 +870,254 @@ def ExecuteFilter(
         logging.info("[services_manager] Max simultaneously users not set in model configuration. Setting to 1.")
         maxSimulUsers = 1
 
-    if (filterQueue is None):
-        filterQueue = queue.Queue(ModelName = filterModel, MaxSimultaneousUsers = maxSimulUsers)
-        queue.Queues.append(filterQueue)
-    
+    filterQueue = queue.GetOrCreateQueue(ModelName = filterModel, MaxSimultaneousUsers = maxSimulUsers)
     filterQueueUID = filterQueue.CreateNewWaitingID(Prioritize = True)  # Wait with priority for faster inference
-    yield {"_queue_uid": filterQueueUID}
-
-    filterQueue.WaitForProcessing(filterQueueUID)
     isSafe = True
 
-    for filterToken in filterModule.RunModuleFunction(
-        filterModule.ServiceModule,
-        "SERVICE_INFERENCE",
-        [
-            filterModel,
-            filterPP,
-            filterUP | {
-                "conversation": copy.deepcopy(Conversation)
-            }
-        ]
-    ):
-        if ("extra" not in filterToken or "label" not in filterToken["extra"] or "confidence" not in filterToken["extra"]):
-            continue
+    try:
+        yield {"_queue_uid": filterQueueUID}
+        filterQueue.WaitForProcessing(filterQueueUID)
+
+        for filterToken in filterModule.RunModuleFunction(
+            filterModule.ServiceModule,
+            "SERVICE_INFERENCE",
+            [
+                filterModel,
+                filterPP,
+                filterUP | {
+                    "conversation": unseenConversation if (Type == "video") else copy.deepcopy(__resolve_blobs__(unseenConversation))
+                }
+            ]
+        ):
+            if ("extra" not in filterToken or "label" not in filterToken["extra"] or "confidence" not in filterToken["extra"]):
+                continue
 
-        label = filterToken["extra"]["label"]
-        confidence = filterToken["extra"]["confidence"] * 100
+            label = filterToken["extra"]["label"]
+            confidence = filterToken["extra"]["confidence"] * 100
 
-        if (label == filterKeyword and confidence >= filterThreshold):
-            isSafe = False
-            break
+            if (label == filterKeyword and confidence >= filterThreshold):
+                isSafe = False
+                break
+    finally:
+        filterQueue.DeleteUID(filterQueueUID)
     
-    filterQueue.DeleteUID(filterQueueUID)
+    if (isSafe and FiltersCache is not None):
+        # Only safe verdicts are saved; an unsafe verdict can't be attributed to a single content
+        for contentHash in unseenHashes:
+            FiltersCache.Set((verdictKey, contentHash), True)
+
     yield {"_action": "none" if (isSafe) else filterAction}
 
+class FiltersExecution():
+    # Runs the filters of every type at the same time in the filters pool
+    def __init__(self, Types: list[str], Conversation: list[dict[str, Any]]) -> None:
+        self.__condition__ = threading.Condition()
+        self.__pending__ = len(Types)
+        self.__action__: str | None = None
+        self.__error__: Exception | None = None
+        self.__cancelled__ = False
+        self.__futures__: list[Future] = []
+
+        for filterType in Types:
+            self.__futures__.append(FiltersPool.submit(self.__run__, filterType, Conversation))
+    
+    def __run__(self, Type: str, Conversation: list[dict[str, Any]]) -> None:
+        action = "none"
+        error = None
+
+        try:
+            for filterToken in ExecuteFilter(Type, Conversation):
+                if (self.__cancelled__):
+                    break
+
+                if ("_action" in filterToken):
+                    action = filterToken["_action"]
+        except Exception as ex:
+            error = ex
+        
+        with self.__condition__:
+            self.__pending__ -= 1
+
+            if (error is not None and self.__error__ is None):
+                self.__error__ = error
+            
+            if (action != "none" and self.__action__ is None):
+                self.__action__ = action
+            
+            self.__condition__.notify_all()
+    
+    def GetAction(self, Timeout: float | None = None) -> str | None:
+        # Action of the first filter that flagged the conversation, "none" if all of them passed, or None if they are still running
+        with self.__condition__:
+            self.__condition__.wait_for(lambda: self.__action__ is not None or self.__error__ is not None or self.__pending__ <= 0, Timeout)
+
+            if (self.__action__ is not None):
+                return self.__action__
+            
+            if (self.__error__ is not None):
+                raise self.__error__
+            
+            return "none" if (self.__pending__ <= 0) else None
+    
+    def Cancel(self) -> None:
+        # Filters that didn't start are not run, the running ones stop at their next token
+        self.__cancelled__ = True
+
+        for future in self.__futures__:
+            future.cancel()
+
+def __release_held_tokens__(
+    Filters: FiltersExecution,
+    HeldTokens: list[tuple[dict[str, Any], dict[str, Any] | None]],
+    OutputCounter: OutputTokensCounter,
+    Timeout: float | None
+) -> Generator[dict[str, Any], None, bool | None]:
+    # Returns True when the held tokens were sent, False if the conversation was flagged, or None if the filters are still running
+    filterAction = Filters.GetAction(Timeout)
+
+    if (filterAction is None):
+        return None
+    
+    yield {"_filter_action": filterAction}
+
+    if (filterAction != "none"):
+        return False
+    
+    for outputToken, usage in HeldTokens:
+        # Held tokens are charged when they are sent
+        OutputCounter.Add(outputToken["response"]["text"], outputToken["response"]["files"], usage)
+        yield outputToken
+    
+    return True
+
 def ModelRedirectTo(ModelName: str) -> dict[str, Any] | None:
-    try:
-        conf = GetModelConfiguration(ModelName = ModelName)
-
-        if ("redirect_to" in conf):
-            if (isinstance(conf["redirect_to"], str)):
-                redirectTo = conf["redirect_to"].split(":")
-
-                if (len(redirectTo) < 4):
-                    raise ValueError("Redirection template not valid.")
-
-                redirectType = redirectTo[0] if (len(redirectTo[0].strip()) > 0) else None
-                redirectSecure = bool(int(redirectTo[1].strip()[0])) if (len(redirectTo[1].strip()) > 0) else None
-                redirectHost = redirectTo[2].strip() if (len(redirectTo[2].strip()) > 0) else None
-                redirectPort = int(redirectTo[3].strip()) if (len(redirectTo[3].strip()) > 0) else None
-                redirectModel = "".join(redirectTo[4:])
-            elif (isinstance(conf["redirect_to"], dict)):
-                redirectTo = conf["redirect_to"]
-                redirectType = redirectTo["type"] if ("type" in redirectTo and isinstance(redirectTo["type"], str)) else None
-                redirectSecure = redirectTo["secure"] if ("secure" in redirectTo and isinstance(redirectTo["secure"], bool)) else None
-                redirectHost = redirectTo["host"] if ("host" in redirectTo and isinstance(redirectTo["host"], str)) else None
-                redirectPort = redirectTo["port"] if ("port" in redirectTo and isinstance(redirectTo["port"], int)) else None
-                redirectModel = redirectTo["model"] if ("model" in redirectTo and isinstance(redirectTo["model"], str)) else None
-            else:
-                raise ValueError("Redirection type not valid.")
+    return Index.Redirects.get(ModelName)
 
-            if (redirectType != "ws" and redirectType != "s" and redirectType != None):
-                raise ValueError("Invalid redirection host type.")
+def __run_inference__(
+    ServiceInstance: Service,
+    ModelName: str,
+    ModelConfiguration: dict[str, Any],
+    UserConfig: dict[str, Any],
+    UserParameters: dict[str, Any]
+) -> Generator[dict[str, Any]]:
+    maxBatchSize = ModelConfiguration["max_batch_size"] if ("max_batch_size" in ModelConfiguration) else 1
 
-            return {"redirect_to": {"type": redirectType, "secure": redirectSecure, "host": redirectHost, "port": redirectPort, "model": redirectModel}}
-    except:
-        pass
+    if (maxBatchSize <= 1 or not Service.ModuleContainsFunction(ServiceInstance.ServiceModule, "SERVICE_INFERENCE_BATCH")):
+        return Service.RunModuleFunction(ServiceInstance.ServiceModule, "SERVICE_INFERENCE", [ModelName, UserConfig, UserParameters])
     
-    return None
+    def __run_batch__(Payloads: list[tuple[dict[str, Any], dict[str, Any]]]) -> Generator[tuple[int, dict[str, Any]]]:
+        return Service.RunModuleFunction(ServiceInstance.ServiceModule, "SERVICE_INFERENCE_BATCH", [
+            ModelName,
+            [payload[0] for payload in Payloads],
+            [payload[1] for payload in Payloads]
+        ])
+    
+    batcher = queue.GetOrCreateBatcher(
+        ModelName = ModelName,
+        MaxBatchSize = maxBatchSize,
+        WindowSeconds = ModelConfiguration["batch_window_seconds"] if ("batch_window_seconds" in ModelConfiguration) else 0.01,
+        RunBatch = __run_batch__,
+        Source = ServiceInstance.ServiceModule
+    )
+    return batcher.Submit((UserConfig, UserParameters))
+
+REQUEST_KEY_IGNORED_PARAMETERS = [
+    # User parameters used by the server only, they don't change the response of the model
+    "key_info",
+    "tokens_budget",
+    "conversation_id",
+    "queue_updates_interval",
+    "delta_result",
+    "files_as_blobs"
+]
+
+def GetRequestKey(ModelName: str, UserConfig: dict[str, Any], UserParameters: dict[str, Any], Conversation: list[dict[str, Any]]) -> str:
+    # Identical requests (same model, parameters and conversation) get the same key
+    requestHash = hashlib.sha256(ModelName.encode("utf-8"))
+    requestHash.update(json.dumps({k: v for k, v in UserConfig.items() if (v is not None)}, sort_keys = True).encode("utf-8"))
+    requestHash.update(json.dumps({
+        k: v for k, v in UserParameters.items() if (not k.startswith("_") and k not in REQUEST_KEY_IGNORED_PARAMETERS and v is not None)
+    }, sort_keys = True, default = str).encode("utf-8"))
+    requestHash.update(json.dumps(Conversation, sort_keys = True).encode("utf-8"))
+
+    return requestHash.hexdigest()
+
+def GetConversationHash(Conversation: list[dict[str, Any]]) -> str:
+    # Lets the clients that only receive the new messages check that their conversation is the same as the server's
+    return hashlib.sha256(json.dumps(Conversation, sort_keys = True, separators = (",", ":")).encode("utf-8")).hexdigest()
+
+def __wait_for_queue__(
+    ModelQueue: queue.Queue,
+    QueueUID: int,
+    MaxWaitSeconds: float | None,
+    QueueUpdatesInterval: float | None
+) -> Generator[dict[str, Any], None, float]:
+    # Yields the queue position updates; returns the time when the processing started
+    queueWaitStart = time.time()
+    lastQueueUpdate = None
+    waitTimeout = 0 if (QueueUpdatesInterval is not None) else None
+
+    while (True):
+        if (MaxWaitSeconds is not None):
+            remainingSeconds = MaxWaitSeconds - (time.time() - queueWaitStart)
+
+            if (remainingSeconds <= 0):
+                raise exceptions.ServerBusyException(ModelQueue.EstimateWaitSeconds(ModelQueue.GetUsersBeforeUID(QueueUID)))
+            
+            waitTimeout = remainingSeconds if (waitTimeout is None) else min(waitTimeout, remainingSeconds)
+
+        if (ModelQueue.WaitForProcessing(QueueUID, 0)):
+            return time.time()
+        
+        if (waitTimeout is None or waitTimeout > 0):
+            # The caller can wait without blocking its thread
+            wait = ModelQueue.CreateWait(QueueUID, waitTimeout)
+            yield {"_wait": wait}
+
+            if (ModelQueue.WaitForProcessing(QueueUID, 0 if (wait.Waited) else waitTimeout)):
+                return time.time()
+
+        if (QueueUpdatesInterval is not None):
+            # Send the position only when it changes
+            queuePosition = ModelQueue.GetUsersBeforeUID(QueueUID)
+            queueUpdate = (queuePosition, ModelQueue.EstimateWaitSeconds(queuePosition))
+
+            if (queueUpdate != lastQueueUpdate):
+                lastQueueUpdate = queueUpdate
+                yield {
+                    "queue_position": queueUpdate[0],
+                    "eta_seconds": queueUpdate[1],
+                    "_queue_uid": QueueUID
+                }
+        
+        waitTimeout = QueueUpdatesInterval
+
+def __wait_for_flight__(FlightInstance: queue.Flight, QueueUpdatesInterval: float | None) -> Generator[dict[str, Any], None, bool]:
+    # Yields the queue position of the identical request; returns if its inference started
+    lastQueueUpdate = None
+
+    while (True):
+        started = FlightInstance.WaitForStart(0)
+
+        if (started is None):
+            wait = queue.Wait(FlightInstance.AddStartCallback, FlightInstance.RemoveStartCallback, QueueUpdatesInterval)
+            yield {"_wait": wait}
+
+            started = FlightInstance.WaitForStart(0 if (wait.Waited) else QueueUpdatesInterval)
+
+        if (started is not None):
+            return started
+        
+        if (FlightInstance.ModelQueue is not None and FlightInstance.QueueUID is not None):
+            queuePosition = FlightInstance.ModelQueue.GetUsersBeforeUID(FlightInstance.QueueUID)
+            queueUpdate = (queuePosition, FlightInstance.ModelQueue.EstimateWaitSeconds(queuePosition))
+
+            if (queuePosition >= 0 and queueUpdate != lastQueueUpdate):
+                lastQueueUpdate = queueUpdate
+                yield {
+                    "queue_position": queueUpdate[0],
+                    "eta_seconds": queueUpdate[1]
+                }
 
 def InferenceModel(
     ModelName: str,
@@ -608,15 +1137,21 @@ def InferenceModel(
         initialTokensBudget = UserParameters["key_info"]["Tokens"]
     
     tokensBudget = initialTokensBudget
-    tokensProcessingTime = None
-    serviceName = FindServiceForModel(ModelName, True)
-    
-    if (ModelName not in ServicesModels[serviceName]):
-        raise ValueError("Model name not found.")
+    modelQueue = None
+    queueUID = None
+    releaseQueueUID = True
+    flight = None
+    isFlightLeader = False
+    tokensSource = None
+    outputCounter = None
+    conversationID = UserParameters["conversation_id"] if ("conversation_id" in UserParameters) else None
+    storedMessages = None
+    referencedBlobs = []
+    filtersExecution = None
+    serviceModule = FindServiceForModel(ModelName, False)
 
     try:
-        modelConfiguration = ServicesModels[serviceName][ModelName]
-        serviceModule = ServicesModules[serviceName]
+        modelConfiguration = Index.Configurations[ModelName]
 
         if ("max_simul_users" in modelConfiguration and modelConfiguration["max_simul_users"] > 0):
             maxSimulUsers = modelConfiguration["max_simul_users"]
@@ -624,26 +1159,33 @@ def InferenceModel(
             logging.info("[services_manager] Max simultaneously users not set in model configuration. Setting to 1.")
             maxSimulUsers = 1
 
-        modelQueue = queue.GetQueueForModel(ModelName)
+        # Admission check; requests that can't be afforded never take a queue position
+        conversation = Prompt["conversation"] if ("conversation" in Prompt) else []
+        userConfig = Prompt["parameters"] if ("parameters" in Prompt) else {}
 
-        if (modelQueue is None):
-            modelQueue = queue.Queue(ModelName = ModelName, MaxSimultaneousUsers = maxSimulUsers)
-            queue.Queues.append(modelQueue)
+        if (conversationID is not None):
+            # Server-side conversation; the client only sends the new messages
+            storedMessages = conversations_manager.Acquire(conversationID, UserParameters["key_info"]["Key"])
+            maxMessages = conversations_manager.GetMaxMessages()
 
-        queueUID = modelQueue.CreateNewWaitingID(Prioritize = ModelName in UserParameters["key_info"]["PrioritizeModels"])
-        modelQueue.WaitForProcessing(queueUID)
+            if (maxMessages is not None and len(storedMessages) + len(conversation) + 1 > maxMessages):
+                raise exceptions.QuotaExceededException(f"The conversation can't have more than {maxMessages} messages.")
+
+            conversation = storedMessages + conversation
+
+        # The blobs of the conversation can't be evicted until the request ends
+        for blobHash in CheckBlobsAccess(conversation, UserParameters["key_info"]["Key"]):
+            __get_blobs__().AddReference(blobHash)
+            referencedBlobs.append(blobHash)
 
-        conversation = Prompt["conversation"] if ("conversation" in Prompt) else []
-        userConfig = Prompt["parameters"] if ("parameters" in Prompt) else {}
         price = 0
         inputTokens = 0
-        outputTokens = 0
 
         for msg in conversation:
             if (isinstance(msg["content"], str)):
                 msg["content"] = [{"type": "text", "text": msg["content"]}]
             
-            tokensPriceData = CalculateTokenPrice(modelConfiguration, False, msg["content"])
+            tokensPriceData = CalculateTokenPrice(modelConfiguration, False, msg["content"], True)
 
             price += tokensPriceData[0]
             inputTokens += tokensPriceData[1]
@@ -651,11 +1193,48 @@ def InferenceModel(
         if (tokensBudget < price):
             raise exceptions.NotEnoughTokensException(price, tokensBudget)
         
+        if ("max_input_tokens" in modelConfiguration and modelConfiguration["max_input_tokens"] is not None and modelConfiguration["max_input_tokens"] > 0 and inputTokens > modelConfiguration["max_input_tokens"]):
+            raise exceptions.PromptTooLongException(inputTokens, modelConfiguration["max_input_tokens"])
+
+        cacheResponse = ResponsesCache is not None and "cache_responses" in modelConfiguration and modelConfiguration["cache_responses"]
+        coalesceRequests = "coalesce_requests" in modelConfiguration and modelConfiguration["coalesce_requests"]
+        requestKey = GetRequestKey(ModelName, userConfig, UserParameters, conversation) if (cacheResponse or coalesceRequests) else None
+        cachedTokens = ResponsesCache.Get(requestKey) if (cacheResponse) else None
+        queueUpdatesInterval = queue.GetQueueUpdatesInterval(UserParameters["queue_updates_interval"] if ("queue_updates_interval" in UserParameters) else None)
+
+        if (cachedTokens is None and coalesceRequests):
+            flight, isFlightLeader = queue.JoinFlight(requestKey)
+
+            if (not isFlightLeader and not (yield from __wait_for_flight__(flight, queueUpdatesInterval))):
+                # The identical request could not run; run this one on its own
+                flight.Leave()
+                flight = None
+
+        if (cachedTokens is None and (flight is None or isFlightLeader)):
+            modelQueue = queue.GetOrCreateQueue(ModelName = ModelName, MaxSimultaneousUsers = maxSimulUsers)
+            maxWaitSeconds = modelConfiguration["max_wait_seconds"] if ("max_wait_seconds" in modelConfiguration and modelConfiguration["max_wait_seconds"] is not None and modelConfiguration["max_wait_seconds"] > 0) else None
+
+            queueTenant, queueWeight = queue.GetFairShare(UserParameters["key_info"])
+            queueUID = modelQueue.CreateNewWaitingID(
+                Prioritize = ModelName in UserParameters["key_info"]["PrioritizeModels"],
+                Tenant = queueTenant,
+                Weight = queueWeight,
+                MaxQueueLength = modelConfiguration["max_queue_length"] if ("max_queue_length" in modelConfiguration) else None,
+                MaxWaitSeconds = maxWaitSeconds
+            )
+
+            if (flight is not None):
+                flight.ModelQueue = modelQueue
+                flight.QueueUID = queueUID
+
+            processingStart = yield from __wait_for_queue__(modelQueue, queueUID, maxWaitSeconds, queueUpdatesInterval)
+
+        # Queue wait finished, charge the input price
         tokensBudget -= price
 
         if (Configuration["server_automatic_blacklist"]["enabled"]):
             if ("enable_filter" in modelConfiguration and isinstance(modelConfiguration["enable_filter"], list)):
-                filterTypes = modelConfiguration["enable_filter"]
+                filterTypes = list(modelConfiguration["enable_filter"])  # The configuration is shared, don't modify it
             elif ("enable_filter" in modelConfiguration and isinstance(modelConfiguration["enable_filter"], bool) and not modelConfiguration["enable_filter"]):
                 filterTypes = []
             else:
@@ -675,35 +1254,73 @@ def InferenceModel(
         else:
             filterTypes = []
         
-        for filterType in filterTypes:
-            for filterToken in ExecuteFilter(filterType, conversation):
-                if ("_queue_uid" in filterToken):
-                    yield {"_queue_uid": [filterToken["_queue_uid"], queueUID]}
-                
-                if ("_action" in filterToken):
-                    yield {"_filter_action": filterToken["_action"]}
+        filtersExecution = FiltersExecution(filterTypes, list(conversation))
 
+        if (len(filterTypes) > 0 and "speculative" in Configuration["server_automatic_blacklist"] and Configuration["server_automatic_blacklist"]["speculative"]):
+            # Speculative mode, the inference starts now and the tokens are held until the filters finish
+            heldTokens = []
+        else:
+            heldTokens = None
+
+            if (len(filterTypes) > 0):
+                filterAction = filtersExecution.GetAction()
+                yield {"_filter_action": filterAction}
+
+                if (filterAction != "none"):
+                    return
+
+        outputCounter = OutputTokensCounter(modelConfiguration, tokensBudget)
         firstToken = True
         lastTokenTime = time.time()
-        convResultTxt = None
+        convResultTxt = None  # Joined once at the end
         convResultFiles = []
         saveResponse = True
+        filesAsBlobs = "files_as_blobs" in UserParameters and UserParameters["files_as_blobs"]
+
+        if (filesAsBlobs):
+            __get_blobs__()  # Fail before the inference if blobs are disabled
+
+            if (UserParameters["key_info"]["Key"] == "nokey"):
+                raise PermissionError("An API key is required to use blobs.")
+
+        if (cachedTokens is not None):
+            # Cached responses are priced and sent like a new response
+            tokensSource = iter(cachedTokens)
+            responseTokens = None
+        elif (flight is not None and not isFlightLeader):
+            # Receive the tokens of the identical request; priced separately
+            tokensSource = flight.Follow()
+            responseTokens = None
+        else:
+            tokensSource = __run_inference__(serviceModule, ModelName, modelConfiguration, userConfig, UserParameters | {
+                "conversation": __resolve_blobs__(conversation)
+            })
+            responseTokens = [] if (cacheResponse) else None
+
+            if (flight is not None):
+                # The flight releases the queue slot when the inference ends, even if this request is cancelled
+                flight.Run(tokensSource, lambda: modelQueue.DeleteUID(queueUID))
+                tokensSource = flight.Follow()
+                releaseQueueUID = False
+
+        for token in tokensSource:
+            tokenTime = time.time()
+
+            if (responseTokens is not None):
+                responseTokens.append(token)
+
+            if (filesAsBlobs and "files" in token):
+                # Generated files are saved once in the blob store and sent as references
+                token = token | {"files": [__content_to_blob__(file, UserParameters["key_info"]["Key"]) for file in token["files"]]}
 
-        for token in Service.RunModuleFunction(serviceModule.ServiceModule, "SERVICE_INFERENCE", [
-            ModelName,
-            userConfig,
-            UserParameters | {
-                "conversation": conversation
-            }
-        ]):
             if ("text" in token):
                 if (convResultTxt is None):
-                    convResultTxt = ""
+                    convResultTxt = []
                 
-                convResultTxt += token["text"]
+                convResultTxt.append(token["text"])
             
             if ("files" in token):
-                convResultFiles += token["files"]
+                convResultFiles.extend(token["files"])
             
             if ("_save_response" in token):
                 saveResponse = token["_save_response"]
@@ -718,44 +1335,65 @@ def InferenceModel(
                 "errors": token["errors"] if ("errors" in token) else [],
                 "_queue_uid": queueUID
             }
-            tokenPriceData = CalculateTokenPrice(modelConfiguration, True, [
-                {
-                    "type": "text",
-                    "text": outputToken["response"]["text"]
-                }
-            ] + outputToken["response"]["files"])
-            outputTokens += tokenPriceData[1]
+            tokenUsage = token["usage"] if ("usage" in token) else None
 
-            if (tokensBudget < tokenPriceData[0]):
-                raise exceptions.NotEnoughTokensException(tokenPriceData[0], tokensBudget)
-            
-            tokensBudget -= tokenPriceData[0]
+            if (modelQueue is not None):
+                # Cached responses don't use the model, so they are not measured
+                modelQueue.Metrics["first_token" if (firstToken) else "inter_token"].Record(tokenTime - lastTokenTime)
             
-            if (firstToken):
-                firstTokenSeconds = time.time() - lastTokenTime
+            firstToken = False
 
-                if (modelQueue.FirstTokenSeconds is not None):
-                    firstTokenSeconds = (modelQueue.FirstTokenSeconds + firstTokenSeconds) / 2
+            if (heldTokens is not None):
+                # Not charged until the filters finish; the tokens of flagged conversations are never sent
+                heldTokens.append((outputToken, tokenUsage))
+                released = yield from __release_held_tokens__(filtersExecution, heldTokens, outputCounter, 0)
 
-                modelQueue.FirstTokenSeconds = round(firstTokenSeconds, 3)
-                firstToken = False
-            else:
-                if (tokensProcessingTime is None):
-                    tokensProcessingTime = time.time() - lastTokenTime
+                if (released is False):
+                    return
                 
-                tokensProcessingTime = (tokensProcessingTime + (time.time() - lastTokenTime)) / 2
+                if (released):
+                    heldTokens = None
+            else:
+                outputCounter.Add(outputToken["response"]["text"], outputToken["response"]["files"], tokenUsage)
+                yield outputToken
             
-            lastTokenTime = time.time()
-            yield outputToken
+            lastTokenTime = time.time()  # Do not count the time the client takes to receive the token
+        
+        if (heldTokens is not None and not (yield from __release_held_tokens__(filtersExecution, heldTokens, outputCounter, None))):
+            return
         
+        outputCounter.Flush()
+        outputTokens = outputCounter.Tokens
+
+        if (modelQueue is not None):
+            modelQueue.Metrics["duration"].Record(time.time() - processingStart)
+            modelQueue.Metrics["output_tokens"].Record(outputTokens)
+
+        if (responseTokens is not None and not any("errors" in token and len(token["errors"]) > 0 for token in responseTokens)):
+            ResponsesCache.Set(requestKey, responseTokens)
+
+        previousLength = len(conversation)
+
         if (saveResponse):
             conversation.append({
                 "role": "assistant",
-                "content": ([{"type": "text", "text": convResultTxt}] if (convResultTxt is not None) else []) + convResultFiles
+                "content": ([{"type": "text", "text": "".join(convResultTxt)}] if (convResultTxt is not None) else []) + convResultFiles
             })
 
-        yield {
-            "conversation_result": conversation,
+        if (storedMessages is not None):
+            conversations_manager.Release(conversationID, conversation)
+            storedMessages = None
+
+        if (conversationID is not None or ("delta_result" in UserParameters and UserParameters["delta_result"])):
+            # Only the assistant message is returned, the client already has the rest
+            conversationResult = {
+                "conversation_result": conversation[previousLength:],
+                "conversation_hash": GetConversationHash(conversation)
+            } | ({"conversation_id": conversationID} if (conversationID is not None) else {})
+        else:
+            conversationResult = {"conversation_result": conversation}
+
+        yield conversationResult | {
             "usage_tokens": {
                 "input": inputTokens,
                 "output": outputTokens,
@@ -766,14 +1404,34 @@ def InferenceModel(
     except StopIteration:
         pass
     finally:
-        if (tokensProcessingTime is not None):
-            if (modelQueue.TokensPerSecond is not None):
-                tokensProcessingTime = (1 / modelQueue.TokensPerSecond + tokensProcessingTime) / 2
+        if (storedMessages is not None):
+            # The request failed, the conversation is not modified
+            conversations_manager.Release(conversationID, None)
+
+        for blobHash in referencedBlobs:
+            Blobs.RemoveReference(blobHash)
+
+        if (filtersExecution is not None):
+            filtersExecution.Cancel()
+
+        if (tokensSource is not None and hasattr(tokensSource, "close")):
+            # Stops the inference if the request ended early
+            tokensSource.close()
+
+        if (modelQueue is not None and queueUID is not None and releaseQueueUID):
+            modelQueue.DeleteUID(queueUID)
+        
+        if (flight is not None):
+            if (isFlightLeader and releaseQueueUID):
+                # Failed before starting the inference
+                flight.Abandon()
             
-            modelQueue.TokensPerSecond = round(1 / tokensProcessingTime, 3)
+            flight.Leave()
         
-        if (modelQueue is not None):
-            modelQueue.DeleteUID(queueUID)
+        if (outputCounter is not None):
+            # Tokens that were not sent because of the budget are not charged
+            outputCounter.Flush()
+            tokensBudget -= min(outputCounter.Price, tokensBudget)
 
         UserParameters["key_info"]["Tokens"] -= initialTokensBudget - tokensBudget
         apiKey = keys_manager.APIKey.__from_dict__(UserParameters["key_info"])
@@ -1,97 +1,606 @@
+from typing import Any
+from collections.abc import Callable, Generator
+from queue import SimpleQueue
+from concurrent.futures import ThreadPoolExecutor
+from sortedcontainers import SortedList
+import itertools
+import math
+import os
+import threading
 import time
+import exceptions
+import Utilities.histograms as histograms
+
+Configuration: dict[str, Any] = {}
+
+class Wait():
+    # Yielded (as `{"_wait": Wait}`) by the requests that must wait for a queue or another request, so the caller can wait without blocking a thread.
+    # The callback is called when the wait ends; if the caller doesn't wait (`Waited` is False when the request continues), the request waits by itself.
+    def __init__(
+        self,
+        AddCallback: Callable[[Callable[[], None]], bool],
+        RemoveCallback: Callable[[Callable[[], None]], None],
+        Timeout: float | None
+    ) -> None:
+        self.AddCallback = AddCallback  # Returns False if the wait already ended
+        self.RemoveCallback = RemoveCallback
+        self.TIMEOUT = Timeout
+        self.Waited = False
 
 class Queue():
     def __init__(self, ModelName: str, MaxSimultaneousUsers: int) -> None:
         self.MODEL_NAME = ModelName
         self.MAX_SIMULTANEOUS_USERS = MaxSimultaneousUsers
-        self.__waiting_uids__ = []
-        self.__processing_uids__ = []
-        self.__next_uid__ = 0
-        self.TokensPerSecond = None
-        self.FirstTokenSeconds = None
+        self.__lock__ = threading.RLock()
+        self.__order__ = SortedList()  # [(order key, UID)], O(log n) insert, delete, pop and position
+        self.__waiting_uids__: dict[int, dict[str, Any]] = {}  # {UID: {"key": order key, "event": event}}
+        self.__processing_uids__: set[int] = set()
+        self.__sequence__ = itertools.count(1)
+        self.__virtual_time__ = 0.0
+        self.__tenants_finish__: dict[str, float] = {}
+        self.__created__ = time.monotonic()
+
+        metricsWindow = GetMetricsWindowSeconds()
+        self.Metrics: dict[str, histograms.Histogram] = {
+            "queue_wait": histograms.Histogram(WindowSeconds = metricsWindow),
+            "first_token": histograms.Histogram(WindowSeconds = metricsWindow),
+            "inter_token": histograms.Histogram(MinValue = 0.0001, MaxValue = 60, WindowSeconds = metricsWindow),
+            "duration": histograms.Histogram(WindowSeconds = metricsWindow),
+            "output_tokens": histograms.Histogram(MinValue = 1, MaxValue = 10000000, WindowSeconds = metricsWindow)
+        }
+    
+    @property
+    def FirstTokenSeconds(self) -> float | None:
+        return self.Metrics["first_token"].GetPercentile(50)
     
-    def CreateNewWaitingID(self, Prioritize: bool = False) -> int:
-        if (
-            1 not in self.__waiting_uids__ and 1 not in self.__processing_uids__ and
-            -1 not in self.__waiting_uids__ and -1 not in self.__processing_uids__
-        ):
-            self.__next_uid__ = 0
+    @property
+    def TokensPerSecond(self) -> float | None:
+        interTokenSeconds = self.Metrics["inter_token"].GetPercentile(50)
+        return round(1 / interTokenSeconds, 3) if (interTokenSeconds is not None and interTokenSeconds > 0) else None
 
-        self.__next_uid__ += 1
+    def __order_key__(self, UID: int, Tenant: str | None, Weight: float) -> tuple[tuple[int, float, int], float, float]:
+        # Prioritized users (negative UIDs) go first, then by virtual finish time (fair share), then by arrival order
+        fairConfig = GetFairQueuingConfiguration()
+        start = self.__virtual_time__
+        finish = start
 
-        if (Prioritize):
-            newUID = -self.__next_uid__
-        else:
-            newUID = self.__next_uid__
+        if (fairConfig["enabled"]):
+            if (Tenant is not None):
+                start = max(start, self.__tenants_finish__.get(Tenant, 0))
+            
+            finish = start + 1 / max(Weight, 0.001)
+
+            if (Tenant is not None):
+                self.__tenants_finish__[Tenant] = finish
         
-        self.__waiting_uids__.append(newUID)
-        return newUID
-    
+        cost = finish - start
+
+        # Aging: older requests get a lower key, so heavy tenants are never starved
+        finish += fairConfig["aging"] * (time.monotonic() - self.__created__)
+        return ((0 if (UID <= 0) else 1, finish, abs(UID)), start, cost)
+
+    @staticmethod
+    def __wake_up__(Waiter: dict[str, Any]) -> None:
+        # Must be called with the lock acquired
+        Waiter["event"].set()
+
+        for callback in Waiter["callbacks"]:
+            callback()
+
+    def __count_before__(self, Key: tuple[int, float, int]) -> int:
+        # Must be called with the lock acquired
+        return self.__order__.bisect_left((Key,))
+
+    def __promote__(self) -> None:
+        # Must be called with the lock acquired
+        while (len(self.__processing_uids__) < self.MAX_SIMULTANEOUS_USERS and len(self.__order__) > 0):
+            self.ProcessNextUser()
+
+    def CreateNewWaitingID(
+        self,
+        Prioritize: bool = False,
+        Tenant: str | None = None,
+        Weight: float = 1,
+        MaxQueueLength: int | None = None,
+        MaxWaitSeconds: float | None = None
+    ) -> int:
+        with self.__lock__:
+            if (MaxQueueLength is not None and MaxQueueLength > 0 and len(self.__waiting_uids__) >= MaxQueueLength):
+                raise exceptions.ServerBusyException(self.EstimateWaitSeconds(len(self.__waiting_uids__) - MaxQueueLength))
+
+            uid = next(self.__sequence__)
+            newUID = -uid if (Prioritize) else uid
+            previousFinish = self.__tenants_finish__.get(Tenant) if (Tenant is not None) else None
+            key, start, cost = self.__order_key__(newUID, Tenant, Weight)
+
+            if (MaxWaitSeconds is not None and MaxWaitSeconds > 0):
+                waitSeconds = self.EstimateWaitSeconds(self.__count_before__(key))
+
+                if (waitSeconds is not None and waitSeconds > MaxWaitSeconds):
+                    # Rejected, undo the fair share of this request
+                    if (Tenant is not None and previousFinish is None):
+                        self.__tenants_finish__.pop(Tenant, None)
+                    elif (Tenant is not None):
+                        self.__tenants_finish__[Tenant] = previousFinish
+
+                    raise exceptions.ServerBusyException(round(waitSeconds - MaxWaitSeconds, 1))
+
+            self.__waiting_uids__[newUID] = {
+                "key": key,
+                "start": start,
+                "tenant": Tenant,
+                "cost": cost,
+                "created": time.monotonic(),
+                "event": threading.Event(),
+                "callbacks": []
+            }
+            self.__order__.add((key, newUID))
+
+            self.__promote__()
+            return newUID
+
     def DeleteUID(self, UID: int | list[int]) -> None:
         if (isinstance(UID, list)):
             for uid in UID:
                 self.DeleteUID(uid)
 
-        if (UID in self.__waiting_uids__):
-            self.__waiting_uids__.remove(UID)
-        
-        if (UID in self.__processing_uids__):
-            self.__processing_uids__.remove(UID)
+            return
+
+        with self.__lock__:
+            if (UID in self.__waiting_uids__):
+                waiter = self.__waiting_uids__.pop(UID)
+                self.__order__.remove((waiter["key"], UID))
+                self.__wake_up__(waiter)  # Wake up the waiter so it can exit
+
+                if (waiter["tenant"] in self.__tenants_finish__):
+                    # Never processed, give back its share so the tenant is not penalized for cancelled requests
+                    self.__tenants_finish__[waiter["tenant"]] = max(self.__tenants_finish__[waiter["tenant"]] - waiter["cost"], self.__virtual_time__)
+
+            if (UID in self.__processing_uids__):
+                self.__processing_uids__.remove(UID)
+
+            self.__promote__()
 
     def ProcessNextUser(self) -> None:
-        priorityUsers = [uid for uid in self.__waiting_uids__ if (uid <= 0)]
-        nonPriorityUsers = [uid for uid in self.__waiting_uids__ if (uid > 0)]
+        with self.__lock__:
+            if (len(self.__order__) > 0):
+                _, selectedUID = self.__order__.pop(0)
+                waiter = self.__waiting_uids__.pop(selectedUID)
+                self.__processing_uids__.add(selectedUID)
+                self.__virtual_time__ = max(self.__virtual_time__, waiter["start"])
+                self.Metrics["queue_wait"].Record(time.monotonic() - waiter["created"])
 
-        if (len(priorityUsers) > 0):
-            selectedUID = max(priorityUsers)
-        elif (len(nonPriorityUsers) > 0):
-            selectedUID = min(nonPriorityUsers)
-        else:
-            selectedUID = None
+                if (len(self.__tenants_finish__) > 1024):
+                    # Tenants behind the virtual time are the same as new tenants
+                    self.__tenants_finish__ = {t: f for t, f in self.__tenants_finish__.items() if (f > self.__virtual_time__)}
+
+                self.__wake_up__(waiter)
+
+    def WaitForProcessing(self, UID: int, Timeout: float | None = None) -> bool:
+        with self.__lock__:
+            if (UID in self.__processing_uids__):
+                return True
+
+            if (UID not in self.__waiting_uids__):
+                return False
+
+            event = self.__waiting_uids__[UID]["event"]
+
+        event.wait(Timeout)
+
+        with self.__lock__:
+            return UID in self.__processing_uids__
+
+    def AddProcessingCallback(self, UID: int, Callback: Callable[[], None]) -> bool:
+        # The callback is called (with the lock acquired) when the UID starts processing or is deleted; returns False if the UID is not waiting
+        with self.__lock__:
+            if (UID not in self.__waiting_uids__):
+                return False
+
+            self.__waiting_uids__[UID]["callbacks"].append(Callback)
+            return True
+
+    def RemoveProcessingCallback(self, UID: int, Callback: Callable[[], None]) -> None:
+        with self.__lock__:
+            if (UID in self.__waiting_uids__ and Callback in self.__waiting_uids__[UID]["callbacks"]):
+                self.__waiting_uids__[UID]["callbacks"].remove(Callback)
+
+    def CreateWait(self, UID: int, Timeout: float | None) -> Wait:
+        return Wait(lambda Callback: self.AddProcessingCallback(UID, Callback), lambda Callback: self.RemoveProcessingCallback(UID, Callback), Timeout)
+
+    def GetUsersBeforeUID(self, UID: int) -> int:
+        with self.__lock__:
+            if (UID in self.__processing_uids__):
+                return 0
+
+            if (UID not in self.__waiting_uids__):
+                return -1
+
+            return self.__count_before__(self.__waiting_uids__[UID]["key"])
+
+    def EstimateRequestSeconds(self) -> float | None:
+        return self.Metrics["duration"].GetPercentile(50)
+
+    def EstimateWaitSeconds(self, UsersBefore: int) -> float | None:
+        with self.__lock__:
+            if (len(self.__processing_uids__) + UsersBefore < self.MAX_SIMULTANEOUS_USERS):
+                return 0
         
-        if (selectedUID is None):
-            return
+        requestSeconds = self.EstimateRequestSeconds()
+
+        if (requestSeconds is None):
+            return None
         
-        self.__waiting_uids__.remove(selectedUID)
-        self.__processing_uids__.append(selectedUID)
-    
-    def WaitForProcessing(self, UID: int) -> None:
-        while (UID in self.__waiting_uids__ and UID not in self.__processing_uids__):
-            if (len(self.__processing_uids__) < self.MAX_SIMULTANEOUS_USERS):
-                self.ProcessNextUser()
+        return round(math.ceil((UsersBefore + 1) / self.MAX_SIMULTANEOUS_USERS) * requestSeconds, 1)
+
+    def GetWaitingCount(self) -> int:
+        with self.__lock__:
+            return len(self.__waiting_uids__)
 
-            time.sleep(0.1)
+    def GetProcessingCount(self) -> int:
+        with self.__lock__:
+            return len(self.__processing_uids__)
     
-    def GetUsersBeforeUID(self, UID: int) -> int:
-        if (UID in self.__processing_uids__):
-            return 0
+    def GetLatencyStats(self) -> dict[str, dict[str, Any]]:
+        return {name: histogram.GetPercentiles() for name, histogram in self.Metrics.items()}
+
+class Batcher():
+    def __init__(
+        self,
+        ModelName: str,
+        MaxBatchSize: int,
+        WindowSeconds: float,
+        RunBatch: Callable[[list[Any]], Generator[tuple[int, dict[str, Any]]]],
+        Source: Any = None
+    ) -> None:
+        self.MODEL_NAME = ModelName
+        self.MAX_BATCH_SIZE = max(MaxBatchSize, 1)
+        self.WINDOW_SECONDS = max(WindowSeconds, 0)
+        self.SOURCE = Source  # What the batches run on (service module, configuration...), the batcher is replaced when it changes
+        self.__run_batch__ = RunBatch
+        self.__condition__ = threading.Condition()
+        self.__pending__: list[dict[str, Any]] = []
+        self.__dispatching__ = False
+        self.BatchesCount = 0
+        self.BatchedRequestsCount = 0
+
+    def __dispatcher__(self) -> None:
+        while (True):
+            with self.__condition__:
+                if (len(self.__pending__) == 0):
+                    self.__dispatching__ = False
+                    return
+
+                # Wait for more requests until the batch is full or the window ends
+                self.__condition__.wait_for(lambda: len(self.__pending__) >= self.MAX_BATCH_SIZE, self.WINDOW_SECONDS)
+
+                batch = [request for request in self.__pending__[:self.MAX_BATCH_SIZE] if (not request["cancelled"])]
+                del self.__pending__[:self.MAX_BATCH_SIZE]
+
+                if (len(batch) == 0):
+                    continue
+
+                self.BatchesCount += 1
+                self.BatchedRequestsCount += len(batch)
+
+            GetBatchesPool().submit(self.__run__, batch)
+
+    def __run__(self, Batch: list[dict[str, Any]]) -> None:
+        tokens = None
+
+        try:
+            tokens = self.__run_batch__([request["payload"] for request in Batch])
+
+            for idx, token in tokens:
+                if (all(request["cancelled"] for request in Batch)):
+                    # Nobody is receiving the tokens
+                    break
+
+                if (not Batch[idx]["cancelled"]):
+                    Batch[idx]["tokens"].put(token)
+        except Exception as ex:
+            for request in Batch:
+                request["tokens"].put(ex)
+        finally:
+            if (tokens is not None and hasattr(tokens, "close")):
+                tokens.close()
+
+            for request in Batch:
+                request["tokens"].put(None)
+
+    def Submit(self, Payload: Any) -> Generator[dict[str, Any]]:
+        request = {"payload": Payload, "tokens": SimpleQueue(), "cancelled": False}
+
+        with self.__condition__:
+            self.__pending__.append(request)
+            self.__condition__.notify_all()
+
+            if (not self.__dispatching__):
+                self.__dispatching__ = True
+                threading.Thread(target = self.__dispatcher__, daemon = True).start()
+
+        try:
+            while (True):
+                token = request["tokens"].get()
+
+                if (token is None):
+                    break
+
+                if (isinstance(token, Exception)):
+                    raise token
+
+                yield token
+        finally:
+            with self.__condition__:
+                # Not sent to the model if the batch didn't start
+                request["cancelled"] = True
+
+                if (request in self.__pending__):
+                    self.__pending__.remove(request)
+
+class Flight():
+    # Single inference shared by identical requests running at the same time.
+    # The inference runs in its own thread, so it keeps going for the other requests if the first one is cancelled.
+    def __init__(self, Key: str) -> None:
+        self.KEY = Key
+        self.ModelQueue: Queue | None = None  # Queue and UID of the first request, used to send the queue position to the others
+        self.QueueUID: int | None = None
+        self.__condition__ = threading.Condition()
+        self.__tokens__: list[dict[str, Any]] = []
+        self.__subscribers__ = 1
+        self.__started__ = False
+        self.__finished__ = False
+        self.__abandoned__ = False
+        self.__error__: Exception | None = None
+        self.__start_callbacks__: list[Callable[[], None]] = []
+
+    def __notify_start__(self) -> None:
+        # Must be called with the condition acquired
+        self.__condition__.notify_all()
+
+        for callback in self.__start_callbacks__:
+            callback()
         
-        if (UID not in self.__waiting_uids__):
-            return -1
+        self.__start_callbacks__.clear()
+
+    def Join(self) -> bool:
+        with self.__condition__:
+            if (self.__finished__):
+                return False
+            
+            self.__subscribers__ += 1
+            return True
+    
+    def Leave(self) -> None:
+        with self.__condition__:
+            self.__subscribers__ -= 1
+
+    def WaitForStart(self, Timeout: float | None = None) -> bool | None:
+        # True when the inference started, False when it will never start, None on timeout
+        with self.__condition__:
+            self.__condition__.wait_for(lambda: self.__started__ or self.__abandoned__, Timeout)
+
+            if (self.__started__):
+                return True
+            
+            return False if (self.__abandoned__) else None
+
+    def AddStartCallback(self, Callback: Callable[[], None]) -> bool:
+        # The callback is called when the inference starts or is abandoned; returns False if that already happened
+        with self.__condition__:
+            if (self.__started__ or self.__abandoned__):
+                return False
+            
+            self.__start_callbacks__.append(Callback)
+            return True
+    
+    def RemoveStartCallback(self, Callback: Callable[[], None]) -> None:
+        with self.__condition__:
+            if (Callback in self.__start_callbacks__):
+                self.__start_callbacks__.remove(Callback)
+
+    def Abandon(self) -> None:
+        # The first request could not start the inference (rejected, filtered...); the others will run on their own
+        with self.__condition__:
+            self.__abandoned__ = True
+            self.__finished__ = True
+            self.__notify_start__()
         
-        priorityUsers = [uid for uid in self.__waiting_uids__ if (uid <= 0)]
-        nonPriorityUsers = [uid for uid in self.__waiting_uids__ if (uid > 0)]
+        __remove_flight__(self)
+
+    def Run(self, Source: Generator[dict[str, Any]], OnFinish: Callable[[], None]) -> None:
+        def __pump__() -> None:
+            error = None
+
+            try:
+                for token in Source:
+                    with self.__condition__:
+                        if (self.__subscribers__ <= 0):
+                            # Nobody is receiving the tokens
+                            break
+
+                        self.__tokens__.append(token)
+                        self.__condition__.notify_all()
+            except Exception as ex:
+                error = ex
+            finally:
+                if (hasattr(Source, "close")):
+                    Source.close()
+                
+                OnFinish()
 
-        usersBefore = 0
+                with self.__condition__:
+                    self.__error__ = error
+                    self.__finished__ = True
+                    self.__condition__.notify_all()
+                
+                __remove_flight__(self)
 
-        if (UID <= 0):
-            for uid in priorityUsers:
-                if (uid > UID):
-                    usersBefore += 1
+        with self.__condition__:
+            self.__started__ = True
+            self.__notify_start__()
+
+        threading.Thread(target = __pump__, daemon = True).start()
+
+    def Follow(self) -> Generator[dict[str, Any]]:
+        index = 0
+
+        while (True):
+            with self.__condition__:
+                self.__condition__.wait_for(lambda: index < len(self.__tokens__) or self.__finished__)
+
+                tokens = self.__tokens__[index:]
+                finished = self.__finished__
+                error = self.__error__
+            
+            for token in tokens:
+                yield token
+            
+            index += len(tokens)
+
+            if (finished):
+                if (error is not None):
+                    raise error
+                
+                return
+
+def GetFairQueuingConfiguration() -> dict[str, Any]:
+    if ("server_queue" in Configuration and "fair_queuing" in Configuration["server_queue"]):
+        fairConfig = Configuration["server_queue"]["fair_queuing"]
+    else:
+        fairConfig = {}
+    
+    return {
+        "enabled": fairConfig["enabled"] if ("enabled" in fairConfig) else False,
+        "key_by": fairConfig["key_by"] if ("key_by" in fairConfig) else "key",
+        "weights": fairConfig["weights"] if ("weights" in fairConfig and fairConfig["weights"] is not None) else {},
+        "default_weight": fairConfig["default_weight"] if ("default_weight" in fairConfig) else 1,
+        "aging": fairConfig["aging"] if ("aging" in fairConfig) else 0
+    }
+
+def GetFairShare(KeyInfo: dict[str, Any]) -> tuple[str | None, float]:
+    fairConfig = GetFairQueuingConfiguration()
+
+    if (not fairConfig["enabled"]):
+        return (None, 1)
+    
+    weights = fairConfig["weights"]
+    groups = KeyInfo["Groups"] if ("Groups" in KeyInfo and KeyInfo["Groups"] is not None) else []
+    groupsWeights = [(weights[group], group) for group in groups if (group in weights)]
+
+    if (fairConfig["key_by"] == "group" and len(groups) > 0):
+        if (len(groupsWeights) > 0):
+            weight, group = max(groupsWeights)
         else:
-            usersBefore += len(priorityUsers)
+            weight, group = (fairConfig["default_weight"], sorted(groups)[0])
 
-            for uid in nonPriorityUsers:
-                if (uid < UID):
-                    usersBefore += 1
-        
-        return usersBefore
+        return (f"group:{group}", weight)
+    
+    if (KeyInfo["Key"] in weights):
+        weight = weights[KeyInfo["Key"]]
+    elif (len(groupsWeights) > 0):
+        weight = max(groupsWeights)[0]
+    else:
+        weight = fairConfig["default_weight"]
+    
+    return (f"key:{KeyInfo['Key']}", weight)
 
-Queues: list[Queue] = []
+def GetMetricsWindowSeconds() -> float:
+    if ("server_queue" in Configuration and "metrics_window_seconds" in Configuration["server_queue"]):
+        return Configuration["server_queue"]["metrics_window_seconds"]
+    
+    return 300
+
+def GetQueueUpdatesInterval(Requested: float | None = None) -> float | None:
+    if ("server_queue" in Configuration and "queue_updates" in Configuration["server_queue"]):
+        updatesConfig = Configuration["server_queue"]["queue_updates"]
+    else:
+        updatesConfig = {}
+    
+    defaultInterval = updatesConfig["default_interval"] if ("default_interval" in updatesConfig) else 2
+    minInterval = updatesConfig["min_interval"] if ("min_interval" in updatesConfig and updatesConfig["min_interval"] is not None) else 0.5
+    interval = defaultInterval if (Requested is None) else Requested
+
+    if (interval is None or interval <= 0):
+        return None
+    
+    return max(interval, minInterval)
+
+Queues: dict[str, Queue] = {}
+QueuesLock: threading.Lock = threading.Lock()
+Batchers: dict[str, Batcher] = {}
+BatchesPool: ThreadPoolExecutor | None = None
+Flights: dict[str, Flight] = {}
+FlightsLock: threading.Lock = threading.Lock()
+FlightsStats: dict[str, int] = {"flights": 0, "coalesced_requests": 0}
 
 def GetQueueForModel(ModelName: str) -> Queue | None:
-    for queue in Queues:
-        if (queue.MODEL_NAME == ModelName):
-            return queue
+    return Queues.get(ModelName)
+
+def GetOrCreateQueue(ModelName: str, MaxSimultaneousUsers: int) -> Queue:
+    queue = Queues.get(ModelName)
+
+    if (queue is not None):
+        return queue
+
+    with QueuesLock:
+        if (ModelName not in Queues):
+            Queues[ModelName] = Queue(ModelName = ModelName, MaxSimultaneousUsers = MaxSimultaneousUsers)
+
+        return Queues[ModelName]
+
+def GetBatchesPool() -> ThreadPoolExecutor:
+    global BatchesPool
+
+    if (BatchesPool is None):
+        with QueuesLock:
+            if (BatchesPool is None):
+                BatchesPool = ThreadPoolExecutor(max_workers = min(32, (os.cpu_count() or 1) + 4), thread_name_prefix = "i4_batch")
     
-    return None
\ No newline at end of file
+    return BatchesPool
+
+def __is_same_batcher__(BatcherInstance: Batcher, MaxBatchSize: int, WindowSeconds: float, Source: Any) -> bool:
+    return (
+        BatcherInstance.MAX_BATCH_SIZE == max(MaxBatchSize, 1) and
+        BatcherInstance.WINDOW_SECONDS == max(WindowSeconds, 0) and
+        BatcherInstance.SOURCE is Source
+    )
+
+def GetOrCreateBatcher(
+    ModelName: str,
+    MaxBatchSize: int,
+    WindowSeconds: float,
+    RunBatch: Callable[[list[Any]], Generator[tuple[int, dict[str, Any]]]],
+    Source: Any = None
+) -> Batcher:
+    # A new batcher is created when the model is reloaded or its configuration changes; the old one finishes its batches
+    batcher = Batchers.get(ModelName)
+
+    if (batcher is not None and __is_same_batcher__(batcher, MaxBatchSize, WindowSeconds, Source)):
+        return batcher
+
+    with QueuesLock:
+        if (ModelName not in Batchers or not __is_same_batcher__(Batchers[ModelName], MaxBatchSize, WindowSeconds, Source)):
+            Batchers[ModelName] = Batcher(ModelName, MaxBatchSize, WindowSeconds, RunBatch, Source)
+
+        return Batchers[ModelName]
+
+def JoinFlight(Key: str) -> tuple[Flight, bool]:
+    # Returns the flight and if this request is the one that must run the inference
+    with FlightsLock:
+        flight = Flights.get(Key)
+
+        if (flight is not None and flight.Join()):
+            FlightsStats["coalesced_requests"] += 1
+            return (flight, False)
+
+        flight = Flight(Key)
+        Flights[Key] = flight
+        FlightsStats["flights"] += 1
+
+        return (flight, True)
+
+def __remove_flight__(FlightInstance: Flight) -> None:
+    with FlightsLock:
+        if (Flights.get(FlightInstance.KEY) is FlightInstance):
+            del Flights[FlightInstance.KEY]